@@ -40,7 +40,7 @@ fi
 
 # Start Flask backend in background
 echo "Starting Flask backend server (port 8000)..."
-python server/app.py 2>&1 &
+gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:8000 server.app:app 2>&1 &
 FLASK_PID=$!
 
 # Wait for backend to start
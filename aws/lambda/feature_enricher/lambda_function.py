@@ -7,46 +7,190 @@ import json
 import os
 import boto3
 import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 from decimal import Decimal
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.config import Config
 
-# Configure logging
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib encoder
+    orjson = None
+
+# Configure logging. LOG_LEVEL lets production run at WARNING; info logs in
+# the per-request path are guarded so they cost nothing when disabled.
+# Unrecognized values fall back to INFO rather than failing the cold start.
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+if isinstance(logging.getLevelName(LOG_LEVEL), int):
+    logger.setLevel(LOG_LEVEL)
+else:
+    logger.setLevel(logging.INFO)
+    logger.warning(f"Unknown LOG_LEVEL {LOG_LEVEL!r}, using INFO")
+
+# Initialize AWS clients once per container so warm invocations reuse
+# the same session, connection pool and TLS connections
+_boto_config = Config(
+    max_pool_connections=10,
+    retries={'mode': 'adaptive', 'max_attempts': 3},
+    tcp_keepalive=True,
+    connect_timeout=1,
+    read_timeout=3
+)
+_session = boto3.session.Session()
+dynamodb_client = _session.client('dynamodb', config=_boto_config)
+ssm_client = _session.client('ssm', config=_boto_config)
 
-# Initialize AWS clients
-dynamodb = boto3.resource('dynamodb')
-ssm_client = boto3.client('ssm')
+# Optional DAX cluster for batch reads. Writes are conditional and go to
+# DynamoDB, so a stale DAX read only costs one failed conditional write.
+# amazon-dax-client is optional and only imported when an endpoint is
+# configured; without it batch reads go straight to DynamoDB.
+DAX_ENDPOINT = os.environ.get('DAX_ENDPOINT')
+features_batch_client = dynamodb_client
+if DAX_ENDPOINT:
+    try:
+        from amazondax import AmazonDaxClient
+        features_batch_client = AmazonDaxClient(session=_session, endpoint_url=DAX_ENDPOINT)
+    except ImportError:
+        logger.warning("DAX_ENDPOINT is set but amazon-dax-client is not installed; using DynamoDB directly")
 
-# Cache for SSM parameters
+# Cache for SSM parameters: name -> (value, expiry as time.monotonic())
 _parameter_cache = {}
 
+# Seconds a cached parameter stays valid, so rotated values are eventually picked up
+PARAMETER_CACHE_TTL = int(os.environ.get('PARAMETER_CACHE_TTL', '300'))
+
+# Background refreshes of expired parameters, so the SSM call overlaps the
+# DynamoDB write instead of running in front of it
+_refresh_executor = ThreadPoolExecutor(max_workers=2)
+_refreshing = set()
+
 # Get environment from Lambda environment variable
 ENVIRONMENT = os.environ.get('ENVIRONMENT', 'dev')
 
+# Parameters every invocation needs, fetched together during cold start
+REQUIRED_PARAMS = ['/referral-system/customer-features-table-name']
+
+# Maximum conditional write attempts when the stored features change underneath us
+MAX_WRITE_ATTEMPTS = 3
+
+# Features this container last wrote, keyed by customer email:
+# email -> (features, expiry as time.monotonic()). A stale entry only costs
+# one failed conditional write, which returns the current item.
+_feature_cache = {}
+FEATURE_CACHE_TTL = int(os.environ.get('FEATURE_CACHE_TTL', '60'))
+FEATURE_CACHE_MAX_ENTRIES = 1024
+
+# DynamoDB limit for a single BatchGetItem request
+BATCH_GET_MAX_KEYS = 100
+
+# Retries for keys DynamoDB leaves unprocessed (usually throttling),
+# with full-jitter exponential backoff capped at BATCH_BACKOFF_MAX seconds
+BATCH_MAX_ATTEMPTS = 8
+BATCH_BACKOFF_BASE = 0.05
+BATCH_BACKOFF_MAX = 2.0
+
+# Stored attributes the feature calculations read back
+EXISTING_FEATURE_ATTRIBUTES = ('satisfaction_avg', 'service_count', 'first_seen')
+
+# Satisfaction averages are 0-5 rounded to 2 decimals, so their Decimal
+# forms can be built once instead of going through str() on every record
+_SATISFACTION_DECIMALS = {i / 100: Decimal(str(i / 100)) for i in range(0, 501)}
+
+# Lifetime value indexed by count_tier * 3 + satisfaction_tier, where
+# count_tier is 0 (<3 services), 1 (3-5) or 2 (6+) and satisfaction_tier is
+# 0 (<3.5), 1 (3.5-4.0) or 2 (4.0+):
+#   high   - many services and high satisfaction
+#   medium - moderate services or good satisfaction
+#   low    - few services and low satisfaction
+_LIFETIME_VALUES = (
+    'low', 'medium', 'medium',
+    'medium', 'medium', 'medium',
+    'medium', 'medium', 'high',
+)
+
+# Shared result for payloads without address or property info (never mutated)
+_EMPTY_PROPERTY_FEATURES = {}
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+def get_env_specific_name(parameter_name: str) -> str:
+    """
+    Map a base parameter name to its environment-specific path.
+    """
+    if parameter_name.startswith('/referral-system/'):
+        return parameter_name.replace('/referral-system/', f'/referral-system/{ENVIRONMENT}/')
+    return parameter_name
+
+
+def prefetch_parameters(parameter_names: List[str]) -> None:
+    """
+    Load parameters into the cache with a single GetParameters call.
+    Both the environment-specific and legacy paths are requested; names that
+    don't exist are simply left for get_parameter to resolve on demand.
+    
+    Args:
+        parameter_names: Base parameter names to prefetch
+    """
+    names = []
+    for parameter_name in parameter_names:
+        names.extend([get_env_specific_name(parameter_name), parameter_name])
+    names = list(dict.fromkeys(names))
+    
+    expiry = time.monotonic() + PARAMETER_CACHE_TTL
+    for start in range(0, len(names), 10):
+        response = ssm_client.get_parameters(Names=names[start:start + 10])
+        for parameter in response['Parameters']:
+            _parameter_cache[parameter['Name']] = (parameter['Value'], expiry)
+    logger.info(f"Prefetched {len(_parameter_cache)} parameters")
+
+
+def refresh_parameter(param_name: str) -> None:
+    """
+    Re-fetch an expired parameter in the background and update the cache.
+    """
+    try:
+        response = ssm_client.get_parameter(Name=param_name)
+        _parameter_cache[param_name] = (response['Parameter']['Value'], time.monotonic() + PARAMETER_CACHE_TTL)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Refreshed parameter: %s", param_name)
+    except Exception as e:
+        logger.warning(f"Could not refresh parameter {param_name}: {str(e)}")
+    finally:
+        _refreshing.discard(param_name)
+
 
 def get_parameter(parameter_name: str) -> str:
     """
     Retrieve parameter from SSM Parameter Store with caching.
     Supports environment-specific parameters with backward compatibility.
+    Expired values are returned as-is while a refresh runs in the background.
     """
-    # Construct environment-specific parameter name
-    if parameter_name.startswith('/referral-system/'):
-        env_specific_name = parameter_name.replace('/referral-system/', f'/referral-system/{ENVIRONMENT}/')
-    else:
-        env_specific_name = parameter_name
+    env_specific_name = get_env_specific_name(parameter_name)
     
     # Try environment-specific parameter first, then fallback to old path
+    now = time.monotonic()
     for param_name in [env_specific_name, parameter_name]:
-        if param_name in _parameter_cache:
-            return _parameter_cache[param_name]
+        cached = _parameter_cache.get(param_name)
+        if cached:
+            if cached[1] <= now and param_name not in _refreshing:
+                _refreshing.add(param_name)
+                _refresh_executor.submit(refresh_parameter, param_name)
+            return cached[0]
         
         try:
             response = ssm_client.get_parameter(Name=param_name)
-            _parameter_cache[param_name] = response['Parameter']['Value']
-            logger.info(f"Retrieved parameter: {param_name}")
-            return _parameter_cache[param_name]
+            value = response['Parameter']['Value']
+            _parameter_cache[param_name] = (value, now + PARAMETER_CACHE_TTL)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Retrieved parameter: %s", param_name)
+            return value
         except ssm_client.exceptions.ParameterNotFound:
             continue
         except Exception as e:
@@ -56,6 +200,39 @@ def get_parameter(parameter_name: str) -> str:
     raise ValueError(f"Parameter not found: {parameter_name} or {env_specific_name}")
 
 
+def warm_connections() -> None:
+    """
+    Open the DynamoDB connection (DNS + TLS) during INIT. SSM is already
+    warmed by the parameter prefetch.
+    """
+    try:
+        dynamodb_client.describe_endpoints()
+    except Exception as e:
+        logger.warning(f"Could not warm DynamoDB connection: {str(e)}")
+
+
+# Pay the SSM round trip during cold start instead of on the first request;
+# PREFETCH_PARAMETERS=false skips it where SSM isn't reachable (e.g. unit tests)
+if os.environ.get('PREFETCH_PARAMETERS', 'true').lower() == 'true':
+    try:
+        prefetch_parameters(REQUIRED_PARAMS)
+    except Exception as e:
+        logger.warning(f"Could not prefetch parameters: {str(e)}")
+
+# Provisioned environments initialize ahead of traffic, so handshakes done
+# here never show up in request latency. On-demand cold starts would just
+# pay the same cost a little earlier, so skip it there.
+if os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE') == 'provisioned-concurrency':
+    warm_connections()
+
+
+def get_features_table_name() -> str:
+    """
+    Return the Feature Store table name (served from the parameter cache).
+    """
+    return get_parameter('/referral-system/customer-features-table-name')
+
+
 def calculate_satisfaction_avg(customer_data: Dict[str, Any], existing_features: Optional[Dict[str, Any]] = None) -> float:
     """
     Calculate average satisfaction score from service history.
@@ -113,13 +290,14 @@ def calculate_service_count(customer_data: Dict[str, Any], existing_features: Op
     return 1
 
 
-def get_lifetime_value(customer_data: Dict[str, Any], existing_features: Optional[Dict[str, Any]] = None) -> str:
+def get_lifetime_value(customer_data: Dict[str, Any], service_count: int, satisfaction: float) -> str:
     """
     Determine customer lifetime value category.
     
     Args:
         customer_data: Current webhook payload
-        existing_features: Existing features from Feature Store
+        service_count: Total service count (from calculate_service_count)
+        satisfaction: Average satisfaction score (from calculate_satisfaction_avg)
         
     Returns:
         Lifetime value category: 'high', 'medium', or 'low'
@@ -129,19 +307,9 @@ def get_lifetime_value(customer_data: Dict[str, Any], existing_features: Optiona
     if lifetime_value:
         return str(lifetime_value).lower()
     
-    # Calculate based on service count and satisfaction
-    service_count = calculate_service_count(customer_data, existing_features)
-    satisfaction = calculate_satisfaction_avg(customer_data, existing_features)
-    
-    # High: many services and high satisfaction
-    if service_count >= 6 and satisfaction >= 4.0:
-        return 'high'
-    # Medium: moderate services or good satisfaction
-    elif service_count >= 3 or satisfaction >= 3.5:
-        return 'medium'
-    # Low: few services and low satisfaction
-    else:
-        return 'low'
+    count_tier = (service_count >= 3) + (service_count >= 6)
+    satisfaction_tier = (satisfaction >= 3.5) + (satisfaction >= 4.0)
+    return _LIFETIME_VALUES[count_tier * 3 + satisfaction_tier]
 
 
 def extract_property_features(customer_data: Dict[str, Any]) -> Dict[str, Any]:
@@ -154,17 +322,20 @@ def extract_property_features(customer_data: Dict[str, Any]) -> Dict[str, Any]:
     Returns:
         Dictionary of property features
     """
+    address = customer_data.get('customer', {}).get('address')
+    property_info = customer_data.get('property_info')
+    if not address and not property_info:
+        return _EMPTY_PROPERTY_FEATURES
+    
     property_features = {}
     
     # Extract from address
-    address = customer_data.get('customer', {}).get('address', {})
     if address:
         property_features['city'] = address.get('city')
         property_features['state'] = address.get('state')
         property_features['zip'] = address.get('zip')
     
     # Extract from property_info if available
-    property_info = customer_data.get('property_info', {})
     if property_info:
         property_features['property_type'] = property_info.get('type')
         property_features['square_feet'] = property_info.get('square_feet')
@@ -174,12 +345,23 @@ def extract_property_features(customer_data: Dict[str, Any]) -> Dict[str, Any]:
     return property_features
 
 
-def enrich_customer_features(customer_data: Dict[str, Any]) -> Dict[str, Any]:
+def to_satisfaction_decimal(value: float) -> Decimal:
+    """
+    Convert a satisfaction average to Decimal, using the precomputed table when possible.
+    """
+    cached = _SATISFACTION_DECIMALS.get(value)
+    if cached is None:
+        return Decimal(str(value))
+    return cached
+
+
+def enrich_customer_features(customer_data: Dict[str, Any], existing_features: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
     Calculate and return all customer features.
     
     Args:
         customer_data: Webhook payload with customer and service data
+        existing_features: Features currently stored for the customer (if any)
         
     Returns:
         Dictionary of calculated features
@@ -188,73 +370,314 @@ def enrich_customer_features(customer_data: Dict[str, Any]) -> Dict[str, Any]:
     if not customer_email:
         raise ValueError("Customer email is required")
     
-    # Get existing features from Feature Store
-    table_name = get_parameter('/referral-system/customer-features-table-name')
-    features_table = dynamodb.Table(table_name)
-    
-    existing_features = None
-    try:
-        response = features_table.get_item(Key={'customerEmail': customer_email})
-        if 'Item' in response:
-            existing_features = response['Item']
-            logger.info(f"Found existing features for {customer_email}")
-    except Exception as e:
-        logger.warning(f"Could not retrieve existing features: {str(e)}")
-    
     # Calculate features
     satisfaction_avg = calculate_satisfaction_avg(customer_data, existing_features)
     service_count = calculate_service_count(customer_data, existing_features)
-    lifetime_value = get_lifetime_value(customer_data, existing_features)
+    lifetime_value = get_lifetime_value(customer_data, service_count, satisfaction_avg)
     property_features = extract_property_features(customer_data)
     
-    # Build feature record
-    feature_record = {
+    # Build feature record in one literal; first_seen is kept for known customers
+    now_iso = datetime.now(timezone.utc).isoformat()
+    first_seen = existing_features.get('first_seen', now_iso) if existing_features else now_iso
+    return {
         'customerEmail': customer_email,
-        'satisfaction_avg': Decimal(str(satisfaction_avg)),
+        'satisfaction_avg': to_satisfaction_decimal(satisfaction_avg),
         'service_count': service_count,
         'lifetime_value': lifetime_value,
         'property_features': property_features,
-        'last_updated': datetime.now(timezone.utc).isoformat()
+        'last_updated': now_iso,
+        'first_seen': first_seen
+    }
+
+
+def to_dynamodb_item(feature_record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Build the Feature Store item directly in DynamoDB JSON, skipping the resource layer.
+    """
+    return {
+        'customerEmail': {'S': feature_record['customerEmail']},
+        'satisfaction_avg': {'N': str(feature_record['satisfaction_avg'])},
+        'service_count': {'N': str(feature_record['service_count'])},
+        'lifetime_value': {'S': feature_record['lifetime_value']},
+        'property_features': _serializer.serialize(feature_record['property_features']),
+        'last_updated': {'S': feature_record['last_updated']},
+        'first_seen': {'S': feature_record.get('first_seen', feature_record['last_updated'])}
     }
-    
-    # Add first_seen timestamp if this is a new customer
-    if not existing_features:
-        feature_record['first_seen'] = datetime.now(timezone.utc).isoformat()
-    else:
-        feature_record['first_seen'] = existing_features.get('first_seen', feature_record['last_updated'])
-    
-    return feature_record
 
 
-def update_feature_store(feature_record: Dict[str, Any]) -> None:
+def to_existing_features(item: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Update Feature Store with calculated features.
+    Deserialize only the stored attributes the calculations use; property_features can be large.
+    """
+    return {
+        k: _deserializer.deserialize(item[k])
+        for k in EXISTING_FEATURE_ATTRIBUTES if k in item
+    }
+
+
+def update_feature_store(feature_record: Dict[str, Any], existing_features: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Conditionally write calculated features to the Feature Store.
+    
+    The write only succeeds if the stored item still matches `existing_features`
+    (or is absent for a new customer). On a mismatch DynamoDB returns the
+    current item, so no separate read is needed before retrying.
     
     Args:
         feature_record: Feature record to store
+        existing_features: Features the record was calculated from (None for a new customer)
+        
+    Returns:
+        None if the write succeeded, otherwise the currently stored features
     """
-    table_name = get_parameter('/referral-system/customer-features-table-name')
-    features_table = dynamodb.Table(table_name)
+    item = to_dynamodb_item(feature_record)
     
-    try:
-        # Convert Decimal to proper format for DynamoDB
-        item = {
-            'customerEmail': feature_record['customerEmail'],
-            'satisfaction_avg': feature_record['satisfaction_avg'],
-            'service_count': feature_record['service_count'],
-            'lifetime_value': feature_record['lifetime_value'],
-            'property_features': feature_record['property_features'],
-            'last_updated': feature_record['last_updated'],
-            'first_seen': feature_record.get('first_seen', feature_record['last_updated'])
+    if existing_features is None:
+        condition = {'ConditionExpression': 'attribute_not_exists(customerEmail)'}
+    elif 'service_count' in existing_features:
+        condition = {
+            'ConditionExpression': 'service_count = :expected_count',
+            'ExpressionAttributeValues': {':expected_count': {'N': str(existing_features['service_count'])}}
         }
-        
-        features_table.put_item(Item=item)
-        logger.info(f"Updated Feature Store for {feature_record['customerEmail']}")
+    else:
+        condition = {'ConditionExpression': 'attribute_not_exists(service_count)'}
+    
+    try:
+        dynamodb_client.put_item(
+            TableName=get_features_table_name(),
+            Item=item,
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+            **condition
+        )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Updated Feature Store for %s", feature_record['customerEmail'])
+        return None
+    except dynamodb_client.exceptions.ConditionalCheckFailedException as e:
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Feature Store item changed for %s, recalculating", feature_record['customerEmail'])
+        return to_existing_features(e.response.get('Item', {}))
     except Exception as e:
         logger.error(f"Error updating Feature Store: {str(e)}")
         raise
 
 
+def get_cached_features(customer_email: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Return the features this container last wrote for a customer, if still fresh.
+    """
+    cached = _feature_cache.get(customer_email)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+
+def cache_features(feature_record: Dict[str, Any]) -> None:
+    """
+    Remember the stored state of a customer's features for later invocations.
+    """
+    if len(_feature_cache) >= FEATURE_CACHE_MAX_ENTRIES:
+        _feature_cache.clear()
+    features = {k: feature_record[k] for k in EXISTING_FEATURE_ATTRIBUTES if k in feature_record}
+    _feature_cache[feature_record['customerEmail']] = (features, time.monotonic() + FEATURE_CACHE_TTL)
+
+
+def save_customer_features(customer_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Calculate features and store them with a single conditional write.
+    
+    New customers, and customers this container wrote recently, cost one
+    DynamoDB request. Otherwise the optimistic write fails its condition and
+    hands back the stored item, which is used to recalculate and write again.
+    
+    Args:
+        customer_data: Webhook payload with customer and service data
+        
+    Returns:
+        The feature record that was stored
+    """
+    return save_customer_events([customer_data], get_cached_features(customer_data.get('customer', {}).get('email')))
+
+
+def save_customer_events(events: List[Dict[str, Any]], existing_features: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Fold a customer's events into their features and store them conditionally.
+    
+    Args:
+        events: Webhook payloads for one customer, oldest first
+        existing_features: Features believed to be stored (None for a new
+            customer); if they are out of date the write is retried from
+            the item DynamoDB returns
+        
+    Returns:
+        The feature record that was stored
+    """
+    for _ in range(MAX_WRITE_ATTEMPTS):
+        feature_record = enrich_customer_features(events[-1], fold_customer_events(events[:-1], existing_features))
+        current = update_feature_store(feature_record, existing_features)
+        if current is None:
+            cache_features(feature_record)
+            return feature_record
+        existing_features = current
+    
+    raise RuntimeError(f"Could not update Feature Store for {feature_record['customerEmail']} after {MAX_WRITE_ATTEMPTS} attempts")
+
+
+def batch_backoff_delay(attempt: int) -> float:
+    """
+    Seconds to wait before retrying unprocessed batch keys (full jitter).
+    """
+    return random.uniform(0, min(BATCH_BACKOFF_MAX, BATCH_BACKOFF_BASE * 2 ** attempt))
+
+
+def batch_get_features(customer_emails: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Read stored features for many customers, up to 100 keys per BatchGetItem.
+    
+    Args:
+        customer_emails: Customer emails to look up
+        
+    Returns:
+        Existing features keyed by customer email (customers without an item are omitted)
+    """
+    table_name = get_features_table_name()
+    found = {}
+    for start in range(0, len(customer_emails), BATCH_GET_MAX_KEYS):
+        request = {
+            table_name: {
+                'Keys': [{'customerEmail': {'S': email}} for email in customer_emails[start:start + BATCH_GET_MAX_KEYS]],
+                'ProjectionExpression': 'customerEmail, ' + ', '.join(EXISTING_FEATURE_ATTRIBUTES)
+            }
+        }
+        for attempt in range(BATCH_MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(batch_backoff_delay(attempt))
+            response = features_batch_client.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(table_name, []):
+                found[item['customerEmail']['S']] = to_existing_features(item)
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+        else:
+            raise RuntimeError(f"Feature Store keys still unprocessed after {BATCH_MAX_ATTEMPTS} attempts")
+    return found
+
+
+def fold_customer_events(events: List[Dict[str, Any]], existing_features: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Apply a customer's events to their stored features in one pass.
+    
+    The running satisfaction average and service count are kept in local
+    scalars (same rules as calculate_satisfaction_avg and
+    calculate_service_count), so no per-event dicts are allocated. The full
+    record (timestamps, lifetime value, property features, Decimal
+    conversion) is built once, from the final event.
+    
+    Args:
+        events: Webhook payloads for one customer, oldest first
+        existing_features: Features currently stored for the customer (if any)
+        
+    Returns:
+        Features after all events, in the same shape as existing_features
+    """
+    if not events:
+        return existing_features
+    
+    existing_features = existing_features or {}
+    avg = existing_features.get('satisfaction_avg')
+    count = existing_features.get('service_count')
+    avg = float(avg) if avg is not None else None
+    count = int(count) if count is not None else None
+    
+    for customer_data in events:
+        score = customer_data.get('service', {}).get('satisfaction_score')
+        if score is None:
+            new_avg = avg if avg is not None else 3.5
+        elif avg is not None and count is not None:
+            new_avg = round((avg * count + float(score)) / (count + 1), 2)
+        else:
+            new_avg = float(score)
+        count = count + 1 if count is not None else int(customer_data.get('services_count') or 1)
+        avg = new_avg
+    
+    features = {'satisfaction_avg': avg, 'service_count': count}
+    if 'first_seen' in existing_features:
+        features['first_seen'] = existing_features['first_seen']
+    return features
+
+
+def save_batch_features(records: List[Dict[str, Any]]) -> List[str]:
+    """
+    Calculate and store features for a batch of SQS records.
+    
+    Events for the same customer are folded in order into one feature record,
+    so the batch needs one write per customer rather than per event. Stored
+    features are read with one BatchGetItem (customers this container wrote
+    recently come from its cache), and each customer is written with the same
+    conditional write as a single event, so a concurrent update from another
+    container is folded in rather than overwritten. Customers succeed or fail
+    independently: only the messages of customers that weren't written are
+    reported as failures, so redelivery never counts an event twice.
+    
+    Args:
+        records: SQS records whose bodies are webhook payloads (optionally
+            wrapped in {"customer_data": ...})
+        
+    Returns:
+        Message IDs of records that could not be processed
+    """
+    failed_message_ids = []
+    events_by_email = {}
+    for record in records:
+        try:
+            body = json.loads(record['body'])
+            customer_data = body.get('customer_data') or body
+            customer_email = customer_data.get('customer', {}).get('email')
+            if not customer_email:
+                raise ValueError("Customer email is required")
+        except Exception as e:
+            logger.error(f"Skipping record {record.get('messageId')}: {str(e)}")
+            failed_message_ids.append(record['messageId'])
+            continue
+        events_by_email.setdefault(customer_email, []).append((record['messageId'], customer_data))
+    
+    if not events_by_email:
+        return failed_message_ids
+    
+    existing = {}
+    uncached = []
+    for customer_email in events_by_email:
+        cached = get_cached_features(customer_email)
+        if cached is None:
+            uncached.append(customer_email)
+        else:
+            existing[customer_email] = cached
+    if uncached:
+        try:
+            existing.update(batch_get_features(uncached))
+        except Exception as e:
+            logger.error(f"Error reading feature batch: {str(e)}")
+            return [record['messageId'] for record in records]
+    
+    for customer_email, events in events_by_email.items():
+        try:
+            save_customer_events([customer_data for _, customer_data in events], existing.get(customer_email))
+        except Exception as e:
+            # Later events build on earlier ones, so retry the customer's whole run
+            logger.error(f"Error saving features for {customer_email}: {str(e)}")
+            failed_message_ids.extend(message_id for message_id, _ in events)
+    return failed_message_ids
+
+
+def to_json(obj: Any) -> str:
+    """
+    Serialize a response body, using orjson when it is packaged with the function.
+    Decimals are emitted as floats.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=float).decode()
+    return json.dumps(obj, default=float)
+
+
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Lambda handler for feature enrichment.
@@ -264,21 +687,24 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         "customer_data": { ... webhook payload ... }
     }
     
-    Or can be called directly with webhook payload.
+    Or can be called directly with webhook payload. When triggered by SQS
+    ({"Records": [...]}), the whole batch is processed together and failed
+    records are reported back as batchItemFailures.
     """
+    if 'Records' in event:
+        failed_message_ids = save_batch_features(event['Records'])
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]}
+    
     try:
         # Extract customer data from event
         customer_data = event.get('customer_data') or event
         
-        # Calculate features
-        feature_record = enrich_customer_features(customer_data)
-        
-        # Update Feature Store
-        update_feature_store(feature_record)
+        # Calculate features and update Feature Store
+        feature_record = save_customer_features(customer_data)
         
         return {
             'statusCode': 200,
-            'body': json.dumps({
+            'body': to_json({
                 'success': True,
                 'features': {
                     'customerEmail': feature_record['customerEmail'],
@@ -293,7 +719,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         logger.error(f"Error in feature enrichment: {str(e)}")
         return {
             'statusCode': 500,
-            'body': json.dumps({
+            'body': to_json({
                 'success': False,
                 'error': str(e)
             })
@@ -3,36 +3,235 @@ AWS Lambda function for orchestrating LLM-powered referral email generation.
 Processes SQS messages, calls Bedrock LLMs, and stores results in DynamoDB.
 """
 
+import base64
 import json
 import os
 import boto3
 import logging
+import random
 import time
 import uuid
-from datetime import datetime
-from typing import Dict, Any, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Any, List, Optional, Tuple
 from decimal import Decimal
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib parser
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # only needed for compressed SQS bodies
+    zstandard = None
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initialize AWS clients
-ssm_client = boto3.client('ssm')
-s3_client = boto3.client('s3')
-bedrock_client = boto3.client('bedrock-runtime')
-dynamodb = boto3.resource('dynamodb')
-cloudwatch = boto3.client('cloudwatch')
+# Initialize AWS clients once per container with a shared config: keep-alive
+# lets warm invocations reuse TLS connections, and the pool is sized for
+# records being processed concurrently
+_boto_config = Config(
+    max_pool_connections=50,
+    retries={'mode': 'standard', 'max_attempts': 3},
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=30
+)
+# Generations can run longer than a plain API call
+_bedrock_config = _boto_config.merge(Config(read_timeout=60))
+
+ssm_client = boto3.client('ssm', config=_boto_config)
+s3_client = boto3.client('s3', config=_boto_config)
+bedrock_client = boto3.client('bedrock-runtime', config=_bedrock_config)
+dynamodb = boto3.resource('dynamodb', config=_boto_config)
+cloudwatch = boto3.client('cloudwatch', config=_boto_config)
+
+# Single-item message writes go through the low-level client, skipping the
+# resource layer's per-call type handling
+dynamodb_client = boto3.client('dynamodb', config=_boto_config)
+_serializer = TypeSerializer()
 
 # Cache for SSM parameters
 _parameter_cache = {}
 
+# Registry lookups per agent: agent_id -> (agent config, expiry as
+# time.monotonic()). The production version rarely changes, so warm
+# containers only re-query the registry once a minute.
+_agent_cache = {}
+AGENT_CACHE_TTL = int(os.environ.get('AGENT_CACHE_TTL', '60'))
+
+# Feature Store lookups per customer: email -> (features or None, expiry).
+# Kept short since the feature enricher keeps updating them.
+_features_cache = {}
+FEATURES_CACHE_TTL = int(os.environ.get('FEATURES_CACHE_TTL', '5'))
+FEATURES_CACHE_MAX_ENTRIES = 1024
+
+# Formatted brand guidelines per bucket: bucket -> (ETag, formatted text).
+# Revalidated with a conditional GET, so unchanged guidelines cost a 304.
+_guidelines_cache = {}
+
 # Get environment from Lambda environment variable
 ENVIRONMENT = os.environ.get('ENVIRONMENT', 'dev')
 
+# Parameters every message needs, fetched together during cold start
+REQUIRED_PARAMS = [
+    '/referral-system/s3-bucket-name',
+    '/referral-system/dynamodb-table-name',
+    '/referral-system/agent-registry-table-name',
+    '/referral-system/customer-features-table-name',
+    '/referral-system/bedrock-model-id'
+]
+
+# Partition key of the messages table's TimestampIndex; shared by every
+# message so the index lists all of them in timestamp order
+MESSAGE_STATUS_GROUP = 'ALL'
+
 # Maximum retry attempts for LLM generation
 MAX_RETRIES = 2
 
+# A/B switch: generate and judge each message in one Bedrock call instead of two
+COMBINED_PROMPT = os.environ.get('COMBINED_PROMPT', 'false').lower() == 'true'
+
+# Mark the system prompt (instructions + brand guidelines) as a prompt cache
+# checkpoint. Only enable for models that support Bedrock prompt caching.
+PROMPT_CACHING = os.environ.get('PROMPT_CACHING', 'false').lower() == 'true'
+
+# Bedrock batch inference for messages that don't need a real-time reply
+# (SQS messages with "priority": "batch"). Each message is staged as its own
+# JSONL object named after its messageId, so results can be matched back
+# from the output object key.
+BATCH_PENDING_PREFIX = 'bedrock-batch-input/pending/'
+BATCH_JOBS_PREFIX = 'bedrock-batch-input/jobs/'
+BATCH_OUTPUT_PREFIX = 'bedrock-batch-output/'
+BATCH_MIN_RECORDS = 100  # Bedrock rejects smaller batch jobs
+BATCH_MAX_RECORDS = 1000  # Input files per batch job
+BEDROCK_BATCH_ROLE_ARN = os.environ.get('BEDROCK_BATCH_ROLE_ARN')
+# Staged messages still waiting for a full job after this many seconds are
+# generated in real time instead, so low traffic never strands them
+BATCH_MAX_WAIT = int(os.environ.get('BATCH_MAX_WAIT', str(6 * 60 * 60)))
+# Stop starting new chunks of batch work once less than this much of the
+# invocation is left; unfinished work is picked up by the next scheduled run
+BATCH_TIME_RESERVE_MS = 120 * 1000
+
+# Encoding attribute value the webhook handler sets on compressed SQS bodies
+SQS_COMPRESSED_ENCODING = 'zstd+b64'
+
+# CloudWatch accepts at most this many datums per PutMetricData request
+METRICS_PER_REQUEST = 1000
+
+# BatchWriteItem accepts at most 25 items per request. Unprocessed items
+# (usually throttling) are retried with full-jitter exponential backoff.
+BATCH_WRITE_MAX_ITEMS = 25
+BATCH_MAX_ATTEMPTS = 8
+BATCH_BACKOFF_BASE = 0.05
+BATCH_BACKOFF_MAX = 2.0
+
+# Records in a batch are processed concurrently; each one spends most of its
+# time waiting on Bedrock, so threads overlap the I/O. Created once per
+# container and reused across warm invocations.
+MAX_CONCURRENT_RECORDS = 10
+_record_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_RECORDS)
+
+# Separate pool for the independent lookups each record makes up front
+# (agent, guidelines, features); three per concurrent record. Kept apart
+# from _record_executor so record workers never wait on their own pool.
+_prefetch_executor = ThreadPoolExecutor(max_workers=3 * MAX_CONCURRENT_RECORDS)
+
+
+def from_json(data: Any) -> Any:
+    """
+    Parse JSON from str or bytes, using orjson when it is packaged with the function.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode_sqs_body(record: Dict[str, Any]) -> Any:
+    """
+    Parse an SQS record body, decompressing bodies the webhook handler sent
+    zstd-compressed (marked by the 'encoding' message attribute).
+    """
+    encoding = record.get('messageAttributes', {}).get('encoding', {}).get('stringValue')
+    if encoding == SQS_COMPRESSED_ENCODING:
+        if zstandard is None:
+            raise RuntimeError("Received a zstd-compressed message but zstandard is not installed")
+        return from_json(zstandard.ZstdDecompressor().decompress(base64.b64decode(record['body'])))
+    return from_json(record['body'])
+
+
+def to_json_bytes(obj: Any) -> bytes:
+    """
+    Serialize JSON to UTF-8 bytes, using orjson when it is packaged with the function.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def publish_metrics(metric_data: List[Dict[str, Any]]) -> None:
+    """
+    Publish metric datums to CloudWatch, up to 1000 per request.
+    
+    Args:
+        metric_data: MetricDatum dictionaries for the ReferralSystem namespace
+    """
+    for start in range(0, len(metric_data), METRICS_PER_REQUEST):
+        cloudwatch.put_metric_data(
+            Namespace='ReferralSystem',
+            MetricData=metric_data[start:start + METRICS_PER_REQUEST]
+        )
+
+
+def record_metrics(metric_data: List[Dict[str, Any]], metrics: Optional[List[Dict[str, Any]]] = None) -> None:
+    """
+    Buffer metric datums for the end of the invocation, or publish them now if no buffer is given.
+    
+    Args:
+        metric_data: MetricDatum dictionaries to record
+        metrics: Per-invocation buffer flushed by lambda_handler
+    """
+    if metrics is None:
+        publish_metrics(metric_data)
+    else:
+        metrics.extend(metric_data)
+
+
+def get_env_specific_name(parameter_name: str) -> str:
+    """
+    Map a base parameter name to its environment-specific path.
+    """
+    if parameter_name.startswith('/referral-system/'):
+        return parameter_name.replace('/referral-system/', f'/referral-system/{ENVIRONMENT}/')
+    return parameter_name
+
+
+def prefetch_parameters(parameter_names: List[str]) -> None:
+    """
+    Load parameters into the cache with GetParameters (10 names per call).
+    Both the environment-specific and legacy paths are requested; names that
+    don't exist are simply left for get_parameter to resolve on demand.
+    
+    Args:
+        parameter_names: Base parameter names to prefetch
+    """
+    names = []
+    for parameter_name in parameter_names:
+        names.extend([get_env_specific_name(parameter_name), parameter_name])
+    names = list(dict.fromkeys(names))
+    
+    for start in range(0, len(names), 10):
+        response = ssm_client.get_parameters(Names=names[start:start + 10], WithDecryption=True)
+        for parameter in response['Parameters']:
+            _parameter_cache[parameter['Name']] = parameter['Value']
+    logger.info(f"Prefetched {len(_parameter_cache)} parameters")
+
 
 def get_parameter(parameter_name: str) -> str:
     """
@@ -45,12 +244,7 @@ def get_parameter(parameter_name: str) -> str:
     Returns:
         Parameter value as string
     """
-    # Construct environment-specific parameter name
-    if parameter_name.startswith('/referral-system/'):
-        # Try environment-specific first: /referral-system/{env}/param-name
-        env_specific_name = parameter_name.replace('/referral-system/', f'/referral-system/{ENVIRONMENT}/')
-    else:
-        env_specific_name = parameter_name
+    env_specific_name = get_env_specific_name(parameter_name)
     
     # Try environment-specific parameter first, then fallback to old path
     for param_name in [env_specific_name, parameter_name]:
@@ -76,10 +270,20 @@ def get_parameter(parameter_name: str) -> str:
     raise ValueError(f"Parameter not found: {parameter_name} or {env_specific_name}")
 
 
+# Pay the SSM round trip during cold start instead of on the first record;
+# PREFETCH_PARAMETERS=false skips it where SSM isn't reachable (e.g. unit tests)
+if os.environ.get('PREFETCH_PARAMETERS', 'true').lower() == 'true':
+    try:
+        prefetch_parameters(REQUIRED_PARAMS)
+    except Exception as e:
+        logger.warning(f"Could not prefetch parameters: {str(e)}")
+
+
 def get_active_agent(agent_id: str = 'upsell-generator') -> Dict[str, Any]:
     """
     Get the active (production) agent from Agent Registry.
     Falls back to SSM parameter if Agent Registry is empty.
+    Registry results are cached for AGENT_CACHE_TTL seconds.
     
     Args:
         agent_id: Agent identifier (default: 'upsell-generator')
@@ -87,6 +291,10 @@ def get_active_agent(agent_id: str = 'upsell-generator') -> Dict[str, Any]:
     Returns:
         Dictionary with agent configuration (model_id, promptTemplate, etc.)
     """
+    cached = _agent_cache.get(agent_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    
     try:
         # Get table name from SSM
         registry_table_name = get_parameter('/referral-system/agent-registry-table-name')
@@ -109,7 +317,7 @@ def get_active_agent(agent_id: str = 'upsell-generator') -> Dict[str, Any]:
         if response['Items']:
             agent = response['Items'][0]
             logger.info(f"Using agent from registry: {agent_id} v{agent['version']}")
-            return {
+            active_agent = {
                 'model_id': agent['bedrockModel'],
                 'version': agent['version'],
                 'promptTemplate': agent.get('promptTemplate'),
@@ -119,12 +327,14 @@ def get_active_agent(agent_id: str = 'upsell-generator') -> Dict[str, Any]:
             logger.warning(f"No production agent found in registry for {agent_id}, falling back to SSM")
             # Fallback to SSM parameter (backward compatibility)
             model_id = get_parameter('/referral-system/bedrock-model-id')
-            return {
+            active_agent = {
                 'model_id': model_id,
                 'version': 'legacy',
                 'promptTemplate': None,
                 'config': {}
             }
+        _agent_cache[agent_id] = (active_agent, time.monotonic() + AGENT_CACHE_TTL)
+        return active_agent
     except Exception as e:
         logger.warning(f"Error querying Agent Registry: {str(e)}, falling back to SSM")
         # Fallback to SSM parameter (backward compatibility)
@@ -145,6 +355,7 @@ def get_customer_features(customer_email: str) -> Optional[Dict[str, Any]]:
     """
     Get customer features from Feature Store.
     Returns None if Feature Store is not available or customer not found.
+    Lookups (including misses) are cached for FEATURES_CACHE_TTL seconds.
     
     Args:
         customer_email: Customer email address
@@ -155,6 +366,10 @@ def get_customer_features(customer_email: str) -> Optional[Dict[str, Any]]:
     if not customer_email:
         return None
     
+    cached = _features_cache.get(customer_email)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    
     try:
         # Get table name from SSM
         features_table_name = get_parameter('/referral-system/customer-features-table-name')
@@ -166,7 +381,7 @@ def get_customer_features(customer_email: str) -> Optional[Dict[str, Any]]:
         if 'Item' in response:
             item = response['Item']
             logger.info(f"Retrieved features from Feature Store for {customer_email}")
-            return {
+            features = {
                 'satisfaction_avg': float(item.get('satisfaction_avg', 0)),
                 'service_count': int(item.get('service_count', 0)),
                 'lifetime_value': item.get('lifetime_value', 'unknown'),
@@ -174,7 +389,12 @@ def get_customer_features(customer_email: str) -> Optional[Dict[str, Any]]:
             }
         else:
             logger.info(f"No features found in Feature Store for {customer_email}")
-            return None
+            features = None
+        
+        if len(_features_cache) >= FEATURES_CACHE_MAX_ENTRIES:
+            _features_cache.clear()
+        _features_cache[customer_email] = (features, time.monotonic() + FEATURES_CACHE_TTL)
+        return features
     except Exception as e:
         # Feature Store not available - backward compatible
         logger.warning(f"Could not retrieve features from Feature Store: {str(e)}")
@@ -184,6 +404,7 @@ def get_customer_features(customer_email: str) -> Optional[Dict[str, Any]]:
 def get_brand_guidelines(bucket_name: str) -> str:
     """
     Fetch brand guidelines from S3 bucket.
+    The formatted text is cached per container and revalidated by ETag.
     
     Args:
         bucket_name: Name of the S3 bucket
@@ -191,14 +412,23 @@ def get_brand_guidelines(bucket_name: str) -> str:
     Returns:
         Brand guidelines as formatted string
     """
+    cached = _guidelines_cache.get(bucket_name)
     try:
-        response = s3_client.get_object(
-            Bucket=bucket_name,
-            Key='guidelines.json'
-        )
-        guidelines_data = json.loads(response['Body'].read().decode('utf-8'))
+        request = {'Bucket': bucket_name, 'Key': 'guidelines.json'}
+        if cached:
+            request['IfNoneMatch'] = cached[0]
+        try:
+            response = s3_client.get_object(**request)
+        except ClientError as e:
+            if cached and e.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+                return cached[1]
+            raise
         
-        # Format guidelines for LLM prompt
+        guidelines_data = from_json(response['Body'].read())
+        
+        # Format guidelines for LLM prompt (once per ETag, see _guidelines_cache)
+        avoid_text = '\n'.join(f'- {item}' for item in guidelines_data.get('avoid', []))
+        preferred_text = '\n'.join(f'- {item}' for item in guidelines_data.get('preferred_language', []))
         formatted_guidelines = f"""
 Brand Voice: {guidelines_data.get('brand_voice', '')}
 Tone: {guidelines_data.get('tone', '')}
@@ -206,11 +436,13 @@ Key Messages: {', '.join(guidelines_data.get('key_messages', []))}
 Formatting Guidelines: {', '.join(guidelines_data.get('formatting', []))}
 
 Do Not Include:
-{chr(10).join(['- ' + item for item in guidelines_data.get('avoid', [])])}
+{avoid_text}
 
 Preferred Language:
-{chr(10).join(['- ' + item for item in guidelines_data.get('preferred_language', [])])}
+{preferred_text}
 """
+        if response.get('ETag'):
+            _guidelines_cache[bucket_name] = (response['ETag'], formatted_guidelines)
         logger.info("Brand guidelines retrieved successfully")
         return formatted_guidelines
     except Exception as e:
@@ -228,8 +460,8 @@ def format_customer_data(customer_data: Dict[str, Any]) -> str:
     Returns:
         JSON string of customer data
     """
-    # Return the raw customer data as formatted JSON for the LLM
-    return json.dumps(customer_data, indent=2)
+    # Compact JSON: indentation only adds whitespace tokens to both prompts
+    return json.dumps(customer_data, separators=(',', ':'), ensure_ascii=False)
 
 
 def format_customer_features(features: Optional[Dict[str, Any]]) -> str:
@@ -263,38 +495,24 @@ def format_customer_features(features: Optional[Dict[str, Any]]) -> str:
     return feature_text
 
 
-def call_bedrock_generator(model_id: str, customer_data_str: str, brand_guidelines: str, retry_count: int = 0, previous_feedback: str = None, customer_features: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    """
-    Call Bedrock LLM to generate service upsell message.
-    
-    Args:
-        model_id: Bedrock model identifier
-        customer_data_str: Formatted customer data
-        brand_guidelines: Brand guidelines text (includes service catalog)
-        retry_count: Current retry attempt
-        previous_feedback: Feedback from previous rejection (if any)
-        customer_features: Customer features from Feature Store (optional)
-        
-    Returns:
-        Dictionary with generated message content and metadata
-    """
-    feedback_note = ""
-    if retry_count > 0 and previous_feedback:
-        feedback_note = f"\n\nIMPORTANT - Previous attempt was rejected:\n{previous_feedback}\nPlease address these issues and select a different service if needed."
+# Closing instruction for the generator when it only writes the message
+GENERATOR_OUTPUT_INSTRUCTIONS = 'Output ONLY the message body text. No subject line, no "Dear [Name]" greeting - start directly with the content.'
 
-    # Format features for prompt
-    features_text = format_customer_features(customer_features)
+# Closing instruction when the same call also judges its message
+COMBINED_OUTPUT_INSTRUCTIONS = """Then review your message as a strict message quality judge would before it is sent.
 
-    # Format features for prompt
-    features_text = format_customer_features(customer_features)
+CURRENT DATE: {current_date}
+
+{criteria}
 
-    prompt = f"""You are creating a personalized service upsell message for a pest control customer.
+Your final output must be a single JSON object wrapping both the message and that judgment:
+{{
+  "message": "the message body text (no subject line, no greeting)",
+  "judgment": {{ ...the judgment JSON described above... }}
+}}"""
 
-Customer Data (JSON):
-{customer_data_str}
 
-Company Information & Service Catalog (JSON):
-{brand_guidelines}{features_text}
+GENERATOR_SYSTEM_INSTRUCTIONS = """You are creating a personalized service upsell message for a pest control customer.
 
 Your task:
 1. Analyze the customer data provided (it may have various fields - use what's available)
@@ -321,98 +539,86 @@ Important:
 - Check current_plan to avoid recommending what they already have
 - If service_history exists, analyze patterns but only reference positive ones
 - If property_info exists, use it to inform recommendations
-- Use customer's first name if available
-{feedback_note}
+- Use customer's first name if available"""
 
-Output ONLY the message body text. No subject line, no "Dear [Name]" greeting - start directly with the content."""
+JUDGE_SYSTEM_INSTRUCTIONS = "You are a message quality judge evaluating whether a service upsell message should be sent."
 
-    try:
-        start_time = time.time()
-        
-        # Use Converse API for Amazon Nova models
-        response = bedrock_client.converse(
-            modelId=model_id,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [{"text": prompt}]
-        }
-            ],
-            inferenceConfig={
-                "maxTokens": 1000,
-                "temperature": 0.7 if retry_count == 0 else 0.8
-            }
-        )
-        
-        generation_time = time.time() - start_time
-        
-        # Extract generated text from Converse API response
-        generated_text = response['output']['message']['content'][0]['text']
-        
-        logger.info(f"Email generated successfully in {generation_time:.2f}s")
-        
-        # Publish generation time metric
-        cloudwatch.put_metric_data(
-            Namespace='ReferralSystem',
-            MetricData=[
-                {
-                    'MetricName': 'GenerationTime',
-                    'Value': generation_time,
-                    'Unit': 'Seconds',
-                    'Timestamp': datetime.utcnow()
-                }
-            ]
-        )
-        
-        return {
-            'email_content': generated_text.strip(),
-            'generation_time': generation_time,
-            'model_id': model_id,
-            'retry_count': retry_count
-        }
+# Static fragments between the variable parts of the prompts. Prompts are
+# assembled with str.join so only the variable slots are copied per call.
+_CATALOG_HEADER = "\n\nCompany Information & Service Catalog (JSON):\n"
+_GENERATOR_SYSTEM_PREFIX = GENERATOR_SYSTEM_INSTRUCTIONS + _CATALOG_HEADER
+_JUDGE_SYSTEM_PREFIX = JUDGE_SYSTEM_INSTRUCTIONS + _CATALOG_HEADER
+_GENERATOR_USER_PREFIX = "Customer Data (JSON):\n"
+_JUDGE_USER_PREFIX = "CURRENT DATE: "
+_JUDGE_USER_CUSTOMER_HEADER = "\n\nCustomer Data (JSON - may have variable fields):\n"
+_JUDGE_USER_MESSAGE_HEADER = "\n\nGenerated Message:\n"
+
+
+def build_generator_prompt(customer_data_str: str, brand_guidelines: str, features_text: str, feedback_note: str, output_instructions: str = GENERATOR_OUTPUT_INSTRUCTIONS) -> Tuple[str, str]:
+    """
+    Build the prompt asking the LLM to write the upsell message.
+    
+    The static instructions and brand guidelines go in the system prompt so
+    they are identical across customers (and cacheable); the user message
+    only carries customer-specific data.
+    
+    Args:
+        customer_data_str: Formatted customer data
+        brand_guidelines: Brand guidelines text (includes service catalog)
+        features_text: Formatted Feature Store insights (may be empty)
+        feedback_note: Feedback from the previous rejection (may be empty)
+        output_instructions: What the LLM should output
         
-    except Exception as e:
-        logger.error(f"Error calling Bedrock generator: {str(e)}")
-        raise
+    Returns:
+        (system prompt, user message) text
+    """
+    system_prompt = ''.join([_GENERATOR_SYSTEM_PREFIX, brand_guidelines, '\n\n', output_instructions])
+    user_message = ''.join([_GENERATOR_USER_PREFIX, customer_data_str, features_text, feedback_note])
+    return system_prompt, user_message
 
 
-def call_bedrock_judge(model_id: str, generated_email: str, brand_guidelines: str, customer_data_str: str) -> Dict[str, Any]:
+def build_judge_prompt(generated_email: str, brand_guidelines: str, customer_data_str: str, current_date: str) -> Tuple[str, str]:
     """
-    Call Bedrock LLM to judge/validate generated upsell message.
+    Build the prompt asking the LLM to judge an upsell message.
     
     Args:
-        model_id: Bedrock model identifier
         generated_email: Message content to judge
         brand_guidelines: Brand guidelines text (includes service catalog)
         customer_data_str: Customer context for appropriateness check
+        current_date: Today's date (YYYY-MM-DD)
         
     Returns:
-        Dictionary with judgment results
+        (system prompt, user message) text
     """
-    # Get current date for comparison
-    from datetime import datetime as dt
-    current_date = dt.utcnow().strftime('%Y-%m-%d')
-    
-    prompt = f"""You are a message quality judge evaluating whether this service upsell message should be sent.
+    system_prompt = ''.join([_JUDGE_SYSTEM_PREFIX, brand_guidelines, '\n\n', build_judge_criteria(current_date)])
+    user_message = ''.join([
+        _JUDGE_USER_PREFIX, current_date,
+        _JUDGE_USER_CUSTOMER_HEADER, customer_data_str,
+        _JUDGE_USER_MESSAGE_HEADER, generated_email
+    ])
+    return system_prompt, user_message
 
-CURRENT DATE: {current_date}
-
-Customer Data (JSON - may have variable fields):
-{customer_data_str}
 
-Generated Message:
-{generated_email}
+def build_system_blocks(system_prompt: str) -> List[Dict[str, Any]]:
+    """
+    Build the Converse API system content blocks, adding a prompt cache
+    checkpoint after the system prompt when PROMPT_CACHING is enabled.
+    """
+    blocks = [{'text': system_prompt}]
+    if PROMPT_CACHING:
+        blocks.append({'cachePoint': {'type': 'default'}})
+    return blocks
 
-Company Information & Service Catalog (JSON):
-{brand_guidelines}
 
-Evaluate on THREE dimensions:
+# Judge criteria split around the one variable slot (the current date)
+_JUDGE_CRITERIA_PREFIX = """Evaluate on THREE dimensions:
 
 1. CUSTOMER APPROPRIATENESS: Should we send ANY upsell to this customer right now?
    
    STEP 1 - Check recent upsell timing:
    - Look for "last_upsell_sent" field in the customer data
-   - If field is PRESENT: Calculate days between last_upsell_sent and CURRENT DATE ({current_date})
+   - If field is PRESENT: Calculate days between last_upsell_sent and CURRENT DATE ("""
+_JUDGE_CRITERIA_SUFFIX = """)
      * Example: last_upsell_sent: "2025-11-18", current: "2025-12-12" = 24 days → REJECT (< 30 days)
      * Example: last_upsell_sent: "2025-10-01", current: "2025-12-12" = 72 days → OK (> 30 days)
      * If within 30 days, IMMEDIATELY REJECT with reason "appropriateness"
@@ -464,13 +670,119 @@ Evaluate on THREE dimensions:
    - Appropriate length (150-200 words)
 
 Respond with JSON only:
-{{
+{
   "approved": true/false,
   "score": 1-10,
   "issues": ["list any problems"],
   "feedback": "brief explanation of decision with specific references to customer data",
-  "reason": "appropriateness" or "service_validity" or "brand" (primary rejection reason if false)
-}}"""
+  "reason": "appropriateness" or "service_validity" or "brand" (primary rejection reason if false),
+  "service": "name of the service the message recommends"
+}"""
+
+
+def build_judge_criteria(current_date: str) -> str:
+    """
+    Build the evaluation criteria and JSON response format for judging a message.
+    
+    Args:
+        current_date: Today's date (YYYY-MM-DD), for upsell timing checks
+        
+    Returns:
+        Criteria text
+    """
+    return ''.join([_JUDGE_CRITERIA_PREFIX, current_date, _JUDGE_CRITERIA_SUFFIX])
+
+
+def build_feedback_note(retry_count: int, previous_feedback: Optional[str]) -> str:
+    """
+    Build the prompt note asking the LLM to address a previous rejection.
+    """
+    if retry_count > 0 and previous_feedback:
+        return f"\n\nIMPORTANT - Previous attempt was rejected:\n{previous_feedback}\nPlease address these issues and select a different service if needed."
+    return ""
+
+
+def parse_json_response(response_text: str) -> Dict[str, Any]:
+    """
+    Parse a JSON object from an LLM response, handling markdown code blocks.
+    Text that looks like raw JSON is parsed directly; anything else (or raw
+    JSON that fails to parse) goes through fence extraction, so fenced
+    responses are only parsed once.
+    """
+    if response_text[:1] in ('{', '['):
+        try:
+            return from_json(response_text)
+        except json.JSONDecodeError:
+            pass
+    if '```json' in response_text:
+        response_text = response_text.split('```json', 1)[1].split('```', 1)[0].strip()
+    elif '```' in response_text:
+        response_text = response_text.split('```', 1)[1].split('```', 1)[0].strip()
+    return from_json(response_text)
+
+
+def to_judgment_result(judgment: Dict[str, Any], judgment_time: float) -> Dict[str, Any]:
+    """
+    Normalize a parsed judgment into the result dictionary used by process_message.
+    'reason' is only included when the judge gave one, so stored messages keep
+    rejectionReason 'N/A' unless a reason was actually reported.
+    """
+    result = {
+        'approved': judgment.get('approved', False),
+        'score': judgment.get('score', 0),
+        'issues': judgment.get('issues', []),
+        'feedback': judgment.get('feedback', ''),
+        'service': judgment.get('service', ''),
+        'judgment_time': judgment_time
+    }
+    if judgment.get('reason'):
+        result['reason'] = judgment['reason']
+    return result
+
+
+def judgment_metrics(judgment: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Build the approval metrics for a judgment.
+    """
+    now = datetime.utcnow()
+    return [
+        {
+            'MetricName': 'ApprovalRate',
+            'Value': 1 if judgment.get('approved') else 0,
+            'Unit': 'None',
+            'Timestamp': now
+        },
+        {
+            'MetricName': 'JudgeScore',
+            'Value': judgment.get('score', 0),
+            'Unit': 'None',
+            'Timestamp': now
+        }
+    ]
+
+
+def call_bedrock_generator(model_id: str, customer_data_str: str, brand_guidelines: str, retry_count: int = 0, previous_feedback: str = None, customer_features: Optional[Dict[str, Any]] = None, metrics: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    Call Bedrock LLM to generate service upsell message.
+    
+    Args:
+        model_id: Bedrock model identifier
+        customer_data_str: Formatted customer data
+        brand_guidelines: Brand guidelines text (includes service catalog)
+        retry_count: Current retry attempt
+        previous_feedback: Feedback from previous rejection (if any)
+        customer_features: Customer features from Feature Store (optional)
+        metrics: Per-invocation metric buffer (metrics are published immediately if None)
+        
+    Returns:
+        Dictionary with generated message content and metadata
+    """
+    feedback_note = build_feedback_note(retry_count, previous_feedback)
+
+    # Format features for prompt
+    features_text = format_customer_features(customer_features) if customer_features else ""
+
+    system_prompt, user_message = build_generator_prompt(customer_data_str, brand_guidelines, features_text, feedback_note)
 
     try:
         start_time = time.time()
@@ -478,136 +790,326 @@ Respond with JSON only:
         # Use Converse API for Amazon Nova models
         response = bedrock_client.converse(
             modelId=model_id,
+            system=build_system_blocks(system_prompt),
             messages=[
                 {
                     "role": "user",
-                    "content": [{"text": prompt}]
+                    "content": [{"text": user_message}]
         }
             ],
             inferenceConfig={
-                "maxTokens": 500,
-                "temperature": 0.3
+                "maxTokens": 1000,
+                "temperature": 0.7 if retry_count == 0 else 0.8
             }
         )
         
-        judgment_time = time.time() - start_time
-        
-        # Extract and parse judgment from Converse API response
-        judgment_text = response['output']['message']['content'][0]['text'].strip()
-        
-        # Extract JSON from response (handle markdown code blocks)
-        if '```json' in judgment_text:
-            judgment_text = judgment_text.split('```json')[1].split('```')[0].strip()
-        elif '```' in judgment_text:
-            judgment_text = judgment_text.split('```')[1].split('```')[0].strip()
+        generation_time = time.time() - start_time
         
-        judgment = json.loads(judgment_text)
+        # Extract generated text from Converse API response
+        generated_text = response['output']['message']['content'][0]['text']
         
-        logger.info(f"Email judged: approved={judgment.get('approved')}, score={judgment.get('score')}")
+        logger.info(f"Email generated successfully in {generation_time:.2f}s")
         
-        # Publish approval metric
-        cloudwatch.put_metric_data(
-            Namespace='ReferralSystem',
-            MetricData=[
-                {
-                    'MetricName': 'ApprovalRate',
-                    'Value': 1 if judgment.get('approved') else 0,
-                    'Unit': 'None',
-                    'Timestamp': datetime.utcnow()
-                },
-                {
-                    'MetricName': 'JudgeScore',
-                    'Value': judgment.get('score', 0),
-                    'Unit': 'None',
-                    'Timestamp': datetime.utcnow()
-                }
-            ]
-        )
+        # Record generation time metric
+        record_metrics([
+            {
+                'MetricName': 'GenerationTime',
+                'Value': generation_time,
+                'Unit': 'Seconds',
+                'Timestamp': datetime.utcnow()
+            }
+        ], metrics)
         
         return {
-            'approved': judgment.get('approved', False),
-            'score': judgment.get('score', 0),
-            'issues': judgment.get('issues', []),
-            'feedback': judgment.get('feedback', ''),
-            'judgment_time': judgment_time
+            'email_content': generated_text.strip(),
+            'generation_time': generation_time,
+            'model_id': model_id,
+            'retry_count': retry_count
         }
         
     except Exception as e:
-        logger.error(f"Error calling Bedrock judge: {str(e)}")
-        # Default to rejected if judge fails
-        return {
-            'approved': False,
-            'score': 0,
-            'issues': ['Judge evaluation failed'],
-            'feedback': f'Error: {str(e)}',
-            'judgment_time': 0
-        }
+        logger.error(f"Error calling Bedrock generator: {str(e)}")
+        raise
 
 
-def generate_email_subject(customer_name: str) -> str:
+def call_bedrock_judge(model_id: str, generated_email: str, brand_guidelines: str, customer_data_str: str, metrics: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
     """
-    Generate message subject line.
+    Call Bedrock LLM to judge/validate generated upsell message.
     
     Args:
-        customer_name: Customer's first name
+        model_id: Bedrock model identifier
+        generated_email: Message content to judge
+        brand_guidelines: Brand guidelines text (includes service catalog)
+        customer_data_str: Customer context for appropriateness check
+        metrics: Per-invocation metric buffer (metrics are published immediately if None)
         
     Returns:
-        Message subject line
+        Dictionary with judgment results
     """
-    import random
-    subjects = [
-        f"{customer_name}, Enhance Your Home Protection",
-        f"Additional Protection Options for Your Home, {customer_name}",
-        f"{customer_name}, Here's How We Can Better Protect Your Home",
-        f"Recommended Service Upgrade for {customer_name}",
-        f"{customer_name}, Take Your Pest Protection to the Next Level"
-    ]
-    return random.choice(subjects)
-
+    # Get current date for comparison
+    current_date = datetime.utcnow().strftime('%Y-%m-%d')
+    
+    system_prompt, user_message = build_judge_prompt(generated_email, brand_guidelines, customer_data_str, current_date)
 
-def store_in_dynamodb(table_name: str, message_data: Dict[str, Any]) -> None:
+    try:
+        start_time = time.time()
+        
+        # Use Converse API for Amazon Nova models
+        response = bedrock_client.converse(
+            modelId=model_id,
+            system=build_system_blocks(system_prompt),
+            messages=[
+                {
+                    "role": "user",
+                    "content": [{"text": user_message}]
+        }
+            ],
+            inferenceConfig={
+                "maxTokens": 500,
+                "temperature": 0.3
+            }
+        )
+        
+        judgment_time = time.time() - start_time
+        
+        # Extract and parse judgment from Converse API response
+        judgment_text = response['output']['message']['content'][0]['text'].strip()
+        
+        # Extract JSON from response (handle markdown code blocks)
+        judgment = parse_json_response(judgment_text)
+        
+        logger.info(f"Email judged: approved={judgment.get('approved')}, score={judgment.get('score')}")
+        
+        # Record approval metrics
+        record_metrics(judgment_metrics(judgment), metrics)
+        
+        return to_judgment_result(judgment, judgment_time)
+        
+    except Exception as e:
+        logger.error(f"Error calling Bedrock judge: {str(e)}")
+        # Default to rejected if judge fails
+        return {
+            'approved': False,
+            'score': 0,
+            'issues': ['Judge evaluation failed'],
+            'feedback': f'Error: {str(e)}',
+            'judgment_time': 0
+        }
+
+
+def call_bedrock_generate_and_judge(model_id: str, customer_data_str: str, brand_guidelines: str, retry_count: int = 0, previous_feedback: str = None, customer_features: Optional[Dict[str, Any]] = None, metrics: Optional[List[Dict[str, Any]]] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
     """
-    Store generated message and metadata in DynamoDB.
+    Generate a service upsell message and judge it with a single Bedrock call.
+    Used instead of call_bedrock_generator + call_bedrock_judge when COMBINED_PROMPT is enabled.
     
     Args:
-        table_name: DynamoDB table name
-        message_data: Complete message data to store
+        model_id: Bedrock model identifier
+        customer_data_str: Formatted customer data
+        brand_guidelines: Brand guidelines text (includes service catalog)
+        retry_count: Current retry attempt
+        previous_feedback: Feedback from previous rejection (if any)
+        customer_features: Customer features from Feature Store (optional)
+        metrics: Per-invocation metric buffer (metrics are published immediately if None)
+        
+    Returns:
+        (generation result, judgment result) in the same shapes as
+        call_bedrock_generator and call_bedrock_judge
     """
+    current_date = datetime.utcnow().strftime('%Y-%m-%d')
+    system_prompt, user_message = build_generator_prompt(
+        customer_data_str,
+        brand_guidelines,
+        format_customer_features(customer_features),
+        build_feedback_note(retry_count, previous_feedback),
+        output_instructions=COMBINED_OUTPUT_INSTRUCTIONS.format(
+            current_date=current_date,
+            criteria=build_judge_criteria(current_date)
+        )
+    )
+    
     try:
-        table = dynamodb.Table(table_name)
+        start_time = time.time()
+        
+        response = bedrock_client.converse(
+            modelId=model_id,
+            system=build_system_blocks(system_prompt),
+            messages=[
+                {
+                    "role": "user",
+                    "content": [{"text": user_message}]
+                }
+            ],
+            inferenceConfig={
+                "maxTokens": 1500,
+                "temperature": 0.7 if retry_count == 0 else 0.8
+            }
+        )
         
-        # Convert float values to Decimal for DynamoDB
-        def convert_floats(obj):
-            if isinstance(obj, float):
-                return Decimal(str(obj))
-            elif isinstance(obj, dict):
-                return {k: convert_floats(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [convert_floats(item) for item in obj]
-            return obj
+        generation_time = time.time() - start_time
         
-        message_data = convert_floats(message_data)
+        result = parse_json_response(response['output']['message']['content'][0]['text'].strip())
+        judgment = result.get('judgment') or {}
         
-        table.put_item(Item=message_data)
-        logger.info(f"Message stored in DynamoDB: {message_data['messageId']}")
+        logger.info(f"Email generated and judged in {generation_time:.2f}s: approved={judgment.get('approved')}, score={judgment.get('score')}")
+        
+        record_metrics([
+            {
+                'MetricName': 'GenerationTime',
+                'Value': generation_time,
+                'Unit': 'Seconds',
+                'Timestamp': datetime.utcnow()
+            }
+        ] + judgment_metrics(judgment), metrics)
+        
+        generation_result = {
+            'email_content': result['message'].strip(),
+            'generation_time': generation_time,
+            'model_id': model_id,
+            'retry_count': retry_count
+        }
+        return generation_result, to_judgment_result(judgment, 0)
+        
+    except Exception as e:
+        logger.error(f"Error calling Bedrock generate-and-judge: {str(e)}")
+        raise
+
+
+# Subject line templates; one is picked at random per message
+_SUBJECT_TEMPLATES = (
+    "{name}, Enhance Your Home Protection",
+    "Additional Protection Options for Your Home, {name}",
+    "{name}, Here's How We Can Better Protect Your Home",
+    "Recommended Service Upgrade for {name}",
+    "{name}, Take Your Pest Protection to the Next Level"
+)
+
+
+def generate_email_subject(customer_name: str) -> str:
+    """
+    Generate message subject line.
+    
+    Args:
+        customer_name: Customer's first name
+        
+    Returns:
+        Message subject line
+    """
+    return random.choice(_SUBJECT_TEMPLATES).format(name=customer_name)
+
+
+def _to_decimal(obj: Any) -> Any:
+    """
+    Convert float values to Decimal for DynamoDB, recursing into dicts and lists.
+    Message data comes from from_json, so exact type checks are enough.
+    """
+    obj_type = type(obj)
+    if obj_type is float:
+        return Decimal(str(obj))
+    if obj_type is dict:
+        return {k: _to_decimal(v) for k, v in obj.items()}
+    if obj_type is list:
+        return [_to_decimal(v) for v in obj]
+    return obj
+
+
+def build_item(message_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Prepare message data for DynamoDB.
+    
+    Args:
+        message_data: Complete message data to store
+        
+    Returns:
+        Item with float values converted to Decimal
+    """
+    return _to_decimal(message_data)
+
+
+def store_in_dynamodb(table_name: str, message_data: Dict[str, Any]) -> None:
+    """
+    Store generated message and metadata in DynamoDB.
+    
+    Args:
+        table_name: DynamoDB table name
+        message_data: Complete message data to store
+    """
+    try:
+        item = build_item(message_data)
+        dynamodb_client.put_item(
+            TableName=table_name,
+            Item={key: _serializer.serialize(value) for key, value in item.items()},
+            ReturnValues='NONE'  # Never read back the replaced item
+        )
+        logger.info(f"Message stored in DynamoDB: {item['messageId']}")
         
     except Exception as e:
         logger.error(f"Error storing message in DynamoDB: {str(e)}")
         raise
 
 
-def process_message(message_body: Dict[str, Any]) -> Dict[str, Any]:
+def batch_backoff_delay(attempt: int) -> float:
+    """
+    Seconds to wait before retrying unprocessed batch items (full jitter).
+    """
+    return random.uniform(0, min(BATCH_BACKOFF_MAX, BATCH_BACKOFF_BASE * 2 ** attempt))
+
+
+def flush_items(table_name: str, items: List[Dict[str, Any]]) -> None:
+    """
+    Store prepared items with BatchWriteItem (25 items per request).
+    
+    Items sharing a key are collapsed to the last one, since a request can't
+    contain duplicate keys. Unprocessed items are retried with backoff; the
+    flush fails rather than silently dropping writes.
+    
+    Args:
+        table_name: DynamoDB table name
+        items: Items prepared by build_item
+    """
+    if not items:
+        return
+    
+    try:
+        unique_items = list({(item['messageId'], item['timestamp']): item for item in items}.values())
+        for start in range(0, len(unique_items), BATCH_WRITE_MAX_ITEMS):
+            request = {
+                table_name: [
+                    {'PutRequest': {'Item': {key: _serializer.serialize(value) for key, value in item.items()}}}
+                    for item in unique_items[start:start + BATCH_WRITE_MAX_ITEMS]
+                ]
+            }
+            for attempt in range(BATCH_MAX_ATTEMPTS):
+                if attempt:
+                    time.sleep(batch_backoff_delay(attempt))
+                response = dynamodb_client.batch_write_item(RequestItems=request)
+                request = response.get('UnprocessedItems')
+                if not request:
+                    break
+            else:
+                raise RuntimeError(f"Messages still unprocessed after {BATCH_MAX_ATTEMPTS} attempts")
+        logger.info(f"Stored {len(unique_items)} messages in DynamoDB")
+        
+    except Exception as e:
+        logger.error(f"Error storing messages in DynamoDB: {str(e)}")
+        raise
+
+
+def process_message(message_body: Dict[str, Any], pending_items: Optional[List[Dict[str, Any]]] = None, metrics: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
     """
     Process a single SQS message through the complete workflow.
     
     Args:
         message_body: Parsed SQS message body
+        pending_items: If given, the prepared DynamoDB item is appended here
+            for the caller to batch-write instead of being stored immediately
+        metrics: If given, CloudWatch datums are appended here for the caller
+            to publish instead of being sent immediately
         
     Returns:
         Processing result dictionary
     """
     webhook_payload = message_body['webhook_payload']
-    customer = webhook_payload.get('customer', {})
+    customer = webhook_payload.get('customer') or {}
     
     # Try to get customer identifier for logging
     customer_id = customer.get('email') or customer.get('id') or 'unknown'
@@ -618,17 +1120,23 @@ def process_message(message_body: Dict[str, Any]) -> Dict[str, Any]:
     bucket_name = get_parameter('/referral-system/s3-bucket-name')
     table_name = get_parameter('/referral-system/dynamodb-table-name')
     
+    # The agent, brand guidelines and customer features are independent
+    # lookups, so run them concurrently
+    agent_future = _prefetch_executor.submit(get_active_agent, 'upsell-generator')
+    guidelines_future = _prefetch_executor.submit(get_brand_guidelines, bucket_name)
+    features_future = _prefetch_executor.submit(get_customer_features, customer_email)
+    
     # Get active agent from Agent Registry (with fallback to SSM)
-    active_agent = get_active_agent('upsell-generator')
+    active_agent = agent_future.result()
     model_id = active_agent['model_id']
     agent_version = active_agent['version']
     logger.info(f"Using agent version: {agent_version}, model: {model_id}")
     
     # Fetch brand guidelines
-    brand_guidelines = get_brand_guidelines(bucket_name)
+    brand_guidelines = guidelines_future.result()
     
     # Query Feature Store for customer features
-    customer_features = get_customer_features(customer_email)
+    customer_features = features_future.result()
     if customer_features:
         logger.info(f"Using features from Feature Store: satisfaction={customer_features.get('satisfaction_avg')}, services={customer_features.get('service_count')}, LTV={customer_features.get('lifetime_value')}")
     else:
@@ -637,6 +1145,16 @@ def process_message(message_body: Dict[str, Any]) -> Dict[str, Any]:
     # Format customer data
     customer_data_str = format_customer_data(webhook_payload)
     
+    if message_body.get('priority') == 'batch':
+        return stage_batch_message(
+            webhook_payload=webhook_payload,
+            prompts=build_generator_prompt(customer_data_str, brand_guidelines, format_customer_features(customer_features), ""),
+            bucket_name=bucket_name,
+            table_name=table_name,
+            agent_version=agent_version,
+            pending_items=pending_items
+        )
+    
     # Generate and validate email (with retries)
     retry_count = 0
     approved = False
@@ -644,25 +1162,40 @@ def process_message(message_body: Dict[str, Any]) -> Dict[str, Any]:
     final_judgment = None
     generation_result = None
     previous_feedback = None
+    rejection_reasons = set()
     
     while retry_count <= MAX_RETRIES and not approved:
-        # Generate email
-        generation_result = call_bedrock_generator(
-            model_id=model_id,
-            customer_data_str=customer_data_str,
-            brand_guidelines=brand_guidelines,
-            retry_count=retry_count,
-            previous_feedback=previous_feedback,
-            customer_features=customer_features
-        )
-        
-        # Judge email
-        judgment_result = call_bedrock_judge(
-            model_id=model_id,
-            generated_email=generation_result['email_content'],
-            brand_guidelines=brand_guidelines,
-            customer_data_str=customer_data_str
-        )
+        if COMBINED_PROMPT:
+            # Generate and judge email in one call
+            generation_result, judgment_result = call_bedrock_generate_and_judge(
+                model_id=model_id,
+                customer_data_str=customer_data_str,
+                brand_guidelines=brand_guidelines,
+                retry_count=retry_count,
+                previous_feedback=previous_feedback,
+                customer_features=customer_features,
+                metrics=metrics
+            )
+        else:
+            # Generate email
+            generation_result = call_bedrock_generator(
+                model_id=model_id,
+                customer_data_str=customer_data_str,
+                brand_guidelines=brand_guidelines,
+                retry_count=retry_count,
+                previous_feedback=previous_feedback,
+                customer_features=customer_features,
+                metrics=metrics
+            )
+            
+            # Judge email
+            judgment_result = call_bedrock_judge(
+                model_id=model_id,
+                generated_email=generation_result['email_content'],
+                brand_guidelines=brand_guidelines,
+                customer_data_str=customer_data_str,
+                metrics=metrics
+            )
         
         if judgment_result['approved']:
             approved = True
@@ -680,18 +1213,29 @@ def process_message(message_body: Dict[str, Any]) -> Dict[str, Any]:
                 final_email_content = generation_result['email_content']
                 break
             
-            # Store feedback for next retry
-            previous_feedback = judgment_result['feedback']
-            retry_count += 1
             final_judgment = judgment_result
             final_email_content = generation_result['email_content']
+            
+            # A second service_validity rejection means the catalog has no fitting
+            # service, which another retry won't fix; brand issues keep retrying
+            if rejection_reason == 'service_validity' and rejection_reason in rejection_reasons:
+                logger.info("Repeated service_validity rejection - skipping remaining retries")
+                break
+            rejection_reasons.add(rejection_reason)
+            
+            # Store feedback for next retry, steering away from a rejected service
+            previous_feedback = judgment_result['feedback']
+            if rejection_reason == 'service_validity' and judgment_result.get('service'):
+                previous_feedback += f"\nDo not recommend {judgment_result['service']} - it was rejected as a valid service for this customer."
+            retry_count += 1
     
     # Generate subject line
     email_subject = generate_email_subject(customer.get('first_name', 'Valued Customer'))
     
-    # Prepare DynamoDB record
+    # Prepare DynamoDB record; one clock read is shared by the record and its metrics
     message_id = str(uuid.uuid4())
-    timestamp = int(datetime.utcnow().timestamp())
+    now = datetime.utcnow()
+    timestamp = int(now.timestamp())
     
     # Build customer name from available fields
     customer_name = f"{customer.get('first_name', '')} {customer.get('last_name', '')}".strip() or 'Unknown Customer'
@@ -710,47 +1254,459 @@ def process_message(message_body: Dict[str, Any]) -> Dict[str, Any]:
         'judgeFeedback': final_judgment.get('feedback', ''),
         'judgeIssues': final_judgment.get('issues', []),
         'rejectionReason': final_judgment.get('reason', 'N/A'),
-        'createdAt': datetime.utcnow().isoformat(),
+        'createdAt': now.isoformat(),
         'status': 'approved' if approved else 'rejected',
+        'statusGroup': MESSAGE_STATUS_GROUP,
         'retryCount': retry_count,
         'agentVersion': agent_version,  # Track which agent version generated this
         'customerData': webhook_payload
     }
     
-    # Store in DynamoDB
-    store_in_dynamodb(table_name, dynamodb_item)
+    # Record metrics
+    record_metrics([
+        {
+            'MetricName': 'MessagesGenerated',
+            'Value': 1,
+            'Unit': 'Count',
+            'Timestamp': now
+        },
+        {
+            'MetricName': 'RetryRate',
+            'Value': retry_count,
+            'Unit': 'Count',
+            'Timestamp': now
+        }
+    ], metrics)
     
-    # Publish metrics
-    cloudwatch.put_metric_data(
-        Namespace='ReferralSystem',
-        MetricData=[
-            {
-                'MetricName': 'MessagesGenerated',
-                'Value': 1,
-                'Unit': 'Count',
-                'Timestamp': datetime.utcnow()
-            },
-            {
-                'MetricName': 'RetryRate',
-                'Value': retry_count,
-                'Unit': 'Count',
-                'Timestamp': datetime.utcnow()
-            }
-        ]
-    )
+    # Store in DynamoDB (or queue it for the batch write) last, so an earlier
+    # failure never leaves an item queued for a record that gets retried
+    if pending_items is None:
+        store_in_dynamodb(table_name, dynamodb_item)
+    else:
+        pending_items.append(build_item(dynamodb_item))
     
     return {
         'message_id': message_id,
-        'customer_email': customer['email'],
+        'customer_email': customer.get('email'),
         'approved': approved,
         'retry_count': retry_count
     }
 
 
+def stage_batch_message(webhook_payload: Dict[str, Any], prompts: Tuple[str, str], bucket_name: str, table_name: str, agent_version: str, pending_items: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    Queue a message for Bedrock batch inference instead of generating it now.
+    
+    The generator prompt is written to S3 in Bedrock's batch JSONL format and
+    the message is stored with status 'pending_batch';
+    batch_inference_handler submits the job and judges the results.
+    
+    Args:
+        webhook_payload: Customer data from the webhook
+        prompts: Generator (system prompt, user message) for this customer
+        bucket_name: S3 bucket for batch input/output
+        table_name: DynamoDB table name
+        agent_version: Agent version the prompt was built for
+        pending_items: If given, the DynamoDB item is appended here instead of stored immediately
+        
+    Returns:
+        Processing result dictionary
+    """
+    customer = webhook_payload.get('customer') or {}
+    message_id = str(uuid.uuid4())
+    now = datetime.utcnow()
+    system_prompt, user_message = prompts
+    
+    batch_record = {
+        'recordId': message_id.replace('-', '')[:11],
+        'modelInput': {
+            'schemaVersion': 'messages-v1',
+            'system': [{'text': system_prompt}],
+            'messages': [{'role': 'user', 'content': [{'text': user_message}]}],
+            'inferenceConfig': {'max_new_tokens': 1000, 'temperature': 0.7}
+        }
+    }
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=f"{BATCH_PENDING_PREFIX}{message_id}.jsonl",
+        Body=to_json_bytes(batch_record)
+    )
+    
+    dynamodb_item = {
+        'messageId': message_id,
+        'timestamp': int(now.timestamp()),
+        'customerEmail': customer.get('email') or customer.get('id') or 'unknown@example.com',
+        'customerName': f"{customer.get('first_name', '')} {customer.get('last_name', '')}".strip() or 'Unknown Customer',
+        'emailSubject': generate_email_subject(customer.get('first_name', 'Valued Customer')),
+        'createdAt': now.isoformat(),
+        'status': 'pending_batch',
+        'statusGroup': MESSAGE_STATUS_GROUP,
+        'retryCount': 0,
+        'agentVersion': agent_version,
+        'customerData': webhook_payload
+    }
+    if pending_items is None:
+        store_in_dynamodb(table_name, dynamodb_item)
+    else:
+        pending_items.append(build_item(dynamodb_item))
+    
+    logger.info(f"Message {message_id} staged for batch inference")
+    return {
+        'message_id': message_id,
+        'customer_email': customer.get('email'),
+        'approved': False,
+        'retry_count': 0,
+        'status': 'pending_batch'
+    }
+
+
+def list_objects(bucket_name: str, prefix: str) -> List[str]:
+    """
+    List all object keys under a prefix.
+    """
+    return [key for key, _ in list_objects_modified(bucket_name, prefix)]
+
+
+def list_objects_modified(bucket_name: str, prefix: str) -> List[Tuple[str, datetime]]:
+    """
+    List all (key, last modified) pairs under a prefix.
+    """
+    objects = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        objects.extend((obj['Key'], obj['LastModified']) for obj in page.get('Contents', []))
+    return objects
+
+
+def submit_batch_jobs(bucket_name: str, model_id: str) -> List[str]:
+    """
+    Submit staged messages as Bedrock batch inference jobs.
+    
+    Staged objects are copied under a per-job prefix (up to 1000 per job) and
+    removed from the pending prefix once the job is created, so they are
+    never submitted twice and a failed submission leaves them pending. Nothing
+    is submitted until at least BATCH_MIN_RECORDS messages are waiting;
+    complete_expired_messages handles those that wait too long.
+    
+    Args:
+        bucket_name: S3 bucket holding staged messages
+        model_id: Bedrock model identifier for the jobs
+        
+    Returns:
+        ARNs of the submitted jobs
+    """
+    pending = list_objects(bucket_name, BATCH_PENDING_PREFIX)
+    if len(pending) < BATCH_MIN_RECORDS:
+        logger.info(f"{len(pending)} messages staged for batch inference, waiting for {BATCH_MIN_RECORDS}")
+        return []
+    
+    # Bedrock's control-plane client is only needed here, so it isn't created for every cold start
+    bedrock_batch_client = boto3.client('bedrock', config=_boto_config)
+    job_arns = []
+    for start in range(0, len(pending), BATCH_MAX_RECORDS):
+        chunk = pending[start:start + BATCH_MAX_RECORDS]
+        if len(chunk) < BATCH_MIN_RECORDS:
+            break
+        
+        job_name = f"referral-{ENVIRONMENT}-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{start // BATCH_MAX_RECORDS}"
+        job_prefix = f"{BATCH_JOBS_PREFIX}{job_name}/"
+        job_keys = [job_prefix + key[len(BATCH_PENDING_PREFIX):] for key in chunk]
+        for key, job_key in zip(chunk, job_keys):
+            s3_client.copy_object(
+                Bucket=bucket_name,
+                Key=job_key,
+                CopySource={'Bucket': bucket_name, 'Key': key}
+            )
+        
+        # The staged originals are only removed once the job exists; if
+        # submission fails they stay pending for the next run
+        try:
+            response = bedrock_batch_client.create_model_invocation_job(
+                jobName=job_name,
+                roleArn=BEDROCK_BATCH_ROLE_ARN,
+                modelId=model_id,
+                inputDataConfig={'s3InputDataConfig': {'s3Uri': f"s3://{bucket_name}/{job_prefix}", 's3InputFormat': 'JSONL'}},
+                outputDataConfig={'s3OutputDataConfig': {'s3Uri': f"s3://{bucket_name}/{BATCH_OUTPUT_PREFIX}{job_name}/"}}
+            )
+        except Exception as e:
+            logger.error(f"Error submitting batch inference job {job_name}: {str(e)}")
+            for job_key in job_keys:
+                s3_client.delete_object(Bucket=bucket_name, Key=job_key)
+            raise
+        
+        for key in chunk:
+            s3_client.delete_object(Bucket=bucket_name, Key=key)
+        job_arns.append(response['jobArn'])
+        logger.info(f"Submitted batch inference job {job_name} with {len(chunk)} messages")
+    
+    return job_arns
+
+
+def out_of_time(context: Any) -> bool:
+    """
+    Whether the invocation is too close to its timeout to start more batch work.
+    """
+    return context is not None and context.get_remaining_time_in_millis() < BATCH_TIME_RESERVE_MS
+
+
+def complete_in_chunks(work: List[str], complete: Callable[[str], Optional[Dict[str, Any]]], cleanup: Callable[[str], None], table_name: str, context: Any) -> int:
+    """
+    Complete pending batch messages chunk by chunk.
+    
+    Each chunk is completed concurrently, its items are written to DynamoDB,
+    and only then are its S3 objects cleaned up. A timeout or failed write
+    therefore never loses results: anything not yet written still has its S3
+    objects and is retried by the next run.
+    
+    Args:
+        work: S3 keys to complete
+        complete: Returns the finished item for a key (None if there is no
+            pending message for it); exceptions leave the key for the next run
+        cleanup: Deletes a completed key's S3 objects
+        table_name: DynamoDB table name
+        context: Lambda context, used to stop before the timeout
+        
+    Returns:
+        Number of messages completed
+    """
+    completed = 0
+    for start in range(0, len(work), BATCH_WRITE_MAX_ITEMS):
+        if out_of_time(context):
+            logger.warning(f"Stopping with {len(work) - start} batch messages left for the next run")
+            break
+        
+        chunk = work[start:start + BATCH_WRITE_MAX_ITEMS]
+        items = []
+        done = []
+        for key, future in [(key, _record_executor.submit(complete, key)) for key in chunk]:
+            try:
+                item = future.result()
+            except Exception as e:
+                # Leave the objects in place so the next run retries them
+                logger.error(f"Error completing batch message {key}: {str(e)}")
+                continue
+            if item is not None:
+                items.append(item)
+            done.append(key)
+        
+        flush_items(table_name, items)
+        for key in done:
+            cleanup(key)
+        completed += len(items)
+    return completed
+
+
+def finish_batch_message(table_name: str, message_id: str, email_content: str, error: Optional[str], brand_guidelines: str, model_id: str, metrics: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Judge a batch-generated message and build its finished DynamoDB item.
+    
+    Args:
+        table_name: DynamoDB table name
+        message_id: Pending message ID
+        email_content: Generated message text
+        error: Generation error, if the message could not be generated
+        brand_guidelines: Brand guidelines text (includes service catalog)
+        model_id: Bedrock model identifier for the judge
+        metrics: Metric buffer for the judge
+        
+    Returns:
+        Item ready for flush_items, or None if the pending message is gone
+    """
+    items = dynamodb.Table(table_name).query(
+        KeyConditionExpression='messageId = :id',
+        ExpressionAttributeValues={':id': message_id}
+    )['Items']
+    if not items:
+        logger.warning(f"No pending message found for batch message {message_id}")
+        return None
+    
+    item = items[0]
+    if error is not None:
+        email_content = ''
+        judgment = to_judgment_result({'feedback': f"Batch inference failed: {error}"}, 0)
+    else:
+        judgment = call_bedrock_judge(
+            model_id=model_id,
+            generated_email=email_content,
+            brand_guidelines=brand_guidelines,
+            customer_data_str=format_customer_data(item.get('customerData', {})),
+            metrics=metrics
+        )
+    item.update({
+        'emailContent': email_content,
+        'llmJudgeScore': judgment.get('score', 0),
+        'judgeApproved': judgment.get('approved', False),
+        'judgeFeedback': judgment.get('feedback', ''),
+        'judgeIssues': judgment.get('issues', []),
+        'rejectionReason': judgment.get('reason', 'N/A'),
+        'status': 'approved' if judgment.get('approved') else 'rejected'
+    })
+    return build_item(item)
+
+
+def collect_batch_outputs(bucket_name: str, table_name: str, metrics: List[Dict[str, Any]], context: Any = None) -> int:
+    """
+    Judge and store the results of finished batch inference jobs.
+    
+    Output objects are named <job>/<job id>/<messageId>.jsonl.out. Each
+    result is judged in real time (no regeneration on rejection) and the
+    pending message is updated with the outcome; input and output objects are
+    only deleted once the update has been written (see complete_in_chunks).
+    
+    Args:
+        bucket_name: S3 bucket holding batch output
+        table_name: DynamoDB table name
+        metrics: Metric buffer for the judge
+        context: Lambda context, used to stop before the timeout
+        
+    Returns:
+        Number of messages completed
+    """
+    outputs = [key for key in list_objects(bucket_name, BATCH_OUTPUT_PREFIX) if key.endswith('.jsonl.out')]
+    if not outputs:
+        return 0
+    
+    brand_guidelines = get_brand_guidelines(bucket_name)
+    model_id = get_active_agent('upsell-generator')['model_id']
+    
+    def complete(key: str) -> Optional[Dict[str, Any]]:
+        message_id = key.rsplit('/', 1)[-1][:-len('.jsonl.out')]
+        result = from_json(s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read())
+        if 'error' in result:
+            return finish_batch_message(table_name, message_id, '', str(result['error']), brand_guidelines, model_id, metrics)
+        email_content = result['modelOutput']['output']['message']['content'][0]['text'].strip()
+        return finish_batch_message(table_name, message_id, email_content, None, brand_guidelines, model_id, metrics)
+    
+    def cleanup(key: str) -> None:
+        job_name = key[len(BATCH_OUTPUT_PREFIX):].split('/', 1)[0]
+        file_name = key.rsplit('/', 1)[-1][:-len('.out')]
+        s3_client.delete_object(Bucket=bucket_name, Key=f"{BATCH_JOBS_PREFIX}{job_name}/{file_name}")
+        s3_client.delete_object(Bucket=bucket_name, Key=key)
+    
+    return complete_in_chunks(outputs, complete, cleanup, table_name, context)
+
+
+def complete_expired_messages(bucket_name: str, table_name: str, model_id: str, metrics: List[Dict[str, Any]], context: Any = None) -> int:
+    """
+    Generate staged messages that have waited longer than BATCH_MAX_WAIT.
+    
+    Bedrock won't run a job with fewer than BATCH_MIN_RECORDS messages, so
+    under low traffic staged messages could otherwise wait forever. Their
+    staged prompts are sent through the Converse API and judged like batch
+    output.
+    
+    Args:
+        bucket_name: S3 bucket holding staged messages
+        table_name: DynamoDB table name
+        model_id: Bedrock model identifier
+        metrics: Metric buffer for the judge
+        context: Lambda context, used to stop before the timeout
+        
+    Returns:
+        Number of messages completed
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=BATCH_MAX_WAIT)
+    expired = [key for key, modified in list_objects_modified(bucket_name, BATCH_PENDING_PREFIX) if modified < cutoff]
+    if not expired:
+        return 0
+    logger.info(f"{len(expired)} staged messages waited over {BATCH_MAX_WAIT}s, generating them in real time")
+    
+    brand_guidelines = get_brand_guidelines(bucket_name)
+    
+    def complete(key: str) -> Optional[Dict[str, Any]]:
+        model_input = from_json(s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read())['modelInput']
+        response = bedrock_client.converse(
+            modelId=model_id,
+            system=model_input['system'],
+            messages=model_input['messages'],
+            inferenceConfig={'maxTokens': 1000, 'temperature': 0.7}
+        )
+        email_content = response['output']['message']['content'][0]['text'].strip()
+        return finish_batch_message(table_name, key[len(BATCH_PENDING_PREFIX):-len('.jsonl')], email_content, None, brand_guidelines, model_id, metrics)
+    
+    def cleanup(key: str) -> None:
+        s3_client.delete_object(Bucket=bucket_name, Key=key)
+    
+    return complete_in_chunks(expired, complete, cleanup, table_name, context)
+
+
+def batch_inference_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Scheduled Lambda handler for Bedrock batch inference.
+    Completes messages from finished jobs, submits newly staged messages, and
+    generates staged messages that have waited too long for a full job.
+    
+    Args:
+        event: EventBridge schedule event
+        context: Lambda context object
+        
+    Returns:
+        Summary of completed messages and submitted jobs
+    """
+    bucket_name = get_parameter('/referral-system/s3-bucket-name')
+    table_name = get_parameter('/referral-system/dynamodb-table-name')
+    
+    metrics = []
+    completed = collect_batch_outputs(bucket_name, table_name, metrics, context)
+    model_id = get_active_agent('upsell-generator')['model_id']
+    job_arns = submit_batch_jobs(bucket_name, model_id)
+    completed += complete_expired_messages(bucket_name, table_name, model_id, metrics, context)
+    
+    try:
+        publish_metrics(metrics)
+    except Exception as e:
+        logger.warning(f"Could not publish metrics: {str(e)}")
+    
+    logger.info(f"Batch inference: {completed} messages completed, {len(job_arns)} jobs submitted")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'completed': completed,
+            'submitted_jobs': job_arns
+        })
+    }
+
+
+def handle_record(record: Dict[str, Any], pending_items: List[Dict[str, Any]], metrics: List[Dict[str, Any]]) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    Parse and process a single SQS record.
+    
+    Args:
+        record: SQS record from the event
+        pending_items: Shared list collecting DynamoDB items for the batch write
+        metrics: Shared list collecting CloudWatch datums for the invocation
+        
+    Returns:
+        (result, error) tuple; exactly one of them is None
+    """
+    # Items are only handed to the batch write once the record has succeeded,
+    # so a record reported in batchItemFailures never has its item written too
+    record_items = []
+    try:
+        # Parse message body
+        message_body = decode_sqs_body(record)
+        
+        # Process message
+        result = process_message(message_body, record_items, metrics)
+        pending_items.extend(record_items)
+        logger.info(f"Successfully processed message: {result['message_id']}")
+        return result, None
+        
+    except Exception as e:
+        logger.error(f"Error processing message: {str(e)}", exc_info=True)
+        return None, {
+            'message_id': record.get('messageId'),
+            'error': str(e)
+        }
+
+
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Main Lambda handler function for SQS event processing.
     
+    Records that fail are reported back as batchItemFailures (keyed by SQS
+    messageId), so SQS only redelivers those and not the whole batch.
+    
     Args:
         event: SQS event object
         context: Lambda context object
@@ -763,36 +1719,39 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     results = []
     errors = []
     
-    for record in event.get('Records', []):
-        try:
-            # Parse message body
-            message_body = json.loads(record['body'])
-            
-            # Process message
-            result = process_message(message_body)
+    # Workers append prepared items and metric datums here (list.append and
+    # list.extend are atomic), and both are flushed once afterwards
+    pending_items = []
+    metrics = []
+    futures = [_record_executor.submit(handle_record, record, pending_items, metrics) for record in event.get('Records', [])]
+    for future in as_completed(futures):
+        result, error = future.result()
+        if error:
+            errors.append(error)
+        else:
             results.append(result)
-            
-            logger.info(f"Successfully processed message: {result['message_id']}")
-            
-        except Exception as e:
-            logger.error(f"Error processing message: {str(e)}", exc_info=True)
-            errors.append({
-                'message_id': record.get('messageId'),
-                'error': str(e)
-            })
+    
+    if pending_items:
+        flush_items(get_parameter('/referral-system/dynamodb-table-name'), pending_items)
+    
+    # Metrics are best-effort; a CloudWatch failure shouldn't redeliver the batch
+    try:
+        publish_metrics(metrics)
+    except Exception as e:
+        logger.warning(f"Could not publish metrics: {str(e)}")
     
     # Log summary
     logger.info(f"Processed {len(results)} messages successfully, {len(errors)} errors")
     
-    # If any errors occurred, raise exception to trigger retry
     if errors:
-        raise Exception(f"Failed to process {len(errors)} messages: {errors}")
+        logger.error(f"Failed to process {len(errors)} messages: {errors}")
     
     return {
         'statusCode': 200,
         'body': json.dumps({
             'processed': len(results),
             'results': results
-        })
+        }),
+        'batchItemFailures': [{'itemIdentifier': error['message_id']} for error in errors]
     }
 
@@ -7,23 +7,73 @@ import json
 import os
 import boto3
 import logging
+import re
+import threading
+import time
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Any
+from botocore.config import Config
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib encoder
+    orjson = None
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initialize AWS clients
-dynamodb = boto3.resource('dynamodb')
-ssm = boto3.client('ssm')
+# Shared client config: adaptive retries back off on SSM/DynamoDB
+# throttling, short timeouts surface it quickly, and keep-alive lets warm
+# invocations reuse TLS connections
+_boto_config = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    tcp_keepalive=True,
+    connect_timeout=1,
+    read_timeout=3,
+    max_pool_connections=50
+)
+
+# Initialize AWS clients. The DynamoDB resource is only created once a
+# request has passed validation (see get_dynamodb).
+dynamodb = None
+ssm = boto3.client('ssm', config=_boto_config)
 
-# Cache for SSM parameters
+# Cache for SSM parameters: name -> (value, expiry as time.monotonic()).
+# Misses are fetched under the lock so concurrent callers don't all hit SSM,
+# and entries expire so rotated values are picked up without a redeploy.
 _parameter_cache = {}
+_parameter_cache_lock = threading.Lock()
+PARAMETER_CACHE_TTL = int(os.environ.get('PARAMETER_CACHE_TTL', '300'))
 
 # Get environment from Lambda environment variable
 ENVIRONMENT = os.environ.get('ENVIRONMENT', 'dev')
 
+# Parameters every request needs, fetched together during cold start
+REQUIRED_PARAMS = ['/referral-system/agent-registry-table-name']
+
+# Versions are MAJOR.MINOR or MAJOR.MINOR.PATCH, e.g. "1.0" or "2.1.3"
+_VERSION_RE = re.compile(r'^\d+(?:\.\d+){1,2}$')
+
+
+def prefetch_parameters(parameter_names: list[str]) -> None:
+    """
+    Load parameters into the cache with a single GetParameters call.
+    Both the environment-specific and legacy paths are requested; names that
+    don't exist are simply left for get_parameter to resolve on demand.
+    """
+    names = []
+    for parameter_name in parameter_names:
+        names.append(parameter_name.replace('/referral-system/', f'/referral-system/{ENVIRONMENT}/'))
+        names.append(parameter_name)
+    
+    response = ssm.get_parameters(Names=names, WithDecryption=True)
+    expiry = time.monotonic() + PARAMETER_CACHE_TTL
+    with _parameter_cache_lock:
+        for parameter in response['Parameters']:
+            _parameter_cache[parameter['Name']] = (parameter['Value'], expiry)
+    logger.info(f"Prefetched {len(_parameter_cache)} parameters")
+
 
 def get_parameter(parameter_name: str) -> str:
     """
@@ -38,24 +88,51 @@ def get_parameter(parameter_name: str) -> str:
     
     # Try environment-specific parameter first, then fallback to old path
     for param_name in [env_specific_name, parameter_name]:
-        if param_name in _parameter_cache:
-            return _parameter_cache[param_name]
+        cached = _parameter_cache.get(param_name)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
         
-        try:
-            response = ssm.get_parameter(Name=param_name, WithDecryption=True)
-            _parameter_cache[param_name] = response['Parameter']['Value']
-            logger.info(f"Retrieved parameter: {param_name}")
-            return _parameter_cache[param_name]
-        except ssm.exceptions.ParameterNotFound:
-            continue
-        except Exception as e:
-            logger.error(f"Error retrieving parameter {param_name}: {str(e)}")
-            raise
+        with _parameter_cache_lock:
+            # Another caller may have fetched it while we waited for the lock
+            cached = _parameter_cache.get(param_name)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+            
+            try:
+                response = ssm.get_parameter(Name=param_name, WithDecryption=True)
+                value = response['Parameter']['Value']
+                _parameter_cache[param_name] = (value, time.monotonic() + PARAMETER_CACHE_TTL)
+                logger.info(f"Retrieved parameter: {param_name}")
+                return value
+            except ssm.exceptions.ParameterNotFound:
+                continue
+            except Exception as e:
+                logger.error(f"Error retrieving parameter {param_name}: {str(e)}")
+                raise
     
     raise ValueError(f"Parameter not found: {parameter_name} or {env_specific_name}")
 
 
-def validate_agent_config(agent_config: Dict[str, Any]) -> tuple[bool, str]:
+# Pay for the SSM round-trip during INIT rather than the first request;
+# PREFETCH_PARAMETERS=false skips it where SSM isn't reachable (e.g. unit tests)
+if os.environ.get('PREFETCH_PARAMETERS', 'true').lower() == 'true':
+    try:
+        prefetch_parameters(REQUIRED_PARAMS)
+    except Exception as e:
+        logger.warning(f"Could not prefetch parameters: {str(e)}")
+
+
+def get_dynamodb():
+    """
+    Return the DynamoDB resource, creating it on first use.
+    """
+    global dynamodb
+    if dynamodb is None:
+        dynamodb = boto3.resource('dynamodb', config=_boto_config)
+    return dynamodb
+
+
+def validate_agent_config(agent_config: dict[str, Any]) -> tuple[bool, str]:
     """
     Validate agent configuration.
     
@@ -79,13 +156,13 @@ def validate_agent_config(agent_config: Dict[str, Any]) -> tuple[bool, str]:
     
     # Validate version format (should be semantic versioning like "1.0", "2.1", etc.)
     version = agent_config['version']
-    if not isinstance(version, str) or not version.replace('.', '').isdigit():
+    if not isinstance(version, str) or not _VERSION_RE.fullmatch(version):
         return False, "Version must be a string in format like '1.0', '2.1', etc."
     
     return True, ""
 
 
-def register_agent(agent_config: Dict[str, Any]) -> Dict[str, Any]:
+def register_agent(agent_config: dict[str, Any]) -> dict[str, Any]:
     """
     Register a new agent version in the Agent Registry.
     
@@ -97,10 +174,11 @@ def register_agent(agent_config: Dict[str, Any]) -> Dict[str, Any]:
     """
     # Get table name from SSM
     table_name = get_parameter('/referral-system/agent-registry-table-name')
-    table = dynamodb.Table(table_name)
+    table = get_dynamodb().Table(table_name)
     
     agent_id = agent_config['agentId']
     version = agent_config['version']
+    now = datetime.utcnow().isoformat()
     
     # Prepare agent record
     agent_record = {
@@ -108,8 +186,8 @@ def register_agent(agent_config: Dict[str, Any]) -> Dict[str, Any]:
         'version': version,
         'bedrockModel': agent_config['bedrockModel'],
         'status': agent_config.get('status', 'draft'),
-        'createdAt': datetime.utcnow().isoformat(),
-        'updatedAt': datetime.utcnow().isoformat(),
+        'createdAt': now,
+        'updatedAt': now,
         'performance': agent_config.get('performance', {}),
     }
     
@@ -123,42 +201,40 @@ def register_agent(agent_config: Dict[str, Any]) -> Dict[str, Any]:
     if 'description' in agent_config:
         agent_record['description'] = agent_config['description']
     
-    # Check if agent version already exists
+    # Create the record unless this agent version is already registered
     try:
-        existing = table.get_item(
-            Key={
-                'agentId': agent_id,
-                'version': version
-            }
-        )
-        
-        if 'Item' in existing:
-            # Update existing record
-            agent_record['updatedAt'] = datetime.utcnow().isoformat()
-            table.put_item(Item=agent_record)
-            logger.info(f"Updated existing agent: {agent_id} v{version}")
-            return {
-                'success': True,
-                'action': 'updated',
-                'agentId': agent_id,
-                'version': version
-            }
-    except Exception as e:
-        logger.warning(f"Error checking for existing agent: {str(e)}")
+        table.put_item(Item=agent_record, ConditionExpression='attribute_not_exists(agentId)')
+        logger.info(f"Registered new agent: {agent_id} v{version}")
+        return {
+            'success': True,
+            'action': 'created',
+            'agentId': agent_id,
+            'version': version
+        }
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
     
-    # Create new record
+    # Update existing record
     table.put_item(Item=agent_record)
-    logger.info(f"Registered new agent: {agent_id} v{version}")
-    
+    logger.info(f"Updated existing agent: {agent_id} v{version}")
     return {
         'success': True,
-        'action': 'created',
+        'action': 'updated',
         'agentId': agent_id,
         'version': version
     }
 
 
-def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+def to_json(obj: Any) -> str:
+    """
+    Serialize compact JSON, using orjson when it is packaged with the function.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def lambda_handler(event: dict[str, Any], context: Any) -> dict[str, Any]:
     """
     Main Lambda handler function.
     
@@ -169,7 +245,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     Returns:
         Response dictionary
     """
-    logger.info(f"Received agent registration request: {json.dumps(event)}")
+    logger.info(f"Received agent registration request: {to_json(event)}")
     
     try:
         # Parse event (could be direct invocation or API Gateway)
@@ -191,7 +267,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'Content-Type': 'application/json',
                     'Access-Control-Allow-Origin': '*'
                 },
-                'body': json.dumps({
+                'body': to_json({
                     'error': 'Invalid agent configuration',
                     'message': error_message
                 })
@@ -206,7 +282,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             },
-            'body': json.dumps(result)
+            'body': to_json(result)
         }
         
     except Exception as e:
@@ -217,7 +293,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             },
-            'body': json.dumps({
+            'body': to_json({
                 'error': 'Internal server error',
                 'message': str(e)
             })
@@ -3,27 +3,121 @@ AWS Lambda function for handling webhook requests.
 Receives webhook payloads, validates them, and sends to SQS queue.
 """
 
+import base64
 import json
 import os
 import boto3
+import functools
 import logging
+import re
+import threading
+import time
 from datetime import datetime
-from typing import Dict, Any
+from typing import Any
+from botocore.config import Config
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib json module
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional; large bodies are then sent as-is
+    zstandard = None
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initialize AWS clients
-ssm_client = boto3.client('ssm')
-sqs_client = boto3.client('sqs')
+# Shared client config: adaptive retries back off on SSM/SQS
+# throttling, short timeouts surface it quickly, and keep-alive lets warm
+# invocations reuse TLS connections
+_boto_config = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    tcp_keepalive=True,
+    connect_timeout=1,
+    read_timeout=3,
+    max_pool_connections=50
+)
 
-# Cache for SSM parameters
+# Initialize AWS clients. SSM is needed on every request; the SQS client is
+# only created once a payload has passed validation (see get_sqs_client).
+ssm_client = boto3.client('ssm', config=_boto_config)
+sqs_client = None
+
+# Cache for SSM parameters: name -> (value, expiry as time.monotonic()).
+# Misses are fetched under the lock so concurrent callers don't all hit SSM,
+# and entries expire so rotated values are picked up without a redeploy.
 _parameter_cache = {}
+_parameter_cache_lock = threading.Lock()
+PARAMETER_CACHE_TTL = int(os.environ.get('PARAMETER_CACHE_TTL', '300'))
+PARAMETER_CACHE_MAX_ENTRIES = 128
+
+# Which path (environment-specific or legacy) each parameter was found at,
+# so later lookups don't probe a path that doesn't exist
+_resolved_names = {}
+
+# SendMessageBatch accepts at most 10 entries per request; failed entries
+# are retried with exponential backoff
+SQS_BATCH_MAX_ENTRIES = 10
+SQS_BATCH_MAX_ATTEMPTS = 4
+SQS_BATCH_BACKOFF_BASE = 0.1
+
+# SQS bills each 64 KB chunk of a message separately; bodies larger than
+# this are zstd-compressed and base64-encoded, flagged with an 'encoding'
+# attribute the orchestrator decodes
+SQS_COMPRESSION_THRESHOLD = int(os.environ.get('SQS_COMPRESSION_THRESHOLD', str(64 * 1024)))
+SQS_COMPRESSED_ENCODING = 'zstd+b64'
+
+# Values of the optional "priority" payload field passed on to the orchestrator
+MESSAGE_PRIORITIES = ('realtime', 'batch')
 
 # Get environment from Lambda environment variable
 ENVIRONMENT = os.environ.get('ENVIRONMENT', 'dev')
 
+# Parameters every request needs, fetched together during cold start
+REQUIRED_PARAMS = ['/referral-system/sqs-queue-url', '/referral-system/feature-queue-url']
+
+# Loose shape check for customer emails (something@domain.tld)
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+
+@functools.lru_cache(maxsize=None)
+def get_env_specific_name(parameter_name: str) -> str:
+    """
+    Map a base parameter name to its environment-specific path.
+    """
+    if parameter_name.startswith('/referral-system/'):
+        return parameter_name.replace('/referral-system/', f'/referral-system/{ENVIRONMENT}/')
+    return parameter_name
+
+
+def prefetch_parameters(parameter_names: list[str]) -> None:
+    """
+    Load parameters into the cache with a single GetParameters call.
+    Both the environment-specific and legacy paths are requested; names that
+    don't exist are simply left for get_parameter to resolve on demand.
+    """
+    names = []
+    for parameter_name in parameter_names:
+        names.append(get_env_specific_name(parameter_name))
+        names.append(parameter_name)
+    
+    response = ssm_client.get_parameters(Names=names, WithDecryption=True)
+    expiry = time.monotonic() + PARAMETER_CACHE_TTL
+    with _parameter_cache_lock:
+        for parameter in response['Parameters']:
+            _parameter_cache[parameter['Name']] = (parameter['Value'], expiry)
+    
+    for parameter_name in parameter_names:
+        for param_name in [get_env_specific_name(parameter_name), parameter_name]:
+            if param_name in _parameter_cache:
+                _resolved_names[parameter_name] = param_name
+                break
+    logger.info(f"Prefetched {len(_parameter_cache)} parameters")
+
+
 def get_parameter(parameter_name: str) -> str:
     """
     Retrieve parameter from SSM Parameter Store with caching.
@@ -35,35 +129,52 @@ def get_parameter(parameter_name: str) -> str:
     Returns:
         Parameter value as string
     """
-    # Construct environment-specific parameter name
-    if parameter_name.startswith('/referral-system/'):
-        env_specific_name = parameter_name.replace('/referral-system/', f'/referral-system/{ENVIRONMENT}/')
-    else:
-        env_specific_name = parameter_name
-    
-    # Try environment-specific parameter first, then fallback to old path
-    for param_name in [env_specific_name, parameter_name]:
-        if param_name in _parameter_cache:
-            return _parameter_cache[param_name]
-        
-        try:
-            response = ssm_client.get_parameter(
-                Name=param_name,
-                WithDecryption=True
-            )
-            _parameter_cache[param_name] = response['Parameter']['Value']
-            logger.info(f"Retrieved parameter: {param_name}")
-            return _parameter_cache[param_name]
-        except ssm_client.exceptions.ParameterNotFound:
-            continue
-        except Exception as e:
-            logger.error(f"Error retrieving parameter {param_name}: {str(e)}")
-            raise
+    env_specific_name = get_env_specific_name(parameter_name)
+    
+    # Use the path found earlier; otherwise try environment-specific
+    # parameter first, then fallback to old path
+    resolved_name = _resolved_names.get(parameter_name)
+    for param_name in [resolved_name] if resolved_name else [env_specific_name, parameter_name]:
+        cached = _parameter_cache.get(param_name)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        
+        with _parameter_cache_lock:
+            # Another caller may have fetched it while we waited for the lock
+            cached = _parameter_cache.get(param_name)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+            
+            try:
+                response = ssm_client.get_parameter(Name=param_name, WithDecryption=True)
+                value = response['Parameter']['Value']
+                if len(_parameter_cache) >= PARAMETER_CACHE_MAX_ENTRIES:
+                    _parameter_cache.clear()
+                _parameter_cache[param_name] = (value, time.monotonic() + PARAMETER_CACHE_TTL)
+                _resolved_names[parameter_name] = param_name
+                logger.info(f"Retrieved parameter: {param_name}")
+                return value
+            except ssm_client.exceptions.ParameterNotFound:
+                # Probe both paths again next time if a resolved name disappears
+                _resolved_names.pop(parameter_name, None)
+                continue
+            except Exception as e:
+                logger.error(f"Error retrieving parameter {param_name}: {str(e)}")
+                raise
     
     raise ValueError(f"Parameter not found: {parameter_name} or {env_specific_name}")
 
 
-def validate_webhook_payload(payload: Dict[str, Any]) -> tuple[bool, str]:
+# Pay for the SSM round-trip during INIT rather than the first request;
+# PREFETCH_PARAMETERS=false skips it where SSM isn't reachable (e.g. unit tests)
+if os.environ.get('PREFETCH_PARAMETERS', 'true').lower() == 'true':
+    try:
+        prefetch_parameters(REQUIRED_PARAMS)
+    except Exception as e:
+        logger.warning(f"Could not prefetch parameters: {str(e)}")
+
+
+def validate_webhook_payload(payload: dict[str, Any]) -> tuple[bool, str]:
     """
     Validate the incoming webhook payload structure.
     Accepts any JSON structure - validation happens in the orchestrator/LLM.
@@ -78,24 +189,65 @@ def validate_webhook_payload(payload: Dict[str, Any]) -> tuple[bool, str]:
     if not payload or not isinstance(payload, dict):
         return False, "Payload must be a non-empty JSON object"
     
-    # Optional: Check for customer identifier (email or id) for logging
-    customer = payload.get('customer', {})
-    customer_id = customer.get('email') or customer.get('id') or 'unknown'
+    # Optional: Check for customer identifier (email or id) for logging.
+    # A null customer is normalized in the payload itself, so everything
+    # downstream can treat 'customer' as an object.
+    customer = payload.get('customer')
+    if customer is None:
+        customer = {}
+        if 'customer' in payload:
+            payload['customer'] = customer
+    elif not isinstance(customer, dict):
+        return False, "Customer must be a JSON object"
+    
+    # Email is optional, but a malformed one can't be used downstream
+    email = customer.get('email')
+    if email is not None and (not isinstance(email, str) or _EMAIL_RE.fullmatch(email) is None):
+        return False, "Invalid customer email format"
+    
+    customer_id = email or customer.get('id') or 'unknown'
     
     logger.info(f"Payload validation successful for customer: {customer_id}")
     return True, ""
 
 
-def send_to_sqs(queue_url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+def from_json(data: Any) -> Any:
     """
-    Send validated payload to SQS queue.
+    Parse JSON from str or bytes, using orjson when it is packaged with the function.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def to_json(obj: Any) -> str:
+    """
+    Serialize compact JSON, using orjson when it is packaged with the function.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def get_sqs_client():
+    """
+    Return the SQS client, creating it on first use.
+    """
+    global sqs_client
+    if sqs_client is None:
+        sqs_client = boto3.client('sqs', config=_boto_config)
+    return sqs_client
+
+
+def build_sqs_message(payload: dict[str, Any]) -> dict[str, Any]:
+    """
+    Build the SQS message body and attributes for one webhook payload.
     
     Args:
-        queue_url: SQS queue URL
         payload: Validated webhook payload
         
     Returns:
-        SQS send_message response
+        MessageBody and MessageAttributes arguments for SQS
     """
     message_body = {
         'webhook_payload': payload,
@@ -103,26 +255,56 @@ def send_to_sqs(queue_url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
         'source': 'webhook_handler'
     }
     
+    # Callers that don't need a real-time reply can send "priority": "batch";
+    # the orchestrator then queues the message for Bedrock batch inference
+    priority = payload.get('priority')
+    if priority in MESSAGE_PRIORITIES:
+        message_body['priority'] = priority
+    
     # Extract identifiers for message attributes (with fallbacks)
-    customer = payload.get('customer', {})
+    customer = payload.get('customer') or {}
     customer_email = customer.get('email') or customer.get('id') or 'unknown'
     event_type = payload.get('event_type', 'service_completed')
     
+    body = to_json(message_body)
+    attributes = {
+        'customer_identifier': {
+            'StringValue': customer_email,
+            'DataType': 'String'
+        },
+        'event_type': {
+            'StringValue': event_type,
+            'DataType': 'String'
+        }
+    }
+    
+    encoded = body.encode('utf-8')
+    if zstandard is not None and len(encoded) > SQS_COMPRESSION_THRESHOLD:
+        body = base64.b64encode(zstandard.ZstdCompressor(level=3).compress(encoded)).decode('ascii')
+        attributes['encoding'] = {
+            'StringValue': SQS_COMPRESSED_ENCODING,
+            'DataType': 'String'
+        }
+    
+    return {
+        'MessageBody': body,
+        'MessageAttributes': attributes
+    }
+
+
+def send_to_sqs(queue_url: str, payload: dict[str, Any]) -> dict[str, Any]:
+    """
+    Send validated payload to SQS queue.
+    
+    Args:
+        queue_url: SQS queue URL
+        payload: Validated webhook payload
+        
+    Returns:
+        SQS send_message response
+    """
     try:
-        response = sqs_client.send_message(
-            QueueUrl=queue_url,
-            MessageBody=json.dumps(message_body),
-            MessageAttributes={
-                'customer_identifier': {
-                    'StringValue': customer_email,
-                    'DataType': 'String'
-                },
-                'event_type': {
-                    'StringValue': event_type,
-                    'DataType': 'String'
-                }
-            }
-        )
+        response = get_sqs_client().send_message(QueueUrl=queue_url, **build_sqs_message(payload))
         logger.info(f"Message sent to SQS: {response['MessageId']}")
         return response
     except Exception as e:
@@ -130,7 +312,98 @@ def send_to_sqs(queue_url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
         raise
 
 
-def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+def send_batch_to_sqs(queue_url: str, payloads: list[dict[str, Any]]) -> list[str]:
+    """
+    Send several validated payloads to SQS, up to 10 per SendMessageBatch.
+    
+    Entries that fail with a server-side error are retried with exponential
+    backoff; sender faults (bad entries) fail immediately.
+    
+    Args:
+        queue_url: SQS queue URL
+        payloads: Validated webhook payloads
+        
+    Returns:
+        SQS message IDs of the sent messages
+    """
+    message_ids = []
+    try:
+        for start in range(0, len(payloads), SQS_BATCH_MAX_ENTRIES):
+            entries = [
+                {'Id': str(index), **build_sqs_message(payload)}
+                for index, payload in enumerate(payloads[start:start + SQS_BATCH_MAX_ENTRIES])
+            ]
+            for attempt in range(SQS_BATCH_MAX_ATTEMPTS):
+                if attempt:
+                    time.sleep(SQS_BATCH_BACKOFF_BASE * 2 ** attempt)
+                response = get_sqs_client().send_message_batch(QueueUrl=queue_url, Entries=entries)
+                message_ids.extend(entry['MessageId'] for entry in response.get('Successful', []))
+                
+                failed = response.get('Failed', [])
+                if not failed:
+                    break
+                if any(entry.get('SenderFault') for entry in failed):
+                    raise RuntimeError(f"SQS rejected messages: {failed}")
+                failed_ids = {entry['Id'] for entry in failed}
+                entries = [entry for entry in entries if entry['Id'] in failed_ids]
+            else:
+                raise RuntimeError(f"{len(entries)} messages still failed after {SQS_BATCH_MAX_ATTEMPTS} attempts")
+        
+        logger.info(f"Sent {len(message_ids)} messages to SQS")
+        return message_ids
+    except Exception as e:
+        logger.error(f"Error sending messages to SQS: {str(e)}")
+        raise
+
+
+def send_feature_events(payloads: list[dict[str, Any]]) -> None:
+    """
+    Forward webhook payloads to the feature enricher's queue so the Feature
+    Store stays current. Best-effort: the webhook has already been queued for
+    the orchestrator, so failures are only logged.
+    
+    Args:
+        payloads: Validated webhook payloads; those without a customer email
+            are skipped, since features are keyed by email
+    """
+    events = [payload for payload in payloads if (payload.get('customer') or {}).get('email')]
+    if not events:
+        return
+    
+    try:
+        queue_url = get_parameter('/referral-system/feature-queue-url')
+        for start in range(0, len(events), SQS_BATCH_MAX_ENTRIES):
+            entries = [
+                {'Id': str(index), 'MessageBody': to_json({'customer_data': payload})}
+                for index, payload in enumerate(events[start:start + SQS_BATCH_MAX_ENTRIES])
+            ]
+            response = get_sqs_client().send_message_batch(QueueUrl=queue_url, Entries=entries)
+            if response.get('Failed'):
+                logger.warning(f"Could not queue {len(response['Failed'])} feature events: {response['Failed']}")
+    except Exception as e:
+        logger.warning(f"Could not queue feature events: {str(e)}")
+
+
+# Probe paths answered without touching SSM or SQS
+HEALTH_CHECK_PATHS = ('/health', '/healthcheck')
+
+
+def is_health_check(event: dict[str, Any]) -> bool:
+    """
+    Check whether the request is a health probe or CORS preflight that can
+    be answered without reading configuration or queueing anything.
+    """
+    path = event.get('rawPath') or event.get('path')
+    if path in HEALTH_CHECK_PATHS:
+        return True
+    
+    method = event.get('httpMethod') or event.get('requestContext', {}).get('http', {}).get('method')
+    if method == 'OPTIONS':
+        return True
+    return method == 'GET' and not event.get('body')
+
+
+def lambda_handler(event: dict[str, Any], context: Any) -> dict[str, Any]:
     """
     Main Lambda handler function.
     
@@ -141,13 +414,26 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     Returns:
         API Gateway response object
     """
-    logger.info(f"Received webhook request: {json.dumps(event)}")
+    if is_health_check(event):
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': '{"ok":true}'
+        }
+    
+    logger.info(f"Received webhook request: {to_json(event)}")
     
     try:
         # Parse request body
         if 'body' in event:
             if isinstance(event['body'], str):
-                body = json.loads(event['body'])
+                # Reject obviously non-JSON bodies before running the parser
+                if event['body'].lstrip()[:1] not in ('{', '['):
+                    raise json.JSONDecodeError('Expecting a JSON object or array', event['body'], 0)
+                body = from_json(event['body'])
             else:
                 body = event['body']
         else:
@@ -163,20 +449,58 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'Content-Type': 'application/json',
                     'Access-Control-Allow-Origin': '*'
                 },
-                'body': json.dumps({
+                'body': to_json({
                     'error': 'Invalid payload',
                     'message': error_message
                 })
             }
         
-        # Get SQS queue URL from SSM
+        # Aggregated webhooks carry several events; each is queued as its own message
+        events = body.get('events')
+        if isinstance(events, list):
+            for webhook_event in events:
+                is_valid, error_message = validate_webhook_payload(webhook_event)
+                if not is_valid:
+                    logger.warning(f"Invalid event in batch: {error_message}")
+                    return {
+                        'statusCode': 400,
+                        'headers': {
+                            'Content-Type': 'application/json',
+                            'Access-Control-Allow-Origin': '*'
+                        },
+                        'body': to_json({
+                            'error': 'Invalid payload',
+                            'message': error_message
+                        })
+                    }
+            
+            queue_url = get_parameter('/referral-system/sqs-queue-url')
+            message_ids = send_batch_to_sqs(queue_url, events)
+            send_feature_events(events)
+            
+            logger.info(f"Webhook batch of {len(message_ids)} events processed successfully")
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': to_json({
+                    'message': 'Webhook received successfully',
+                    'messageIds': message_ids,
+                    'timestamp': datetime.utcnow().isoformat()
+                })
+            }
+        
+        # Only valid payloads reach SSM and SQS (the SQS client is created here on first use)
         queue_url = get_parameter('/referral-system/sqs-queue-url')
         
         # Send to SQS
         sqs_response = send_to_sqs(queue_url, body)
+        send_feature_events([body])
         
         # Extract customer identifier for response
-        customer = body.get('customer', {})
+        customer = body.get('customer') or {}
         customer_identifier = customer.get('email') or customer.get('id') or 'unknown'
         
         # Return success response
@@ -186,7 +510,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             },
-            'body': json.dumps({
+            'body': to_json({
                 'message': 'Webhook received successfully',
                 'messageId': sqs_response['MessageId'],
                 'customer_identifier': customer_identifier,
@@ -205,7 +529,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             },
-            'body': json.dumps({
+            'body': to_json({
                 'error': 'Invalid JSON',
                 'message': str(e)
             })
@@ -219,7 +543,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             },
-            'body': json.dumps({
+            'body': to_json({
                 'error': 'Internal server error',
                 'message': 'An unexpected error occurred processing your request'
             })
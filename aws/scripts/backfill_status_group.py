@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Backfill script that sets statusGroup on messages written before it existed.
+The /messages endpoint and query_messages.py list messages through
+TimestampIndex, whose partition key is statusGroup, so older rows without it
+don't show up until this has been run once.
+"""
+
+import argparse
+import sys
+from typing import Iterator, Dict, Any
+
+import boto3
+from botocore.exceptions import ClientError
+
+from query_messages import get_table_name, MESSAGE_STATUS_GROUP
+
+
+def scan_missing_status_group(table) -> Iterator[Dict[str, Any]]:
+    """Yield the key of every message that has no statusGroup attribute."""
+    kwargs = {
+        'FilterExpression': 'attribute_not_exists(statusGroup)',
+        'ProjectionExpression': 'messageId, #ts',
+        'ExpressionAttributeNames': {'#ts': 'timestamp'}
+    }
+    while True:
+        response = table.scan(**kwargs)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def backfill_status_group(table_name: str, dry_run: bool = False) -> int:
+    """
+    Set statusGroup on every message missing it.
+
+    Args:
+        table_name: DynamoDB messages table
+        dry_run: Only count the messages that would be updated
+
+    Returns:
+        Number of messages updated (or that would be, for a dry run)
+    """
+    table = boto3.resource('dynamodb').Table(table_name)
+    updated = 0
+    for key in scan_missing_status_group(table):
+        if not dry_run:
+            try:
+                # The condition keeps concurrent writers' values and makes re-runs no-ops
+                table.update_item(
+                    Key=key,
+                    UpdateExpression='SET statusGroup = :group',
+                    ConditionExpression='attribute_exists(messageId) AND attribute_not_exists(statusGroup)',
+                    ExpressionAttributeValues={':group': MESSAGE_STATUS_GROUP}
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                    continue
+                raise
+        updated += 1
+    return updated
+
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Set statusGroup on messages written before TimestampIndex existed')
+    parser.add_argument('--dry-run', action='store_true',
+                       help='Only report how many messages are missing statusGroup')
+    args = parser.parse_args()
+
+    table_name = get_table_name()
+    try:
+        count = backfill_status_group(table_name, dry_run=args.dry_run)
+    except Exception as e:
+        print(f"Error: Backfill failed: {str(e)}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.dry_run:
+        print(f"{count} messages in {table_name} are missing statusGroup")
+    else:
+        print(f"Set statusGroup on {count} messages in {table_name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,20 +5,36 @@ Provides various filtering and display options.
 """
 
 import json
+import os
 import sys
+import time
 import argparse
+import functools
+import queue
+import threading
 import boto3
+from boto3.dynamodb.conditions import Key
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Optional
 from decimal import Decimal
 
-# Initialize AWS clients
-cloudformation = boto3.client('cloudformation')
+# Initialize AWS clients. CloudFormation is only needed when no table name
+# is given (see _cfn).
 dynamodb = boto3.resource('dynamodb')
 
 # Configuration
 STACK_NAME = 'referral-email-system'
 
+# Stack outputs are cached on disk so repeated runs skip DescribeStacks
+STACK_OUTPUTS_CACHE = os.path.join(
+    os.path.expanduser('~'), '.cache', 'referral-system', f'stackoutputs-{STACK_NAME}.json'
+)
+STACK_OUTPUTS_CACHE_TTL = 24 * 60 * 60  # seconds
+
+# statusGroup value shared by every message (TimestampIndex partition key)
+MESSAGE_STATUS_GROUP = 'ALL'
+
 
 class Colors:
     """ANSI color codes for terminal output."""
@@ -32,6 +48,15 @@ class Colors:
     BOLD = '\033[1m'
 
 
+# Skip ANSI escapes when output is piped or redirected (e.g. | less, > file)
+_IS_TTY = sys.stdout.isatty()
+if not _IS_TTY:
+    for _name in ('HEADER', 'OKBLUE', 'OKCYAN', 'OKGREEN', 'WARNING', 'FAIL', 'ENDC', 'BOLD'):
+        setattr(Colors, _name, '')
+
+SEPARATOR = f"{Colors.HEADER}{'='*80}{Colors.ENDC}"
+
+
 def decimal_default(obj):
     """JSON serializer for Decimal objects."""
     if isinstance(obj, Decimal):
@@ -39,14 +64,45 @@ def decimal_default(obj):
     raise TypeError
 
 
+@functools.cache
+def _cfn():
+    """CloudFormation client, created only when the stack has to be described."""
+    return boto3.client('cloudformation')
+
+
+def get_stack_outputs() -> Dict[str, str]:
+    """
+    Return the stack's outputs as {OutputKey: OutputValue}.
+    Served from the on-disk cache while it is fresh; otherwise fetched with
+    DescribeStacks and cached (best-effort) for later runs.
+    """
+    try:
+        if time.time() - os.path.getmtime(STACK_OUTPUTS_CACHE) < STACK_OUTPUTS_CACHE_TTL:
+            with open(STACK_OUTPUTS_CACHE) as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    
+    response = _cfn().describe_stacks(StackName=STACK_NAME)
+    outputs = {output['OutputKey']: output['OutputValue'] for output in response['Stacks'][0].get('Outputs', [])}
+    try:
+        os.makedirs(os.path.dirname(STACK_OUTPUTS_CACHE), exist_ok=True)
+        with open(STACK_OUTPUTS_CACHE, 'w') as f:
+            json.dump(outputs, f)
+    except OSError:
+        pass
+    return outputs
+
+
 def get_table_name() -> str:
-    """Retrieve DynamoDB table name from CloudFormation stack."""
+    """Retrieve DynamoDB table name from $AWS_REFERRAL_TABLE or the CloudFormation stack."""
+    if os.environ.get('AWS_REFERRAL_TABLE'):
+        return os.environ['AWS_REFERRAL_TABLE']
+    
     try:
-        response = cloudformation.describe_stacks(StackName=STACK_NAME)
-        outputs = response['Stacks'][0]['Outputs']
-        for output in outputs:
-            if output['OutputKey'] == 'DynamoDBTableName':
-                return output['OutputValue']
+        outputs = get_stack_outputs()
+        if 'DynamoDBTableName' in outputs:
+            return outputs['DynamoDBTableName']
         raise ValueError("DynamoDB table name not found in stack outputs")
     except Exception as e:
         print(f"Error: Failed to get table name: {str(e)}", file=sys.stderr)
@@ -58,68 +114,65 @@ def format_timestamp(timestamp: int) -> str:
     return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
 
 
-def print_separator():
-    """Print a separator line."""
-    print(f"{Colors.HEADER}{'='*80}{Colors.ENDC}")
+def status_color(status: str) -> str:
+    """Color for an upper-cased message status."""
+    if status == 'APPROVED':
+        return Colors.OKGREEN
+    elif status == 'REJECTED':
+        return Colors.FAIL
+    return Colors.WARNING
 
 
 def print_message_summary(item: Dict[str, Any], index: int = None):
-    """Print a summary of a message."""
+    """Print a summary of a message, written out in one call."""
     if index is not None:
-        print(f"\n{Colors.BOLD}Message #{index}{Colors.ENDC}")
+        lines = [f"\n{Colors.BOLD}Message #{index}{Colors.ENDC}"]
     else:
-        print(f"\n{Colors.BOLD}Message{Colors.ENDC}")
+        lines = [f"\n{Colors.BOLD}Message{Colors.ENDC}"]
     
-    print_separator()
+    lines.append(SEPARATOR)
     
     # Status with color coding
     status = item.get('status', 'unknown').upper()
-    if status == 'APPROVED':
-        status_color = Colors.OKGREEN
-    elif status == 'REJECTED':
-        status_color = Colors.FAIL
-    else:
-        status_color = Colors.WARNING
     
-    print(f"Status: {status_color}{Colors.BOLD}{status}{Colors.ENDC}")
-    print(f"Message ID: {item.get('messageId', 'N/A')}")
-    print(f"Created: {item.get('createdAt', 'N/A')}")
-    print(f"Customer: {item.get('customerName', 'N/A')} ({item.get('customerEmail', 'N/A')})")
-    print(f"Judge Score: {item.get('llmJudgeScore', 'N/A')}/10")
-    print(f"Approved: {'Yes' if item.get('judgeApproved') else 'No'}")
-    print(f"Retry Count: {item.get('retryCount', 0)}")
+    lines.append(f"Status: {status_color(status)}{Colors.BOLD}{status}{Colors.ENDC}")
+    lines.append(f"Message ID: {item.get('messageId', 'N/A')}")
+    lines.append(f"Created: {item.get('createdAt', 'N/A')}")
+    lines.append(f"Customer: {item.get('customerName', 'N/A')} ({item.get('customerEmail', 'N/A')})")
+    lines.append(f"Judge Score: {item.get('llmJudgeScore', 'N/A')}/10")
+    lines.append(f"Approved: {'Yes' if item.get('judgeApproved') else 'No'}")
+    lines.append(f"Retry Count: {item.get('retryCount', 0)}")
     
     if item.get('judgeFeedback'):
-        print(f"\n{Colors.OKCYAN}Judge Feedback:{Colors.ENDC}")
-        print(f"  {item['judgeFeedback']}")
+        lines.append(f"\n{Colors.OKCYAN}Judge Feedback:{Colors.ENDC}")
+        lines.append(f"  {item['judgeFeedback']}")
     
     if item.get('judgeIssues'):
-        print(f"\n{Colors.WARNING}Issues:{Colors.ENDC}")
-        for issue in item['judgeIssues']:
-            print(f"  - {issue}")
+        lines.append(f"\n{Colors.WARNING}Issues:{Colors.ENDC}")
+        lines.extend(f"  - {issue}" for issue in item['judgeIssues'])
     
-    print(f"\n{Colors.BOLD}Email Subject:{Colors.ENDC}")
-    print(f"  {item.get('emailSubject', 'N/A')}")
+    lines.append(f"\n{Colors.BOLD}Email Subject:{Colors.ENDC}")
+    lines.append(f"  {item.get('emailSubject', 'N/A')}")
     
-    print(f"\n{Colors.BOLD}Email Content:{Colors.ENDC}")
+    lines.append(f"\n{Colors.BOLD}Email Content:{Colors.ENDC}")
     content = item.get('emailContent', 'N/A')
-    for line in content.split('\n'):
-        print(f"  {line}")
+    lines.extend(f"  {line}" for line in content.split('\n'))
     
-    print_separator()
+    lines.append(SEPARATOR)
+    sys.stdout.write('\n'.join(lines) + '\n')
 
 
 def print_message_list(items: List[Dict[str, Any]]):
-    """Print a compact list of messages."""
+    """Print a compact list of messages, written out in one call."""
     if not items:
         print(f"{Colors.WARNING}No messages found.{Colors.ENDC}")
         return
     
-    print(f"\n{Colors.BOLD}Found {len(items)} message(s):{Colors.ENDC}\n")
+    lines = [f"\n{Colors.BOLD}Found {len(items)} message(s):{Colors.ENDC}\n"]
     
     # Table header
-    print(f"{Colors.HEADER}{'Index':<6} {'Status':<12} {'Score':<7} {'Customer':<30} {'Created':<20}{Colors.ENDC}")
-    print_separator()
+    lines.append(f"{Colors.HEADER}{'Index':<6} {'Status':<12} {'Score':<7} {'Customer':<30} {'Created':<20}{Colors.ENDC}")
+    lines.append(SEPARATOR)
     
     for idx, item in enumerate(items, 1):
         status = item.get('status', 'unknown').upper()
@@ -128,30 +181,46 @@ def print_message_list(items: List[Dict[str, Any]]):
         created = item.get('createdAt', 'N/A')[:19]
         
         # Color code by status
-        if status == 'APPROVED':
-            status_color = Colors.OKGREEN
-        elif status == 'REJECTED':
-            status_color = Colors.FAIL
-        else:
-            status_color = Colors.WARNING
-        
-        print(f"{idx:<6} {status_color}{status:<12}{Colors.ENDC} {score:<7} {customer:<30} {created:<20}")
+        lines.append(f"{idx:<6} {status_color(status)}{status:<12}{Colors.ENDC} {score:<7} {customer:<30} {created:<20}")
     
-    print()
+    lines.append('')
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+
+def query_paginated(table, limit: int, **query_kwargs) -> List[Dict[str, Any]]:
+    """
+    Run a query, following LastEvaluatedKey until limit items are collected.
+    
+    Args:
+        table: DynamoDB Table resource
+        limit: Maximum number of items to return
+        **query_kwargs: Arguments for table.query
+        
+    Returns:
+        Up to limit items, in the query's order
+    """
+    items = []
+    while len(items) < limit:
+        response = table.query(Limit=limit - len(items), **query_kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return items
 
 
 def query_all_messages(table_name: str, limit: int = 50) -> List[Dict[str, Any]]:
-    """Query all messages from DynamoDB."""
+    """Query all messages from DynamoDB, most recent first."""
     table = dynamodb.Table(table_name)
     
     try:
-        response = table.scan(Limit=limit)
-        items = response.get('Items', [])
-        
-        # Sort by timestamp (most recent first)
-        items.sort(key=lambda x: x.get('timestamp', 0), reverse=True)
-        
-        return items
+        return query_paginated(
+            table,
+            limit,
+            IndexName='TimestampIndex',
+            KeyConditionExpression=Key('statusGroup').eq(MESSAGE_STATUS_GROUP),
+            ScanIndexForward=False
+        )
     except Exception as e:
         print(f"Error: Failed to query messages: {str(e)}", file=sys.stderr)
         sys.exit(1)
@@ -162,15 +231,15 @@ def query_by_status(table_name: str, status: str, limit: int = 50) -> List[Dict[
     table = dynamodb.Table(table_name)
     
     try:
-        response = table.query(
+        return query_paginated(
+            table,
+            limit,
             IndexName='StatusIndex',
             KeyConditionExpression='#status = :status',
             ExpressionAttributeNames={'#status': 'status'},
             ExpressionAttributeValues={':status': status.lower()},
-            ScanIndexForward=False,
-            Limit=limit
+            ScanIndexForward=False
         )
-        return response.get('Items', [])
     except Exception as e:
         print(f"Error: Failed to query messages by status: {str(e)}", file=sys.stderr)
         sys.exit(1)
@@ -181,19 +250,92 @@ def query_by_email(table_name: str, email: str, limit: int = 50) -> List[Dict[st
     table = dynamodb.Table(table_name)
     
     try:
-        response = table.query(
+        return query_paginated(
+            table,
+            limit,
             IndexName='CustomerEmailIndex',
             KeyConditionExpression='customerEmail = :email',
             ExpressionAttributeValues={':email': email},
-            ScanIndexForward=False,
-            Limit=limit
+            ScanIndexForward=False
         )
-        return response.get('Items', [])
     except Exception as e:
         print(f"Error: Failed to query messages by email: {str(e)}", file=sys.stderr)
         sys.exit(1)
 
 
+def scan_parallel(table_name: str, segments: int = 4, limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Read the whole table with a parallel scan, for bulk exports.
+    
+    Each segment is paginated in its own thread, so throughput grows with
+    the number of segments - and so does the read capacity consumed. Items
+    are yielded page by page as segments return them (in no particular
+    order), so the table is never held in memory.
+    
+    Args:
+        table_name: DynamoDB table name
+        segments: Number of scan segments read in parallel
+        limit: Maximum number of items to yield (None for all)
+        
+    Yields:
+        Message items
+    """
+    # The resource's client already converts items to Python types
+    paginator = dynamodb.meta.client.get_paginator('scan')
+    pages = queue.Queue()
+    stop = threading.Event()
+    
+    def scan_segment(segment: int) -> None:
+        try:
+            for page in paginator.paginate(TableName=table_name, Segment=segment, TotalSegments=segments):
+                if stop.is_set():
+                    break
+                pages.put(page.get('Items', []))
+        except Exception as e:
+            pages.put(e)
+        finally:
+            pages.put(None)  # This segment is done
+    
+    count = 0
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        for segment in range(segments):
+            executor.submit(scan_segment, segment)
+        
+        try:
+            remaining = segments
+            while remaining:
+                page = pages.get()
+                if page is None:
+                    remaining -= 1
+                    continue
+                if isinstance(page, Exception):
+                    raise page
+                for item in page:
+                    if limit and count >= limit:
+                        return
+                    count += 1
+                    yield item
+        finally:
+            stop.set()
+
+
+def query_by_message_id(table_name: str, message_id: str) -> Optional[Dict[str, Any]]:
+    """Get the most recent message with this ID, without knowing its timestamp."""
+    table = dynamodb.Table(table_name)
+    
+    try:
+        response = table.query(
+            KeyConditionExpression=Key('messageId').eq(message_id),
+            ScanIndexForward=False,
+            Limit=1
+        )
+        items = response.get('Items', [])
+        return items[0] if items else None
+    except Exception as e:
+        print(f"Error: Failed to get message: {str(e)}", file=sys.stderr)
+        sys.exit(1)
+
+
 def get_message_by_id(table_name: str, message_id: str, timestamp: int) -> Dict[str, Any]:
     """Get a specific message by ID and timestamp."""
     table = dynamodb.Table(table_name)
@@ -211,12 +353,22 @@ def get_message_by_id(table_name: str, message_id: str, timestamp: int) -> Dict[
         sys.exit(1)
 
 
-def export_to_json(items: List[Dict[str, Any]], filename: str):
-    """Export messages to JSON file."""
+def export_to_json(items: Iterable[Dict[str, Any]], filename: str) -> int:
+    """
+    Export messages to JSON file, one message per line.
+    Items are written as they are read, so a generator is never materialized.
+    """
     try:
+        count = 0
         with open(filename, 'w') as f:
-            json.dump(items, f, indent=2, default=decimal_default)
-        print(f"{Colors.OKGREEN}✓ Exported {len(items)} message(s) to {filename}{Colors.ENDC}")
+            f.write('[')
+            for item in items:
+                f.write(',\n  ' if count else '\n  ')
+                f.write(json.dumps(item, default=decimal_default))
+                count += 1
+            f.write('\n]\n' if count else ']\n')
+        print(f"{Colors.OKGREEN}✓ Exported {count} message(s) to {filename}{Colors.ENDC}")
+        return count
     except Exception as e:
         print(f"Error: Failed to export to JSON: {str(e)}", file=sys.stderr)
         sys.exit(1)
@@ -244,6 +396,10 @@ Examples:
   # Export messages to JSON
   python3 query_messages.py --status approved --export messages.json
 
+  # Export every message (parallel table scan; uses read capacity
+  # proportional to table size)
+  python3 query_messages.py --list-all --export all_messages.json
+
   # Limit number of results
   python3 query_messages.py --list-all --limit 10
         """
@@ -251,7 +407,7 @@ Examples:
     
     parser.add_argument('--list-all', action='store_true',
                        help='List all messages')
-    parser.add_argument('--status', choices=['approved', 'rejected', 'pending'],
+    parser.add_argument('--status', choices=['approved', 'rejected', 'pending', 'pending_batch'],
                        help='Filter by message status')
     parser.add_argument('--email', type=str,
                        help='Filter by customer email')
@@ -259,10 +415,12 @@ Examples:
                        help='Get specific message by ID')
     parser.add_argument('--detailed', action='store_true',
                        help='Show detailed information for each message')
-    parser.add_argument('--limit', type=int, default=50,
-                       help='Maximum number of messages to retrieve (default: 50)')
+    parser.add_argument('--limit', type=int,
+                       help='Maximum number of messages to retrieve (default: 50, or all with --list-all --export)')
     parser.add_argument('--export', type=str, metavar='FILENAME',
                        help='Export results to JSON file')
+    parser.add_argument('--segments', type=int, default=4,
+                       help='Parallel scan segments for --list-all --export (default: 4)')
     parser.add_argument('--table-name', type=str,
                        help='DynamoDB table name (overrides stack lookup)')
     
@@ -281,20 +439,23 @@ Examples:
     items = []
     
     if args.message_id:
-        # Get specific message (requires timestamp too, but we'll scan for it)
-        all_items = query_all_messages(table_name, limit=1000)
-        item = next((i for i in all_items if i.get('messageId') == args.message_id), None)
+        # Get specific message (newest version if there are several timestamps)
+        item = query_by_message_id(table_name, args.message_id)
         if item:
             items = [item]
         else:
             print(f"{Colors.FAIL}Message with ID '{args.message_id}' not found.{Colors.ENDC}")
             sys.exit(1)
     elif args.email:
-        items = query_by_email(table_name, args.email, args.limit)
+        items = query_by_email(table_name, args.email, args.limit or 50)
     elif args.status:
-        items = query_by_status(table_name, args.status, args.limit)
+        items = query_by_status(table_name, args.status, args.limit or 50)
+    elif args.list_all and args.export:
+        # Bulk export streams straight to the file without listing each message
+        export_to_json(scan_parallel(table_name, args.segments, args.limit), args.export)
+        return
     elif args.list_all:
-        items = query_all_messages(table_name, args.limit)
+        items = query_all_messages(table_name, args.limit or 50)
     else:
         parser.print_help()
         sys.exit(0)
@@ -313,15 +474,32 @@ Examples:
     # Print statistics
     if items:
         print(f"\n{Colors.BOLD}Statistics:{Colors.ENDC}")
-        approved = sum(1 for item in items if item.get('status') == 'approved')
-        rejected = sum(1 for item in items if item.get('status') == 'rejected')
-        pending = sum(1 for item in items if item.get('status') == 'pending')
-        avg_score = sum(item.get('llmJudgeScore', 0) for item in items) / len(items)
+        approved = rejected = pending = pending_batch = 0
+        score_sum = 0.0
+        score_count = 0
+        for item in items:
+            status = item.get('status')
+            if status == 'approved':
+                approved += 1
+            elif status == 'rejected':
+                rejected += 1
+            elif status == 'pending':
+                pending += 1
+            elif status == 'pending_batch':
+                pending_batch += 1
+            
+            # Messages without a judge score (e.g. pending) don't count toward the average
+            score = item.get('llmJudgeScore')
+            if score is not None:
+                score_sum += float(score)
+                score_count += 1
+        avg_score = score_sum / score_count if score_count else 0.0
         
         print(f"  Total messages: {len(items)}")
         print(f"  {Colors.OKGREEN}Approved: {approved}{Colors.ENDC}")
         print(f"  {Colors.FAIL}Rejected: {rejected}{Colors.ENDC}")
         print(f"  {Colors.WARNING}Pending: {pending}{Colors.ENDC}")
+        print(f"  {Colors.WARNING}Pending Batch: {pending_batch}{Colors.ENDC}")
         print(f"  Average Judge Score: {avg_score:.1f}/10")
         
         if approved > 0:
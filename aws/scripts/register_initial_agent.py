@@ -4,32 +4,65 @@ Script to register the initial agent in Agent Registry after deployment.
 This sets up the default agent so the system works immediately.
 """
 
-import json
+import functools
+import os
 import sys
 import boto3
 from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+from typing import Dict
 
-# Initialize AWS clients
-cloudformation = boto3.client('cloudformation')
+# Initialize AWS clients. CloudFormation is only needed when the table name
+# isn't overridden (see _cfn).
 dynamodb = boto3.resource('dynamodb')
 ssm = boto3.client('ssm')
 
-# Get environment from command line or default to dev
-ENVIRONMENT = sys.argv[1] if len(sys.argv) > 1 else 'dev'
-STACK_NAME = f'referral-email-system-{ENVIRONMENT}'
+# Agents seeded into the registry; all use the default Bedrock model
+DEFAULT_AGENTS = [
+    {
+        'agentId': 'upsell-generator',
+        'version': '1.0',
+        'status': 'production',
+        'description': 'Initial production agent - migrated from SSM parameter'
+    }
+]
+
+
+@functools.cache
+def get_environment() -> str:
+    """Get environment from command line or default to dev."""
+    return sys.argv[1] if len(sys.argv) > 1 else 'dev'
+
+
+def get_stack_name() -> str:
+    """CloudFormation stack name for the selected environment."""
+    return f'referral-email-system-{get_environment()}'
+
+
+@functools.cache
+def _cfn():
+    """CloudFormation client, created only when the stack has to be described."""
+    return boto3.client('cloudformation')
+
+
+def get_stack_outputs() -> Dict[str, str]:
+    """Return the stack's outputs as {OutputKey: OutputValue}."""
+    response = _cfn().describe_stacks(StackName=get_stack_name())
+    return {output['OutputKey']: output['OutputValue'] for output in response['Stacks'][0].get('Outputs', [])}
 
 
 def get_table_name() -> str:
-    """Get Agent Registry table name from CloudFormation stack."""
+    """Get Agent Registry table name from $AWS_REFERRAL_REGISTRY_TABLE or the CloudFormation stack."""
+    if os.environ.get('AWS_REFERRAL_REGISTRY_TABLE'):
+        return os.environ['AWS_REFERRAL_REGISTRY_TABLE']
+    
     try:
-        response = cloudformation.describe_stacks(StackName=STACK_NAME)
-        outputs = response['Stacks'][0]['Outputs']
-        for output in outputs:
-            if output['OutputKey'] == 'AgentRegistryTableName':
-                return output['OutputValue']
+        outputs = get_stack_outputs()
+        if 'AgentRegistryTableName' in outputs:
+            return outputs['AgentRegistryTableName']
         # Fallback to SSM (try environment-specific first)
         try:
-            response = ssm.get_parameter(Name=f'/referral-system/{ENVIRONMENT}/agent-registry-table-name')
+            response = ssm.get_parameter(Name=f'/referral-system/{get_environment()}/agent-registry-table-name')
             return response['Parameter']['Value']
         except:
             # Fallback to old path for backward compatibility
@@ -48,7 +81,7 @@ def get_default_model_id() -> str:
     try:
         # Try environment-specific first
         try:
-            response = ssm.get_parameter(Name=f'/referral-system/{ENVIRONMENT}/bedrock-model-id')
+            response = ssm.get_parameter(Name=f'/referral-system/{get_environment()}/bedrock-model-id')
             return response['Parameter']['Value']
         except:
             # Fallback to old path
@@ -58,54 +91,62 @@ def get_default_model_id() -> str:
         return 'amazon.nova-pro-v1:0'  # Default fallback
 
 
+def register_agent(table, agent: Dict, model_id: str) -> bool:
+    """
+    Register one agent unless it already exists.
+
+    Returns:
+        True if the agent was written, False if it was already registered
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    try:
+        table.put_item(
+            Item={
+                'agentId': agent['agentId'],
+                'version': agent['version'],
+                'bedrockModel': model_id,
+                'status': agent['status'],
+                'createdAt': now,
+                'updatedAt': now,
+                'description': agent['description'],
+                'performance': {}
+            },
+            ConditionExpression='attribute_not_exists(agentId)'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+
 def register_initial_agent():
-    """Register the initial production agent."""
+    """Register the default agents that are not already in the registry."""
     table_name = get_table_name()
     model_id = get_default_model_id()
     
     table = dynamodb.Table(table_name)
     
-    # Check if agent already exists
-    try:
-        response = table.get_item(
-            Key={
-                'agentId': 'upsell-generator',
-                'version': '1.0'
-            }
-        )
-        if 'Item' in response:
-            print(f"[OK] Agent 'upsell-generator' v1.0 already exists in registry")
-            return
-    except Exception as e:
-        print(f"Warning: Could not check for existing agent: {e}")
-    
-    # Register initial agent
-    agent_record = {
-        'agentId': 'upsell-generator',
-        'version': '1.0',
-        'bedrockModel': model_id,
-        'status': 'production',
-        'createdAt': datetime.now(timezone.utc).isoformat(),
-        'updatedAt': datetime.now(timezone.utc).isoformat(),
-        'description': 'Initial production agent - migrated from SSM parameter',
-        'performance': {}
-    }
-    
-    try:
-        table.put_item(Item=agent_record)
-        print(f"[OK] Successfully registered initial agent:")
-        print(f"  Agent ID: upsell-generator")
-        print(f"  Version: 1.0")
+    for agent in DEFAULT_AGENTS:
+        try:
+            registered = register_agent(table, agent, model_id)
+        except Exception as e:
+            print(f"[ERROR] Error registering agent: {str(e)}", file=sys.stderr)
+            sys.exit(1)
+        
+        if not registered:
+            print(f"[OK] Agent '{agent['agentId']}' v{agent['version']} already exists in registry")
+            continue
+        print(f"[OK] Successfully registered agent:")
+        print(f"  Agent ID: {agent['agentId']}")
+        print(f"  Version: {agent['version']}")
         print(f"  Model: {model_id}")
-        print(f"  Status: production")
+        print(f"  Status: {agent['status']}")
         print(f"  Table: {table_name}")
-    except Exception as e:
-        print(f"[ERROR] Error registering agent: {str(e)}", file=sys.stderr)
-        sys.exit(1)
-
 
 if __name__ == '__main__':
-    print(f"Registering initial agent in Agent Registry (Environment: {ENVIRONMENT})...")
+    ENVIRONMENT = get_environment()
+    print(f"Registering initial agents in Agent Registry (Environment: {ENVIRONMENT})...")
     register_initial_agent()
     print(f"\n[OK] Agent Registry setup complete for {ENVIRONMENT} environment!")
     print("\nThe orchestrator will now use this agent from the registry.")
@@ -4,24 +4,56 @@ Integration testing script for Referral Email System.
 Tests the complete workflow from webhook to DynamoDB storage.
 """
 
+import functools
 import json
+import os
+import random
 import sys
+import threading
 import time
 import boto3
+from boto3.dynamodb.types import TypeDeserializer
 import requests
-from datetime import datetime
-from typing import Dict, Any, List
-
-# Initialize AWS clients
-cloudformation = boto3.client('cloudformation')
-dynamodb = boto3.resource('dynamodb')
-sqs = boto3.client('sqs')
-logs = boto3.client('logs')
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib parser
+    orjson = None
+
+# Shared HTTP session so webhook POSTs reuse keep-alive connections to API
+# Gateway instead of a new TLS handshake per test. urllib3 doesn't retry
+# POSTs on error statuses by default, so only connection failures are retried.
+_http = requests.Session()
+_http.mount('https://', HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
 
 # Configuration
 STACK_NAME = 'referral-email-system'
 MOCK_DATA_DIR = 'mock_data'
 TEST_TIMEOUT = 60  # seconds
+STACK_OUTPUTS_CACHE_TTL = 10 * 60  # seconds
+
+# (test name, mock payload file) pairs run by run_all_tests
+TEST_CASES = [
+    ("High-Value Customer - Quarterly Service", "webhook_payload_1.json"),
+    ("Termite Treatment Customer", "webhook_payload_2.json"),
+    ("Long-Term Monthly Customer", "webhook_payload_3.json"),
+]
+POLL_BASE_DELAY = 0.2  # seconds
+POLL_MAX_DELAY = 2.0  # seconds
+
+# Test cases run concurrently; output goes through this lock so each
+# test's report is written as one uninterrupted block
+_print_lock = threading.Lock()
 
 
 class Colors:
@@ -36,49 +68,98 @@ class Colors:
     BOLD = '\033[1m'
 
 
+def _emit(text: str):
+    """Write text to stdout in one call, without output from other tests in between."""
+    with _print_lock:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+
 def print_header(message: str):
     """Print a formatted header."""
-    print(f"\n{Colors.HEADER}{Colors.BOLD}{'='*60}{Colors.ENDC}")
-    print(f"{Colors.HEADER}{Colors.BOLD}{message}{Colors.ENDC}")
-    print(f"{Colors.HEADER}{Colors.BOLD}{'='*60}{Colors.ENDC}\n")
+    bar = f"{Colors.HEADER}{Colors.BOLD}{'='*60}{Colors.ENDC}"
+    _emit(f"\n{bar}\n{Colors.HEADER}{Colors.BOLD}{message}{Colors.ENDC}\n{bar}\n\n")
 
 
 def print_success(message: str):
     """Print a success message."""
-    print(f"{Colors.OKGREEN}✓ {message}{Colors.ENDC}")
+    _emit(f"{Colors.OKGREEN}✓ {message}{Colors.ENDC}\n")
 
 
 def print_error(message: str):
     """Print an error message."""
-    print(f"{Colors.FAIL}✗ {message}{Colors.ENDC}")
+    _emit(f"{Colors.FAIL}✗ {message}{Colors.ENDC}\n")
 
 
 def print_info(message: str):
     """Print an info message."""
-    print(f"{Colors.OKCYAN}ℹ {message}{Colors.ENDC}")
+    _emit(f"{Colors.OKCYAN}ℹ {message}{Colors.ENDC}\n")
 
 
 def print_warning(message: str):
     """Print a warning message."""
-    print(f"{Colors.WARNING}⚠ {message}{Colors.ENDC}")
-
-
-def get_stack_outputs() -> Dict[str, str]:
-    """Retrieve CloudFormation stack outputs."""
+    _emit(f"{Colors.WARNING}⚠ {message}{Colors.ENDC}\n")
+
+
+def print_block(lines: List[str]):
+    """Print several lines with a single write."""
+    _emit('\n'.join(lines) + '\n')
+
+
+@functools.lru_cache(maxsize=None)
+def get_session() -> boto3.Session:
+    """
+    boto3 session shared by every client, created on first use so that
+    importing this module (or --help) doesn't walk the credential chain.
+    Clients are created from the main thread and then shared; boto3 clients
+    are thread-safe, sessions and resources are not.
+    """
+    return boto3.Session()
+
+
+@functools.lru_cache(maxsize=4)
+def get_stack_outputs(stack_name: str = STACK_NAME) -> Dict[str, str]:
+    """
+    Retrieve CloudFormation stack outputs.
+    Outputs are cached on disk for a few minutes so back-to-back test runs
+    skip DescribeStacks.
+    """
+    cache_path = os.path.join(
+        os.path.expanduser('~'), '.cache', 'referral-tests', f'outputs-{stack_name}.json'
+    )
+    try:
+        if time.time() - os.path.getmtime(cache_path) < STACK_OUTPUTS_CACHE_TTL:
+            with open(cache_path) as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    
     try:
-        response = cloudformation.describe_stacks(StackName=STACK_NAME)
+        response = get_session().client('cloudformation').describe_stacks(StackName=stack_name)
         outputs = response['Stacks'][0]['Outputs']
-        return {output['OutputKey']: output['OutputValue'] for output in outputs}
+        outputs = {output['OutputKey']: output['OutputValue'] for output in outputs}
     except Exception as e:
         print_error(f"Failed to get stack outputs: {str(e)}")
         sys.exit(1)
+    
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'w') as f:
+            json.dump(outputs, f)
+    except OSError:
+        pass
+    return outputs
 
 
+@functools.lru_cache(maxsize=None)
 def load_mock_payload(filename: str) -> Dict[str, Any]:
-    """Load a mock webhook payload from file."""
+    """
+    Load a mock webhook payload from file.
+    Parsed once per run; callers must not modify the returned dict.
+    """
     try:
-        with open(f'{MOCK_DATA_DIR}/{filename}', 'r') as f:
-            return json.load(f)
+        data = Path(MOCK_DATA_DIR, filename).read_bytes()
+        return orjson.loads(data) if orjson is not None else json.loads(data)
     except Exception as e:
         print_error(f"Failed to load mock payload {filename}: {str(e)}")
         sys.exit(1)
@@ -87,7 +168,7 @@ def load_mock_payload(filename: str) -> Dict[str, Any]:
 def send_webhook(url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
     """Send webhook POST request."""
     try:
-        response = requests.post(
+        response = _http.post(
             url,
             json=payload,
             headers={'Content-Type': 'application/json'},
@@ -103,7 +184,7 @@ def send_webhook(url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
         raise
 
 
-def check_queue_depth(queue_url: str) -> int:
+def check_queue_depth(sqs, queue_url: str) -> int:
     """Check SQS queue depth."""
     try:
         response = sqs.get_queue_attributes(
@@ -118,34 +199,139 @@ def check_queue_depth(queue_url: str) -> int:
         return -1
 
 
-def wait_for_processing(table_name: str, customer_email: str, timeout: int = TEST_TIMEOUT) -> Dict[str, Any]:
-    """Wait for message to be processed and stored in DynamoDB."""
-    table = dynamodb.Table(table_name)
+class ResultsListener:
+    """
+    Long-polls the test results queue (fed by the messages table's stream)
+    in a background thread and hands each stored message to the test
+    waiting on its customer email.
+    """
+    
+    def __init__(self, sqs, queue_url: str, since: int):
+        """
+        Args:
+            sqs: SQS client
+            queue_url: TestResultsQueueUrl stack output
+            since: Epoch seconds; messages stored earlier (previous runs) are ignored
+        """
+        self.queue_url = queue_url
+        self.since = since
+        self._sqs = sqs
+        self._deserializer = TypeDeserializer()
+        self._results = {}
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                response = self._sqs.receive_message(
+                    QueueUrl=self.queue_url,
+                    MaxNumberOfMessages=10,
+                    WaitTimeSeconds=20
+                )
+            except Exception as e:
+                print_warning(f"Error receiving test results: {str(e)}")
+                time.sleep(1)
+                continue
+            
+            messages = response.get('Messages', [])
+            if not messages:
+                continue
+            
+            with self._condition:
+                for message in messages:
+                    record = json.loads(message['Body'])
+                    image = record.get('dynamodb', {}).get('NewImage', {})
+                    item = {key: self._deserializer.deserialize(value) for key, value in image.items()}
+                    if item.get('customerEmail') and item.get('timestamp', 0) >= self.since:
+                        self._results[item['customerEmail']] = item
+                self._condition.notify_all()
+            
+            try:
+                self._sqs.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+                        for i, message in enumerate(messages)
+                    ]
+                )
+            except Exception as e:
+                print_warning(f"Error deleting test results: {str(e)}")
+    
+    def wait(self, customer_email: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Block until a message for customer_email arrives or timeout elapses."""
+        with self._condition:
+            self._condition.wait_for(lambda: customer_email in self._results, timeout=timeout)
+            return self._results.get(customer_email)
+    
+    def stop(self):
+        """Stop polling once the current receive returns."""
+        self._stopped.set()
+
+
+# Attributes run_single_test validates and displays
+RESULT_PROJECTION = (
+    'messageId, emailContent, emailSubject, #status, llmJudgeScore, '
+    'customerData, judgeApproved, retryCount, judgeFeedback'
+)
+
+
+def query_latest_message(table, customer_email: str) -> Optional[Dict[str, Any]]:
+    """Return the customer's most recent message, or None."""
+    # Query by customer email using GSI, returning only what the checks use
+    response = table.query(
+        IndexName='CustomerEmailIndex',
+        KeyConditionExpression='customerEmail = :email',
+        ExpressionAttributeValues={':email': customer_email},
+        ProjectionExpression=RESULT_PROJECTION,
+        ExpressionAttributeNames={'#status': 'status'},
+        ScanIndexForward=False,  # Most recent first
+        Limit=1
+    )
+    return response['Items'][0] if response['Items'] else None
+
+
+def wait_for_processing(table, customer_email: str, timeout: int = TEST_TIMEOUT,
+                        results: Optional[ResultsListener] = None) -> Dict[str, Any]:
+    """
+    Wait for message to be processed and stored in DynamoDB.
+    
+    With a results listener the wait is event-driven and the table is only
+    queried once, after a timeout; otherwise the table is polled.
+    """
+    if results is not None:
+        result = results.wait(customer_email, timeout)
+        if result is not None:
+            return result
+        try:
+            return query_latest_message(table, customer_email)
+        except Exception as e:
+            print_error(f"Error querying DynamoDB: {str(e)}")
+            return None
+    
     start_time = time.time()
+    attempt = 0
     
     while time.time() - start_time < timeout:
         try:
-            # Query by customer email using GSI
-            response = table.query(
-                IndexName='CustomerEmailIndex',
-                KeyConditionExpression='customerEmail = :email',
-                ExpressionAttributeValues={':email': customer_email},
-                ScanIndexForward=False,  # Most recent first
-                Limit=1
-            )
-            
-            if response['Items']:
-                return response['Items'][0]
-            
-            time.sleep(2)
+            result = query_latest_message(table, customer_email)
+            if result is not None:
+                return result
         except Exception as e:
             print_error(f"Error querying DynamoDB: {str(e)}")
-            time.sleep(2)
+        
+        # Exponential backoff with jitter: fast results are picked up within
+        # a few hundred ms, slow ones settle at one query every ~2s
+        delay = min(POLL_MAX_DELAY, POLL_BASE_DELAY * (1.6 ** attempt)) + random.uniform(0, 0.1)
+        attempt += 1
+        time.sleep(delay)
     
     return None
 
 
-def get_cloudwatch_logs(log_group: str, minutes: int = 5) -> List[str]:
+def get_cloudwatch_logs(logs, log_group: str, minutes: int = 5) -> List[str]:
     """Retrieve recent CloudWatch logs."""
     try:
         end_time = int(time.time() * 1000)
@@ -155,7 +341,7 @@ def get_cloudwatch_logs(log_group: str, minutes: int = 5) -> List[str]:
             logGroupName=log_group,
             startTime=start_time,
             endTime=end_time,
-            limit=50
+            limit=1000  # Enough to cover a whole test run
         )
         
         return [event['message'] for event in response.get('events', [])]
@@ -164,51 +350,77 @@ def get_cloudwatch_logs(log_group: str, minutes: int = 5) -> List[str]:
         return []
 
 
-def run_single_test(test_name: str, webhook_url: str, table_name: str, payload_file: str) -> bool:
-    """Run a single test case."""
-    print_info(f"Running test: {test_name}")
-    print(f"  Payload file: {payload_file}")
+def get_recent_logs(logs, log_groups: List[str], minutes: int = 5) -> Dict[str, List[str]]:
+    """Retrieve recent CloudWatch logs for several log groups concurrently."""
+    if not log_groups:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(4, len(log_groups))) as executor:
+        messages = executor.map(lambda log_group: get_cloudwatch_logs(logs, log_group, minutes), log_groups)
+        return dict(zip(log_groups, messages))
+
+
+def run_single_test(test_name: str, webhook_url: str, table, payload_file: str,
+                    results: Optional[ResultsListener] = None) -> bool:
+    """
+    Run a single test case.
     
+    Args:
+        test_name: Name shown in the report
+        webhook_url: Webhook endpoint to POST the payload to
+        table: DynamoDB Table resource used only by this test's thread
+        payload_file: Mock payload file name in MOCK_DATA_DIR
+        results: Listener for stored messages; the table is polled without one
+        
+    Returns:
+        True if every check passed
+    """
     # Load payload
     payload = load_mock_payload(payload_file)
     customer_email = payload['customer']['email']
     customer_name = f"{payload['customer']['first_name']} {payload['customer']['last_name']}"
     
-    print(f"  Customer: {customer_name} ({customer_email})")
+    print_info(f"Running test: {test_name} ({customer_email})")
+    
+    # The report is collected and printed once the test finishes
+    report = [
+        f"{Colors.OKCYAN}ℹ {test_name}{Colors.ENDC}",
+        f"  Payload file: {payload_file}",
+        f"  Customer: {customer_name} ({customer_email})"
+    ]
     
     # Send webhook
-    print("  Sending webhook...", end=" ")
     try:
         webhook_response = send_webhook(webhook_url, payload)
         if webhook_response['status_code'] == 200:
-            print_success("Webhook accepted")
+            report.append(f"  Sending webhook... {Colors.OKGREEN}✓ Webhook accepted{Colors.ENDC}")
         else:
-            print_error(f"Webhook failed with status {webhook_response['status_code']}")
+            report.append(f"  Sending webhook... {Colors.FAIL}✗ Webhook failed with status {webhook_response['status_code']}{Colors.ENDC}")
+            print_block(report)
             return False
     except Exception as e:
-        print_error(f"Webhook failed: {str(e)}")
+        report.append(f"  Sending webhook... {Colors.FAIL}✗ Webhook failed: {str(e)}{Colors.ENDC}")
+        print_block(report)
         return False
     
     # Wait for processing
-    print("  Waiting for processing...", end=" ")
-    sys.stdout.flush()
-    
-    result = wait_for_processing(table_name, customer_email)
+    start_time = time.time()
+    result = wait_for_processing(table, customer_email, results=results)
     
     if result is None:
-        print_error("Timeout - message not processed")
+        report.append(f"  Waiting for processing... {Colors.FAIL}✗ Timeout - message not processed{Colors.ENDC}")
+        print_block(report)
         return False
     
-    print_success(f"Processed in {int(time.time())} seconds")
+    report.append(f"  Waiting for processing... {Colors.OKGREEN}✓ Processed in {int(time.time() - start_time)} seconds{Colors.ENDC}")
     
     # Validate result
-    print("  Validating results...")
+    report.append("  Validating results...")
     
     checks = [
         ("Message ID exists", 'messageId' in result),
         ("Email content generated", result.get('emailContent') and len(result['emailContent']) > 0),
         ("Email subject generated", result.get('emailSubject') and len(result['emailSubject']) > 0),
-        ("Status set", result.get('status') in ['approved', 'rejected', 'pending']),
+        ("Status set", result.get('status') in ['approved', 'rejected', 'pending', 'pending_batch']),
         ("Judge score exists", 'llmJudgeScore' in result),
         ("Customer data stored", 'customerData' in result),
     ]
@@ -216,32 +428,33 @@ def run_single_test(test_name: str, webhook_url: str, table_name: str, payload_f
     all_passed = True
     for check_name, check_result in checks:
         if check_result:
-            print(f"    {Colors.OKGREEN}✓{Colors.ENDC} {check_name}")
+            report.append(f"    {Colors.OKGREEN}✓{Colors.ENDC} {check_name}")
         else:
-            print(f"    {Colors.FAIL}✗{Colors.ENDC} {check_name}")
+            report.append(f"    {Colors.FAIL}✗{Colors.ENDC} {check_name}")
             all_passed = False
     
     # Display results
-    print("\n  Generated Content:")
-    print(f"    Status: {Colors.BOLD}{result.get('status', 'unknown').upper()}{Colors.ENDC}")
-    print(f"    Judge Score: {result.get('llmJudgeScore', 'N/A')}/10")
-    print(f"    Approved: {result.get('judgeApproved', False)}")
-    print(f"    Retry Count: {result.get('retryCount', 0)}")
+    report.append("\n  Generated Content:")
+    report.append(f"    Status: {Colors.BOLD}{result.get('status', 'unknown').upper()}{Colors.ENDC}")
+    report.append(f"    Judge Score: {result.get('llmJudgeScore', 'N/A')}/10")
+    report.append(f"    Approved: {result.get('judgeApproved', False)}")
+    report.append(f"    Retry Count: {result.get('retryCount', 0)}")
     
     if result.get('emailSubject'):
-        print(f"    Subject: {result['emailSubject'][:80]}...")
+        report.append(f"    Subject: {result['emailSubject'][:80]}...")
     
     if result.get('emailContent'):
         content = result['emailContent']
         preview = content[:200] + "..." if len(content) > 200 else content
-        print(f"    Content Preview:\n")
+        report.append(f"    Content Preview:\n")
         for line in preview.split('\n'):
-            print(f"      {line}")
+            report.append(f"      {line}")
     
     if result.get('judgeFeedback'):
-        print(f"    Judge Feedback: {result['judgeFeedback']}")
+        report.append(f"    Judge Feedback: {result['judgeFeedback']}")
     
-    print()
+    report.append("")
+    print_block(report)
     return all_passed
 
 
@@ -262,82 +475,109 @@ def run_all_tests():
         sys.exit(1)
     
     print_success("Stack configuration retrieved")
-    print(f"  Webhook URL: {webhook_url}")
-    print(f"  DynamoDB Table: {table_name}")
-    print(f"  SQS Queue: {queue_url}")
+    print_block([
+        f"  Webhook URL: {webhook_url}",
+        f"  DynamoDB Table: {table_name}",
+        f"  SQS Queue: {queue_url}"
+    ])
+    
+    session = get_session()
+    sqs = session.client('sqs')
+    
+    # Stacks outside production pipe stored messages to a results queue, so
+    # tests can wait on it instead of polling the table
+    results = None
+    if outputs.get('TestResultsQueueUrl'):
+        results = ResultsListener(sqs, outputs['TestResultsQueueUrl'], since=int(time.time()))
+        print_info(f"Waiting on test results queue: {outputs['TestResultsQueueUrl']}")
     
     # Check initial queue depth
-    initial_depth = check_queue_depth(queue_url)
+    initial_depth = check_queue_depth(sqs, queue_url)
     print_info(f"Initial queue depth: {initial_depth}")
     
-    # Define test cases
-    test_cases = [
-        ("High-Value Customer - Quarterly Service", "webhook_payload_1.json"),
-        ("Termite Treatment Customer", "webhook_payload_2.json"),
-        ("Long-Term Monthly Customer", "webhook_payload_3.json"),
-    ]
-    
-    # Run tests
-    results = []
+    # Run tests. Each case uses a distinct customer email, so they can run
+    # concurrently; boto3 resources aren't thread-safe, so every test gets
+    # its own Table.
+    test_results = []
     print_header("Running Test Cases")
     
-    for test_name, payload_file in test_cases:
-        try:
-            success = run_single_test(test_name, webhook_url, table_name, payload_file)
-            results.append((test_name, success))
-            
-            # Brief pause between tests
-            if len(results) < len(test_cases):
-                time.sleep(3)
-        except Exception as e:
-            print_error(f"Test failed with exception: {str(e)}")
-            results.append((test_name, False))
+    with ThreadPoolExecutor(max_workers=len(TEST_CASES)) as executor:
+        futures = {
+            executor.submit(
+                run_single_test, test_name, webhook_url,
+                session.resource('dynamodb').Table(table_name), payload_file, results
+            ): test_name
+            for test_name, payload_file in TEST_CASES
+        }
+        for future in as_completed(futures):
+            test_name = futures[future]
+            try:
+                test_results.append((test_name, future.result()))
+            except Exception as e:
+                print_error(f"Test failed with exception: {str(e)}")
+                test_results.append((test_name, False))
+    
+    if results is not None:
+        results.stop()
+    
+    # Report in the order the cases were defined
+    order = {test_name: i for i, (test_name, _) in enumerate(TEST_CASES)}
+    test_results.sort(key=lambda result: order[result[0]])
     
     # Summary
     print_header("Test Summary")
     
-    passed = sum(1 for _, success in results if success)
-    total = len(results)
+    passed = sum(1 for _, success in test_results if success)
+    total = len(test_results)
     
-    for test_name, success in results:
+    summary = []
+    for test_name, success in test_results:
         status = f"{Colors.OKGREEN}PASSED{Colors.ENDC}" if success else f"{Colors.FAIL}FAILED{Colors.ENDC}"
-        print(f"  {status}: {test_name}")
+        summary.append(f"  {status}: {test_name}")
     
-    print(f"\n{Colors.BOLD}Results: {passed}/{total} tests passed{Colors.ENDC}")
+    summary.append(f"\n{Colors.BOLD}Results: {passed}/{total} tests passed{Colors.ENDC}")
+    print_block(summary)
     
     # Performance metrics
     print_header("System Metrics")
     
     try:
-        cloudwatch = boto3.client('cloudwatch')
+        cloudwatch = session.client('cloudwatch')
         
-        # Get approval rate
-        response = cloudwatch.get_metric_statistics(
-            Namespace='ReferralSystem',
-            MetricName='ApprovalRate',
-            StartTime=datetime.utcnow().replace(hour=0, minute=0, second=0),
-            EndTime=datetime.utcnow(),
-            Period=3600,
-            Statistics=['Average']
-        )
+        def metric_query(query_id: str, metric_name: str, stat: str) -> Dict[str, Any]:
+            return {
+                'Id': query_id,
+                'MetricStat': {
+                    'Metric': {'Namespace': 'ReferralSystem', 'MetricName': metric_name},
+                    'Period': 3600,
+                    'Stat': stat
+                }
+            }
         
-        if response['Datapoints']:
-            avg_approval = response['Datapoints'][-1]['Average'] * 100
-            print_info(f"LLM Judge Approval Rate: {avg_approval:.1f}%")
+        # One window for all queries, from midnight UTC until now
+        now = datetime.now(timezone.utc)
+        start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
         
-        # Get generation time
-        response = cloudwatch.get_metric_statistics(
-            Namespace='ReferralSystem',
-            MetricName='GenerationTime',
-            StartTime=datetime.utcnow().replace(hour=0, minute=0, second=0),
-            EndTime=datetime.utcnow(),
-            Period=3600,
-            Statistics=['Average', 'Maximum']
+        # Approval rate and generation time in a single request
+        response = cloudwatch.get_metric_data(
+            MetricDataQueries=[
+                metric_query('approval', 'ApprovalRate', 'Average'),
+                metric_query('gen_avg', 'GenerationTime', 'Average'),
+                metric_query('gen_max', 'GenerationTime', 'Maximum'),
+            ],
+            StartTime=start_of_day,
+            EndTime=now
         )
+        # Values are newest first
+        latest = {result['Id']: result['Values'][0] for result in response['MetricDataResults'] if result['Values']}
+        
+        if 'approval' in latest:
+            avg_approval = latest['approval'] * 100
+            print_info(f"LLM Judge Approval Rate: {avg_approval:.1f}%")
         
-        if response['Datapoints']:
-            avg_time = response['Datapoints'][-1]['Average']
-            max_time = response['Datapoints'][-1]['Maximum']
+        if 'gen_avg' in latest and 'gen_max' in latest:
+            avg_time = latest['gen_avg']
+            max_time = latest['gen_max']
             print_info(f"Average Generation Time: {avg_time:.2f}s")
             print_info(f"Maximum Generation Time: {max_time:.2f}s")
     
@@ -345,7 +585,7 @@ def run_all_tests():
         print_warning(f"Could not retrieve metrics: {str(e)}")
     
     # Final queue depth
-    final_depth = check_queue_depth(queue_url)
+    final_depth = check_queue_depth(sqs, queue_url)
     print_info(f"Final queue depth: {final_depth}")
     
     print_header("Testing Complete")
@@ -355,13 +595,24 @@ def run_all_tests():
         return 0
     else:
         print_error(f"Some tests failed. Check logs for details.")
+        
+        # Surface the latest errors from both functions' logs
+        function_arns = [outputs.get('WebhookHandlerFunctionArn'), outputs.get('OrchestratorFunctionArn')]
+        log_groups = [f"/aws/lambda/{arn.split(':')[-1]}" for arn in function_arns if arn]
+        for log_group, messages in get_recent_logs(session.client('logs'), log_groups).items():
+            errors = [message.strip() for message in messages if 'ERROR' in message][-5:]
+            if errors:
+                print_block([f"  Recent errors in {log_group}:"] + [f"    {error}" for error in errors])
+        
         print_info("\nTroubleshooting:")
-        print("  1. Check CloudWatch Logs:")
-        print("     aws logs tail /aws/lambda/referral-webhook-handler --follow")
-        print("     aws logs tail /aws/lambda/referral-orchestrator --follow")
-        print(f"  2. Check Dead Letter Queue:")
-        print(f"     aws sqs receive-message --queue-url {outputs.get('DeadLetterQueueUrl')}")
-        print("  3. Verify Bedrock access is enabled in your AWS account")
+        print_block([
+            "  1. Check CloudWatch Logs:",
+            "     aws logs tail /aws/lambda/referral-webhook-handler --follow",
+            "     aws logs tail /aws/lambda/referral-orchestrator --follow",
+            "  2. Check Dead Letter Queue:",
+            f"     aws sqs receive-message --queue-url {outputs.get('DeadLetterQueueUrl')}",
+            "  3. Verify Bedrock access is enabled in your AWS account"
+        ])
         return 1
 
 
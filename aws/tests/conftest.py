@@ -0,0 +1,58 @@
+"""
+Shared pytest configuration for the Lambda unit tests.
+
+Every Lambda lives in its own directory as lambda_function.py, so the test
+modules can't simply all import the same module name. Each test module's
+Lambda directory is put on the path right before it is collected, and its
+module is registered as lambda_function while its tests run, so
+patch('lambda_function.<name>') targets the right code. This keeps the modules
+independent whether they run in one process or across pytest-xdist workers.
+"""
+
+import os
+import sys
+
+import pytest
+
+# Lambdas create boto3 clients at import (collection) time, which needs a
+# region. Dummy credentials keep any unmocked call from reaching a real account.
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
+os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
+os.environ.pop('AWS_SESSION_TOKEN', None)
+
+# Lambdas are imported at collection time; keep them from calling SSM on import
+os.environ.setdefault('PREFETCH_PARAMETERS', 'false')
+
+LAMBDA_ROOT = os.path.join(os.path.dirname(__file__), '..', 'lambda')
+
+# Test module -> Lambda directory under aws/lambda
+LAMBDA_DIRS = {
+    'test_orchestrator.py': 'orchestrator',
+    'test_webhook_handler.py': 'webhook_handler',
+}
+
+
+def pytest_collectstart(collector):
+    """Point lambda_function at the right Lambda just before a test module is imported."""
+    if not isinstance(collector, pytest.Module):
+        return
+    lambda_dir = LAMBDA_DIRS.get(collector.path.name)
+    if lambda_dir is None:
+        return
+
+    for other in LAMBDA_DIRS.values():
+        other_path = os.path.abspath(os.path.join(LAMBDA_ROOT, other))
+        if other_path in sys.path:
+            sys.path.remove(other_path)
+    sys.path.insert(0, os.path.abspath(os.path.join(LAMBDA_ROOT, lambda_dir)))
+    sys.modules.pop('lambda_function', None)
+
+
+@pytest.fixture(autouse=True)
+def lambda_module(request):
+    """Register the current test module's Lambda as lambda_function."""
+    module = getattr(request.module, 'lambda_function', None)
+    if module is not None:
+        sys.modules['lambda_function'] = module
+    yield module
@@ -2,19 +2,35 @@
 Unit tests for Orchestrator Lambda function.
 """
 
+import importlib.util
+import io
 import json
 import pytest
 import sys
 import os
 from unittest.mock import Mock, patch, MagicMock
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 
-# Add lambda function directory to path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../lambda/orchestrator'))
-
+# lambda_function resolves to this Lambda's module (see conftest.py)
 import lambda_function
 
 
+def _bedrock_response(content):
+    """Converse API response whose message text is content (str, or an object to JSON-encode)."""
+    text = content if isinstance(content, str) else json.dumps(content)
+    return {'output': {'message': {'content': [{'text': text}]}}}
+
+
+def _load_webhook_handler():
+    """Import the webhook handler under its own name, next to the orchestrator's lambda_function."""
+    path = os.path.join(os.path.dirname(__file__), '..', 'lambda', 'webhook_handler', 'lambda_function.py')
+    spec = importlib.util.spec_from_file_location('webhook_lambda_function', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
 class TestOrchestrator:
     """Test cases for orchestrator function."""
     
@@ -66,17 +82,18 @@ class TestOrchestrator:
         """Test customer data formatting."""
         formatted = lambda_function.format_customer_data(self.customer_data)
         
-        assert "John Smith" in formatted
-        assert "Austin, TX" in formatted
-        assert "Quarterly Pest Control" in formatted
-        assert "high" in formatted
+        # The whole payload is passed through as compact JSON
+        assert json.loads(formatted) == self.customer_data
+        assert '\n' not in formatted
+        assert '"last_name":"Smith"' in formatted
+        assert "Austin" in formatted
     
     def test_generate_email_subject(self):
         """Test email subject generation."""
         subject = lambda_function.generate_email_subject("John")
         
         assert "John" in subject
-        assert "Referral" in subject or "referral" in subject
+        assert subject in [template.format(name="John") for template in lambda_function._SUBJECT_TEMPLATES]
     
     @patch('lambda_function.s3_client')
     def test_get_brand_guidelines(self, mock_s3):
@@ -104,16 +121,7 @@ class TestOrchestrator:
     @patch('lambda_function.cloudwatch')
     def test_call_bedrock_generator(self, mock_cloudwatch, mock_bedrock):
         """Test Bedrock LLM generator call."""
-        mock_response = {
-            'body': Mock(
-                read=Mock(return_value=json.dumps({
-                    'content': [{
-                        'text': 'This is a test referral email content...'
-                    }]
-                }).encode())
-            )
-        }
-        mock_bedrock.invoke_model.return_value = mock_response
+        mock_bedrock.converse.return_value = _bedrock_response('This is a test referral email content...')
         
         result = lambda_function.call_bedrock_generator(
             'anthropic.claude-sonnet-4-20250514-v1:0',
@@ -124,78 +132,52 @@ class TestOrchestrator:
         assert 'email_content' in result
         assert result['email_content'] == 'This is a test referral email content...'
         assert 'generation_time' in result
-        mock_bedrock.invoke_model.assert_called_once()
+        mock_bedrock.converse.assert_called_once()
     
+    @pytest.mark.parametrize('approved,score,issues,feedback', [
+        (True, 9, [], "Excellent email"),
+        (False, 5, ["Too aggressive", "Missing key message"], "Needs improvement"),
+    ], ids=['approved', 'rejected'])
     @patch('lambda_function.bedrock_client')
     @patch('lambda_function.cloudwatch')
-    def test_call_bedrock_judge_approved(self, mock_cloudwatch, mock_bedrock):
-        """Test Bedrock LLM judge call with approval."""
+    def test_call_bedrock_judge(self, mock_cloudwatch, mock_bedrock, approved, score, issues, feedback):
+        """Test Bedrock LLM judge call with approval and rejection."""
         judgment = {
-            "approved": True,
-            "score": 9,
-            "issues": [],
-            "feedback": "Excellent email"
+            "approved": approved,
+            "score": score,
+            "issues": issues,
+            "feedback": feedback
         }
         
-        mock_response = {
-            'body': Mock(
-                read=Mock(return_value=json.dumps({
-                    'content': [{
-                        'text': json.dumps(judgment)
-                    }]
-                }).encode())
-            )
-        }
-        mock_bedrock.invoke_model.return_value = mock_response
+        mock_bedrock.converse.return_value = _bedrock_response(judgment)
         
         result = lambda_function.call_bedrock_judge(
             'anthropic.claude-sonnet-4-20250514-v1:0',
             'Test email content',
-            self.brand_guidelines
+            self.brand_guidelines,
+            "Customer: John Smith"
         )
         
-        assert result['approved'] == True
-        assert result['score'] == 9
-        assert result['feedback'] == "Excellent email"
+        assert result['approved'] == approved
+        assert result['score'] == score
+        assert len(result['issues']) == len(issues)
+        assert result['feedback'] == feedback
     
-    @patch('lambda_function.bedrock_client')
-    @patch('lambda_function.cloudwatch')
-    def test_call_bedrock_judge_rejected(self, mock_cloudwatch, mock_bedrock):
-        """Test Bedrock LLM judge call with rejection."""
-        judgment = {
-            "approved": False,
-            "score": 5,
-            "issues": ["Too aggressive", "Missing key message"],
-            "feedback": "Needs improvement"
-        }
-        
-        mock_response = {
-            'body': Mock(
-                read=Mock(return_value=json.dumps({
-                    'content': [{
-                        'text': json.dumps(judgment)
-                    }]
-                }).encode())
-            )
-        }
-        mock_bedrock.invoke_model.return_value = mock_response
-        
-        result = lambda_function.call_bedrock_judge(
-            'anthropic.claude-sonnet-4-20250514-v1:0',
-            'Test email content',
-            self.brand_guidelines
-        )
+    @pytest.mark.parametrize('judgment,expected', [
+        ({'approved': True, 'score': 9}, None),
+        ({'approved': False, 'reason': None}, None),
+        ({'approved': False, 'reason': 'service_validity'}, 'service_validity'),
+    ], ids=['approved', 'null_reason', 'rejected'])
+    def test_to_judgment_result_reason(self, judgment, expected):
+        """Test that a rejection reason is only carried over when the judge gave one."""
+        result = lambda_function.to_judgment_result(judgment, 1.0)
         
-        assert result['approved'] == False
-        assert result['score'] == 5
-        assert len(result['issues']) == 2
+        assert result.get('reason') == expected
+        assert ('reason' in result) == (expected is not None)
     
-    @patch('lambda_function.dynamodb')
-    def test_store_in_dynamodb(self, mock_dynamodb):
+    @patch('lambda_function.dynamodb_client')
+    def test_store_in_dynamodb(self, mock_dynamodb_client):
         """Test storing message in DynamoDB."""
-        mock_table = Mock()
-        mock_dynamodb.Table.return_value = mock_table
-        
         message_data = {
             'messageId': 'test-123',
             'customerEmail': 'test@example.com',
@@ -205,8 +187,37 @@ class TestOrchestrator:
         
         lambda_function.store_in_dynamodb('TestTable', message_data)
         
-        mock_table.put_item.assert_called_once()
+        mock_dynamodb_client.put_item.assert_called_once()
+        call_kwargs = mock_dynamodb_client.put_item.call_args[1]
+        assert call_kwargs['TableName'] == 'TestTable'
+        assert call_kwargs['Item']['messageId'] == {'S': 'test-123'}
+        assert call_kwargs['ReturnValues'] == 'NONE'
+    
+    @patch('lambda_function.time')
+    @patch('lambda_function.dynamodb_client')
+    def test_flush_items_uses_batch_write_item(self, mock_dynamodb_client, mock_time):
+        """Test that items are serialized into BatchWriteItem requests and unprocessed ones retried."""
+        items = [{'messageId': f'test-{i}', 'timestamp': i, 'llmJudgeScore': Decimal('8')} for i in range(30)]
+        unprocessed = {'TestTable': [{'PutRequest': {'Item': {'messageId': {'S': 'test-0'}}}}]}
+        mock_dynamodb_client.batch_write_item.side_effect = [
+            {'UnprocessedItems': unprocessed},
+            {'UnprocessedItems': {}},
+            {}
+        ]
+        
+        lambda_function.flush_items('TestTable', items)
+        
+        requests = [call[1]['RequestItems'] for call in mock_dynamodb_client.batch_write_item.call_args_list]
+        assert [len(request['TestTable']) for request in requests] == [25, 1, 5]
+        assert requests[1] == unprocessed
+        assert requests[0]['TestTable'][0]['PutRequest']['Item'] == {
+            'messageId': {'S': 'test-0'},
+            'timestamp': {'N': '0'},
+            'llmJudgeScore': {'N': '8'}
+        }
     
+    @patch('lambda_function.get_customer_features', return_value={})
+    @patch('lambda_function.get_active_agent', return_value={'model_id': 'test-model', 'version': 'v1'})
     @patch('lambda_function.get_parameter')
     @patch('lambda_function.get_brand_guidelines')
     @patch('lambda_function.call_bedrock_generator')
@@ -214,14 +225,11 @@ class TestOrchestrator:
     @patch('lambda_function.store_in_dynamodb')
     @patch('lambda_function.cloudwatch')
     def test_process_message_approved(self, mock_cw, mock_store, mock_judge, 
-                                      mock_generator, mock_guidelines, mock_param):
+                                      mock_generator, mock_guidelines, mock_param,
+                                      mock_agent, mock_features):
         """Test complete message processing with approval."""
         # Setup mocks
-        mock_param.side_effect = [
-            'test-bucket',
-            'anthropic.claude-sonnet-4-20250514-v1:0',
-            'TestTable'
-        ]
+        mock_param.side_effect = lambda name: name.rsplit('/', 1)[-1]
         mock_guidelines.return_value = self.brand_guidelines
         mock_generator.return_value = {
             'email_content': 'Test email content',
@@ -251,6 +259,8 @@ class TestOrchestrator:
         assert result['customer_email'] == 'john.smith@example.com'
         mock_store.assert_called_once()
     
+    @patch('lambda_function.get_customer_features', return_value={})
+    @patch('lambda_function.get_active_agent', return_value={'model_id': 'test-model', 'version': 'v1'})
     @patch('lambda_function.get_parameter')
     @patch('lambda_function.get_brand_guidelines')
     @patch('lambda_function.call_bedrock_generator')
@@ -258,14 +268,11 @@ class TestOrchestrator:
     @patch('lambda_function.store_in_dynamodb')
     @patch('lambda_function.cloudwatch')
     def test_process_message_with_retry(self, mock_cw, mock_store, mock_judge, 
-                                       mock_generator, mock_guidelines, mock_param):
+                                       mock_generator, mock_guidelines, mock_param,
+                                      mock_agent, mock_features):
         """Test message processing with retry logic."""
         # Setup mocks
-        mock_param.side_effect = [
-            'test-bucket',
-            'anthropic.claude-sonnet-4-20250514-v1:0',
-            'TestTable'
-        ]
+        mock_param.side_effect = lambda name: name.rsplit('/', 1)[-1]
         mock_guidelines.return_value = self.brand_guidelines
         mock_generator.return_value = {
             'email_content': 'Test email content',
@@ -305,6 +312,237 @@ class TestOrchestrator:
         assert result['retry_count'] == 1
         assert mock_generator.call_count == 2
         assert mock_judge.call_count == 2
+    
+    @pytest.mark.parametrize('reason,attempts', [
+        ('brand', lambda_function.MAX_RETRIES + 1),
+        ('service_validity', 2),
+    ], ids=['brand', 'service_validity'])
+    @patch('lambda_function.get_customer_features', return_value={})
+    @patch('lambda_function.get_active_agent', return_value={'model_id': 'test-model', 'version': 'v1'})
+    @patch('lambda_function.get_parameter')
+    @patch('lambda_function.get_brand_guidelines')
+    @patch('lambda_function.call_bedrock_generator')
+    @patch('lambda_function.call_bedrock_judge')
+    @patch('lambda_function.store_in_dynamodb')
+    @patch('lambda_function.cloudwatch')
+    def test_process_message_repeated_rejection(self, mock_cw, mock_store, mock_judge, mock_generator,
+                                                mock_guidelines, mock_param, mock_agent, mock_features,
+                                                reason, attempts):
+        """Test that only repeated service_validity rejections stop retrying early."""
+        mock_param.side_effect = lambda name: name.rsplit('/', 1)[-1]
+        mock_guidelines.return_value = self.brand_guidelines
+        mock_generator.return_value = {'email_content': 'Test email content', 'generation_time': 2.5}
+        mock_judge.return_value = {
+            'approved': False,
+            'score': 4,
+            'issues': ['Issue 1'],
+            'feedback': 'Needs work',
+            'reason': reason,
+            'service': 'Mosquito Control'
+        }
+        
+        result = lambda_function.process_message({'webhook_payload': self.customer_data})
+        
+        assert result['approved'] == False
+        assert mock_judge.call_count == attempts
+    
+    @pytest.mark.parametrize('metrics_fail', [False, True], ids=['stored', 'metrics_fail'])
+    @patch('lambda_function.get_customer_features', return_value={})
+    @patch('lambda_function.get_active_agent', return_value={'model_id': 'test-model', 'version': 'v1'})
+    @patch('lambda_function.get_parameter')
+    @patch('lambda_function.get_brand_guidelines')
+    @patch('lambda_function.call_bedrock_generator')
+    @patch('lambda_function.call_bedrock_judge')
+    @patch('lambda_function.record_metrics')
+    def test_process_message_id_only_customer(self, mock_metrics, mock_judge, mock_generator,
+                                              mock_guidelines, mock_param, mock_agent, mock_features,
+                                              metrics_fail):
+        """Test that id-only payloads are queued, and only once nothing else can fail."""
+        mock_param.side_effect = lambda name: name.rsplit('/', 1)[-1]
+        mock_guidelines.return_value = self.brand_guidelines
+        mock_generator.return_value = {'email_content': 'Test email content', 'generation_time': 2.5}
+        mock_judge.return_value = {'approved': True, 'score': 9, 'issues': [], 'feedback': 'Great email'}
+        if metrics_fail:
+            mock_metrics.side_effect = RuntimeError('metrics failed')
+        
+        payload = {'event_type': 'service_completed', 'customer': {'id': 'CUST-12345', 'first_name': 'John'}}
+        pending_items = []
+        
+        if metrics_fail:
+            with pytest.raises(RuntimeError):
+                lambda_function.process_message({'webhook_payload': payload}, pending_items)
+            assert pending_items == []
+        else:
+            result = lambda_function.process_message({'webhook_payload': payload}, pending_items)
+            assert result['customer_email'] is None
+            assert len(pending_items) == 1
+            assert pending_items[0]['customerEmail'] == 'CUST-12345'
+
+    
+    @patch('lambda_function.cloudwatch')
+    @patch('lambda_function.flush_items')
+    @patch('lambda_function.s3_client')
+    @patch('lambda_function.bedrock_client')
+    @patch('lambda_function.get_customer_features', return_value=None)
+    @patch('lambda_function.get_active_agent', return_value={'model_id': 'test-model', 'version': '1.0.0'})
+    @patch('lambda_function.get_brand_guidelines')
+    @patch('lambda_function.get_parameter')
+    def test_batch_priority_webhook_is_staged(self, mock_param, mock_guidelines, mock_agent, mock_features,
+                                              mock_bedrock, mock_s3, mock_flush, mock_cw):
+        """Test that a webhook sent with priority 'batch' is staged for batch inference."""
+        mock_param.side_effect = lambda name: name.rsplit('/', 1)[-1]
+        mock_guidelines.return_value = self.brand_guidelines
+        
+        # Build the SQS message exactly as the webhook handler would
+        message = _load_webhook_handler().build_sqs_message(dict(self.customer_data, priority='batch'))
+        event = {
+            'Records': [{
+                'messageId': 'batch-message-id',
+                'body': message['MessageBody'],
+                'messageAttributes': {
+                    name: {'stringValue': value['StringValue'], 'dataType': value['DataType']}
+                    for name, value in message['MessageAttributes'].items()
+                }
+            }]
+        }
+        
+        response = lambda_function.lambda_handler(event, None)
+        
+        assert response['batchItemFailures'] == []
+        mock_bedrock.converse.assert_not_called()
+        put_kwargs = mock_s3.put_object.call_args[1]
+        assert put_kwargs['Bucket'] == 's3-bucket-name'
+        assert put_kwargs['Key'].startswith(lambda_function.BATCH_PENDING_PREFIX)
+        table_name, items = mock_flush.call_args[0]
+        assert table_name == 'dynamodb-table-name'
+        assert [item['status'] for item in items] == ['pending_batch']
+    
+    @patch('lambda_function.cloudwatch')
+    @patch('lambda_function.get_parameter')
+    @patch('lambda_function.flush_items')
+    @patch('lambda_function.process_message')
+    def test_failed_record_item_is_not_flushed(self, mock_process, mock_flush, mock_param, mock_cw):
+        """Test that a record which fails after queueing its item doesn't get that item written."""
+        mock_param.return_value = 'TestTable'
+        
+        def process(message_body, pending_items, metrics):
+            # The item is queued before the record fails
+            pending_items.append({'messageId': message_body['id']})
+            if message_body['id'] == 'bad':
+                raise RuntimeError('failed after write')
+            return {'message_id': message_body['id']}
+        mock_process.side_effect = process
+        
+        event = {
+            'Records': [
+                {'messageId': 'sqs-good', 'body': json.dumps({'id': 'good'})},
+                {'messageId': 'sqs-bad', 'body': json.dumps({'id': 'bad'})}
+            ]
+        }
+        
+        response = lambda_function.lambda_handler(event, None)
+        
+        assert response['batchItemFailures'] == [{'itemIdentifier': 'sqs-bad'}]
+        mock_flush.assert_called_once_with('TestTable', [{'messageId': 'good'}])
+
+    
+    @pytest.mark.parametrize('job_fails', [False, True], ids=['submitted', 'submission_fails'])
+    @patch('lambda_function.boto3')
+    @patch('lambda_function.s3_client')
+    @patch('lambda_function.list_objects')
+    def test_submit_batch_jobs_moves_prompts_after_submission(self, mock_list, mock_s3, mock_boto3, job_fails):
+        """Test that staged prompts only leave the pending prefix once their job exists."""
+        pending = [f"{lambda_function.BATCH_PENDING_PREFIX}msg-{i}.jsonl" for i in range(lambda_function.BATCH_MIN_RECORDS)]
+        mock_list.return_value = pending
+        create_job = mock_boto3.client.return_value.create_model_invocation_job
+        if job_fails:
+            create_job.side_effect = RuntimeError('ThrottlingException')
+        else:
+            create_job.return_value = {'jobArn': 'arn:aws:bedrock:job/test'}
+        
+        if job_fails:
+            with pytest.raises(RuntimeError):
+                lambda_function.submit_batch_jobs('test-bucket', 'test-model')
+        else:
+            assert lambda_function.submit_batch_jobs('test-bucket', 'test-model') == ['arn:aws:bedrock:job/test']
+        
+        assert mock_s3.copy_object.call_count == len(pending)
+        deleted = [call[1]['Key'] for call in mock_s3.delete_object.call_args_list]
+        if job_fails:
+            # Job copies are cleaned up; the staged originals stay pending
+            assert len(deleted) == len(pending)
+            assert all(key.startswith(lambda_function.BATCH_JOBS_PREFIX) for key in deleted)
+        else:
+            assert sorted(deleted) == sorted(pending)
+
+    
+    @pytest.mark.parametrize('flush_fails', [False, True], ids=['stored', 'flush_fails'])
+    @patch('lambda_function.flush_items')
+    @patch('lambda_function.finish_batch_message')
+    @patch('lambda_function.get_active_agent', return_value={'model_id': 'test-model', 'version': 'v1'})
+    @patch('lambda_function.get_brand_guidelines')
+    @patch('lambda_function.s3_client')
+    @patch('lambda_function.list_objects')
+    def test_collect_batch_outputs_deletes_only_stored_results(self, mock_list, mock_s3, mock_guidelines, mock_agent,
+                                                               mock_finish, mock_flush, flush_fails):
+        """Test that batch output is only deleted from S3 after its result has been written."""
+        outputs = [f"{lambda_function.BATCH_OUTPUT_PREFIX}job/123/msg-{i}.jsonl.out" for i in range(30)]
+        mock_list.return_value = outputs
+        mock_s3.get_object.side_effect = lambda Bucket, Key: {
+            'Body': io.BytesIO(json.dumps({'modelOutput': {'output': {'message': {'content': [{'text': 'Email'}]}}}}).encode())
+        }
+        mock_finish.side_effect = lambda table_name, message_id, *args: {'messageId': message_id}
+        if flush_fails:
+            # The first chunk is written, the second fails
+            mock_flush.side_effect = [None, RuntimeError('DynamoDB unavailable')]
+            with pytest.raises(RuntimeError):
+                lambda_function.collect_batch_outputs('test-bucket', 'TestTable', [])
+        else:
+            assert lambda_function.collect_batch_outputs('test-bucket', 'TestTable', []) == 30
+        
+        written = lambda_function.BATCH_WRITE_MAX_ITEMS if flush_fails else len(outputs)
+        assert [len(call[0][1]) for call in mock_flush.call_args_list] == [lambda_function.BATCH_WRITE_MAX_ITEMS, 5]
+        deleted = {call[1]['Key'] for call in mock_s3.delete_object.call_args_list}
+        assert deleted & set(outputs) == set(outputs[:written])
+    
+    @patch('lambda_function.flush_items')
+    @patch('lambda_function.list_objects')
+    def test_collect_batch_outputs_stops_before_timeout(self, mock_list, mock_flush):
+        """Test that no batch work is started when the invocation is about to time out."""
+        mock_list.return_value = [f"{lambda_function.BATCH_OUTPUT_PREFIX}job/123/msg-1.jsonl.out"]
+        context = Mock(get_remaining_time_in_millis=Mock(return_value=lambda_function.BATCH_TIME_RESERVE_MS - 1))
+        
+        with patch('lambda_function.get_brand_guidelines'), patch('lambda_function.get_active_agent'):
+            assert lambda_function.collect_batch_outputs('test-bucket', 'TestTable', [], context) == 0
+        mock_flush.assert_not_called()
+    
+    @patch('lambda_function.flush_items')
+    @patch('lambda_function.finish_batch_message')
+    @patch('lambda_function.get_brand_guidelines')
+    @patch('lambda_function.bedrock_client')
+    @patch('lambda_function.s3_client')
+    @patch('lambda_function.list_objects_modified')
+    def test_complete_expired_messages(self, mock_list, mock_s3, mock_bedrock, mock_guidelines, mock_finish, mock_flush):
+        """Test that only messages staged longer than BATCH_MAX_WAIT are generated in real time."""
+        now = datetime.now(timezone.utc)
+        old_key = f"{lambda_function.BATCH_PENDING_PREFIX}old-msg.jsonl"
+        new_key = f"{lambda_function.BATCH_PENDING_PREFIX}new-msg.jsonl"
+        mock_list.return_value = [
+            (old_key, now - timedelta(seconds=lambda_function.BATCH_MAX_WAIT + 60)),
+            (new_key, now)
+        ]
+        model_input = {'system': [{'text': 'System'}], 'messages': [{'role': 'user', 'content': [{'text': 'Customer'}]}]}
+        mock_s3.get_object.return_value = {'Body': io.BytesIO(json.dumps({'modelInput': model_input}).encode())}
+        mock_bedrock.converse.return_value = _bedrock_response('Generated email')
+        mock_finish.return_value = {'messageId': 'old-msg'}
+        
+        assert lambda_function.complete_expired_messages('test-bucket', 'TestTable', 'test-model', []) == 1
+        
+        mock_s3.get_object.assert_called_once_with(Bucket='test-bucket', Key=old_key)
+        assert mock_bedrock.converse.call_args[1]['messages'] == model_input['messages']
+        assert mock_finish.call_args[0][:4] == ('TestTable', 'old-msg', 'Generated email', None)
+        mock_flush.assert_called_once_with('TestTable', [{'messageId': 'old-msg'}])
+        mock_s3.delete_object.assert_called_once_with(Bucket='test-bucket', Key=old_key)
 
 
 if __name__ == '__main__':
@@ -8,137 +8,218 @@ import sys
 import os
 from unittest.mock import Mock, patch, MagicMock
 
-# Add lambda function directory to path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../lambda/webhook_handler'))
-
+# lambda_function resolves to this Lambda's module (see conftest.py)
 import lambda_function
 
 
+@pytest.fixture
+def valid_payload():
+    """A fresh valid webhook payload; tests may mutate it freely."""
+    return {
+        "event_type": "service_completed",
+        "customer": {
+            "id": "CUST-12345",
+            "first_name": "John",
+            "last_name": "Smith",
+            "email": "john.smith@example.com",
+            "phone": "+1-555-0123",
+            "address": {
+                "street": "123 Main St",
+                "city": "Austin",
+                "state": "TX",
+                "zip": "78701"
+            }
+        },
+        "service": {
+            "type": "Quarterly Pest Control",
+            "date": "2024-12-10",
+            "technician": "Mike Johnson",
+            "satisfaction_score": 5,
+            "next_service": "2025-03-10"
+        },
+        "referral_eligible": True,
+        "customer_lifetime_value": "high",
+        "services_count": 8
+    }
+
+
+@pytest.fixture
+def api_gateway_event(valid_payload):
+    """API Gateway event wrapping the valid payload."""
+    return {
+        "body": json.dumps(valid_payload),
+        "headers": {
+            "Content-Type": "application/json"
+        },
+        "httpMethod": "POST"
+    }
+
+
 class TestWebhookHandler:
     """Test cases for webhook handler."""
     
-    def setup_method(self):
-        """Set up test fixtures."""
-        self.valid_payload = {
-            "event_type": "service_completed",
-            "customer": {
-                "id": "CUST-12345",
-                "first_name": "John",
-                "last_name": "Smith",
-                "email": "john.smith@example.com",
-                "phone": "+1-555-0123",
-                "address": {
-                    "street": "123 Main St",
-                    "city": "Austin",
-                    "state": "TX",
-                    "zip": "78701"
-                }
-            },
-            "service": {
-                "type": "Quarterly Pest Control",
-                "date": "2024-12-10",
-                "technician": "Mike Johnson",
-                "satisfaction_score": 5,
-                "next_service": "2025-03-10"
-            },
-            "referral_eligible": True,
-            "customer_lifetime_value": "high",
-            "services_count": 8
-        }
-        
-        self.api_gateway_event = {
-            "body": json.dumps(self.valid_payload),
-            "headers": {
-                "Content-Type": "application/json"
-            },
-            "httpMethod": "POST"
-        }
-    
-    def test_validate_webhook_payload_valid(self):
+    def test_validate_webhook_payload_valid(self, valid_payload):
         """Test validation with valid payload."""
-        is_valid, error_msg = lambda_function.validate_webhook_payload(self.valid_payload)
+        is_valid, error_msg = lambda_function.validate_webhook_payload(valid_payload)
         assert is_valid == True
         assert error_msg == ""
     
-    def test_validate_webhook_payload_missing_event_type(self):
-        """Test validation with missing event_type."""
-        payload = self.valid_payload.copy()
-        del payload['event_type']
+    def test_validate_webhook_payload_missing_event_type(self, valid_payload):
+        """Test validation accepts a payload without event_type (the orchestrator defaults it)."""
+        del valid_payload['event_type']
         
-        is_valid, error_msg = lambda_function.validate_webhook_payload(payload)
-        assert is_valid == False
-        assert "event_type" in error_msg
+        is_valid, error_msg = lambda_function.validate_webhook_payload(valid_payload)
+        assert is_valid == True
+        assert error_msg == ""
     
-    def test_validate_webhook_payload_missing_customer_field(self):
-        """Test validation with missing customer email."""
-        payload = self.valid_payload.copy()
-        del payload['customer']['email']
+    def test_validate_webhook_payload_missing_customer_field(self, valid_payload):
+        """Test validation accepts a customer identified only by id."""
+        del valid_payload['customer']['email']
         
+        is_valid, error_msg = lambda_function.validate_webhook_payload(valid_payload)
+        assert is_valid == True
+        assert error_msg == ""
+    
+    @pytest.mark.parametrize('payload', [{}, [], 'not an object'])
+    def test_validate_webhook_payload_not_object(self, payload):
+        """Test validation rejects empty and non-object payloads."""
         is_valid, error_msg = lambda_function.validate_webhook_payload(payload)
         assert is_valid == False
-        assert "email" in error_msg
+        assert "object" in error_msg
     
-    def test_validate_webhook_payload_invalid_email(self):
+    def test_validate_webhook_payload_invalid_email(self, valid_payload):
         """Test validation with invalid email format."""
-        payload = self.valid_payload.copy()
-        payload['customer']['email'] = "invalid-email"
+        valid_payload['customer']['email'] = "invalid-email"
         
-        is_valid, error_msg = lambda_function.validate_webhook_payload(payload)
+        is_valid, error_msg = lambda_function.validate_webhook_payload(valid_payload)
         assert is_valid == False
         assert "email" in error_msg.lower()
     
-    def test_validate_webhook_payload_not_referral_eligible(self):
-        """Test validation with referral_eligible = False."""
-        payload = self.valid_payload.copy()
-        payload['referral_eligible'] = False
+    @pytest.mark.parametrize('customer', ['CUST-12345', ['john.smith@example.com'], 42])
+    def test_validate_webhook_payload_customer_not_object(self, valid_payload, customer):
+        """Test validation rejects a customer that isn't a JSON object."""
+        valid_payload['customer'] = customer
         
-        is_valid, error_msg = lambda_function.validate_webhook_payload(payload)
+        is_valid, error_msg = lambda_function.validate_webhook_payload(valid_payload)
         assert is_valid == False
-        assert "eligible" in error_msg.lower()
+        assert "customer" in error_msg.lower()
+    
+    @patch('lambda_function.get_parameter')
+    @patch('lambda_function.get_sqs_client')
+    def test_lambda_handler_null_customer(self, mock_get_sqs, mock_param, valid_payload):
+        """Test that a null customer is accepted and queued as an empty object."""
+        mock_param.side_effect = lambda name: name.rsplit('/', 1)[-1]
+        mock_sqs = mock_get_sqs.return_value
+        mock_sqs.send_message.return_value = {'MessageId': 'test-message-id-123'}
+        valid_payload['customer'] = None
+        
+        response = lambda_function.lambda_handler({'body': json.dumps(valid_payload)}, None)
+        
+        assert response['statusCode'] == 200
+        queued = json.loads(mock_sqs.send_message.call_args[1]['MessageBody'])
+        assert queued['webhook_payload']['customer'] == {}
+        mock_sqs.send_message_batch.assert_not_called()
+    
+    def test_validate_webhook_payload_not_referral_eligible(self, valid_payload):
+        """Test validation leaves referral eligibility to the orchestrator's judge."""
+        valid_payload['referral_eligible'] = False
+        
+        is_valid, error_msg = lambda_function.validate_webhook_payload(valid_payload)
+        assert is_valid == True
+        assert error_msg == ""
     
     @patch('lambda_function.sqs_client')
-    def test_send_to_sqs_success(self, mock_sqs):
+    def test_send_to_sqs_success(self, mock_sqs, valid_payload):
         """Test successful SQS message sending."""
         mock_sqs.send_message.return_value = {
             'MessageId': 'test-message-id-123'
         }
         
         queue_url = 'https://sqs.us-east-1.amazonaws.com/123456789012/test-queue'
-        response = lambda_function.send_to_sqs(queue_url, self.valid_payload)
+        response = lambda_function.send_to_sqs(queue_url, valid_payload)
         
         assert response['MessageId'] == 'test-message-id-123'
         mock_sqs.send_message.assert_called_once()
+        
+        # Typical payloads are well under the compression threshold
+        call_kwargs = mock_sqs.send_message.call_args[1]
+        assert json.loads(call_kwargs['MessageBody'])['webhook_payload'] == valid_payload
+        assert 'encoding' not in call_kwargs['MessageAttributes']
     
-    @patch('lambda_function.ssm_client')
-    @patch('lambda_function.sqs_client')
-    def test_lambda_handler_success(self, mock_sqs, mock_ssm):
+    @pytest.mark.parametrize('priority,expected', [
+        ('batch', 'batch'),
+        ('realtime', 'realtime'),
+        ('urgent', None),
+        (None, None),
+    ])
+    def test_build_sqs_message_priority(self, valid_payload, priority, expected):
+        """Test that a known priority is passed on to the orchestrator and others are dropped."""
+        if priority is not None:
+            valid_payload['priority'] = priority
+        
+        message = lambda_function.build_sqs_message(valid_payload)
+        
+        assert json.loads(message['MessageBody']).get('priority') == expected
+    
+    def test_build_sqs_message_compresses_large_payload(self, valid_payload):
+        """Test that oversized payloads are compressed and round-trip intact."""
+        zstandard = pytest.importorskip('zstandard')
+        import base64
+        valid_payload['notes'] = 'x' * (lambda_function.SQS_COMPRESSION_THRESHOLD + 1)
+        
+        message = lambda_function.build_sqs_message(valid_payload)
+        
+        assert message['MessageAttributes']['encoding']['StringValue'] == 'zstd+b64'
+        assert len(message['MessageBody']) < lambda_function.SQS_COMPRESSION_THRESHOLD
+        decoded = zstandard.ZstdDecompressor().decompress(base64.b64decode(message['MessageBody']))
+        assert json.loads(decoded)['webhook_payload'] == valid_payload
+    
+    @patch('lambda_function.get_parameter')
+    @patch('lambda_function.get_sqs_client')
+    def test_lambda_handler_success(self, mock_get_sqs, mock_param, api_gateway_event):
         """Test successful Lambda handler execution."""
         # Mock SSM parameter
-        mock_ssm.get_parameter.return_value = {
-            'Parameter': {
-                'Value': 'https://sqs.us-east-1.amazonaws.com/123456789012/test-queue'
-            }
-        }
+        mock_param.return_value = 'https://sqs.us-east-1.amazonaws.com/123456789012/test-queue'
         
         # Mock SQS send
+        mock_sqs = mock_get_sqs.return_value
         mock_sqs.send_message.return_value = {
             'MessageId': 'test-message-id-123'
         }
         
         # Execute handler
-        response = lambda_function.lambda_handler(self.api_gateway_event, None)
+        response = lambda_function.lambda_handler(api_gateway_event, None)
         
         # Verify response
         assert response['statusCode'] == 200
         body = json.loads(response['body'])
         assert body['messageId'] == 'test-message-id-123'
-        assert body['customer_email'] == 'john.smith@example.com'
+        assert body['customer_identifier'] == 'john.smith@example.com'
+    
+    @pytest.mark.parametrize('feature_fails', [False, True], ids=['queued', 'feature_queue_down'])
+    @patch('lambda_function.get_parameter')
+    @patch('lambda_function.get_sqs_client')
+    def test_lambda_handler_sends_feature_event(self, mock_get_sqs, mock_param, api_gateway_event, valid_payload, feature_fails):
+        """Test that webhooks are forwarded to the feature enricher without depending on it."""
+        mock_param.side_effect = lambda name: name.rsplit('/', 1)[-1]
+        mock_sqs = mock_get_sqs.return_value
+        mock_sqs.send_message.return_value = {'MessageId': 'test-message-id-123'}
+        if feature_fails:
+            mock_sqs.send_message_batch.side_effect = RuntimeError('queue unavailable')
+        
+        response = lambda_function.lambda_handler(api_gateway_event, None)
+        
+        assert response['statusCode'] == 200
+        assert mock_sqs.send_message.call_args[1]['QueueUrl'] == 'sqs-queue-url'
+        batch_kwargs = mock_sqs.send_message_batch.call_args[1]
+        assert batch_kwargs['QueueUrl'] == 'feature-queue-url'
+        assert [json.loads(entry['MessageBody']) for entry in batch_kwargs['Entries']] == [{'customer_data': valid_payload}]
     
     @patch('lambda_function.ssm_client')
     def test_lambda_handler_invalid_payload(self, mock_ssm):
         """Test Lambda handler with invalid payload."""
         invalid_event = {
-            "body": json.dumps({"event_type": "test"})  # Missing required fields
+            "body": json.dumps({"event_type": "test", "customer": "CUST-12345"})  # Customer must be an object
         }
         
         response = lambda_function.lambda_handler(invalid_event, None)
@@ -176,6 +257,14 @@ class TestWebhookHandler:
             value2 = lambda_function.get_parameter('/test/param')
             assert value2 == 'test-value'
             assert mock_ssm.get_parameter.call_count == 1  # Still 1, not 2
+            
+            # Once the TTL has passed the value is fetched again
+            expired = lambda_function.time.monotonic() + lambda_function.PARAMETER_CACHE_TTL + 1
+            with patch('lambda_function.time') as mock_time:
+                mock_time.monotonic.return_value = expired
+                value3 = lambda_function.get_parameter('/test/param')
+            assert value3 == 'test-value'
+            assert mock_ssm.get_parameter.call_count == 2
 
 
 if __name__ == '__main__':
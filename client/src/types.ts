@@ -63,12 +63,12 @@ export interface ReferralMessage {
   judgeIssues?: string[]
   rejectionReason: string  // appropriateness, service_validity, or brand
   createdAt: string
-  status: 'approved' | 'rejected' | 'pending'
+  status: 'approved' | 'rejected' | 'pending' | 'pending_batch'
   retryCount: number
-  customerData: WebhookPayload
+  customerData?: WebhookPayload  // not included in the /messages response
 }
 
-export type Status = 'approved' | 'rejected' | 'pending'
+export type Status = 'approved' | 'rejected' | 'pending' | 'pending_batch'
 
 export interface ServiceCatalogItem {
   name: string
@@ -1,106 +1,286 @@
 """
 Simple Flask server to query DynamoDB and serve data to React UI.
+
+START.sh runs it under gunicorn:
+    gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:8000 server.app:app
+Running this file directly starts Flask's single-process development server.
 """
 
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import boto3
-from decimal import Decimal
+import gzip
+import hashlib
+import heapq
+import logging
+import os
+import threading
+import time
+from operator import itemgetter
+from pathlib import Path
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
 import json
 
-app = Flask(__name__)
-CORS(app)  # Enable CORS for React frontend
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib json module
+    orjson = None
+
+try:
+    from flask_compress import Compress
+except ImportError:  # flask-compress is optional; responses are then sent uncompressed
+    Compress = None
 
-# Initialize AWS clients
-dynamodb = boto3.resource('dynamodb')
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+# Initialize AWS clients. DynamoDB is used through the low-level client,
+# deserializing only the projected attributes of each item.
+dynamodb = boto3.client('dynamodb')
 cloudformation = boto3.client('cloudformation')
 
-# Cache for table name
-_table_name = None
+# /health body; it never changes, so it's encoded once
+HEALTH_BODY = b'{"status":"ok"}'
+
+# Origin of the React frontend (Vite dev server by default)
+FRONTEND_ORIGIN = os.environ.get('FRONTEND_ORIGIN', 'http://localhost:3000')
+
+# Most messages returned by /messages
+MESSAGES_LIMIT = 50
+
+# The UI polls /messages; responses are reused for this many seconds so
+# polling doesn't turn into one DynamoDB query per request. The body is at
+# most MESSAGES_LIMIT items, so it's encoded whole rather than streamed.
+MESSAGES_CACHE_TTL = float(os.environ.get('MESSAGES_CACHE_TTL', '2'))
+_messages_cache = {'expires': 0.0, 'body': b''}
+_messages_cache_lock = threading.Lock()
+
+# statusGroup value shared by every message (TimestampIndex partition key)
+MESSAGE_STATUS_GROUP = 'ALL'
+
+# Attributes the UI's ReferralMessage type reads; the stored webhook payload
+# (customerData) is the bulk of each item and isn't displayed
+MESSAGE_PROJECTION = (
+    'messageId, #ts, customerEmail, customerName, emailContent, emailSubject, '
+    'llmGeneratorScore, llmJudgeScore, judgeApproved, judgeFeedback, judgeIssues, '
+    'rejectionReason, createdAt, #status, retryCount'
+)
+MESSAGE_PROJECTION_NAMES = {'#ts': 'timestamp', '#status': 'status'}
+
+# Brand guidelines, located relative to this file so the server can be
+# started from any directory
+GUIDELINES_PATH = Path(__file__).resolve().parent.parent / 'aws' / 'brand_guidelines' / 'guidelines.json'
+
+# Service catalog from the brand guidelines; the file doesn't change while
+# the server runs, so it's read on the first request and kept in memory as
+# the encoded response body, plus a gzipped copy, each with its own ETag
+_service_catalog = None
+_service_catalog_lock = threading.Lock()
 
 
 def get_table_name():
-    """Get DynamoDB table name from CloudFormation stack."""
-    global _table_name
-    if _table_name is None:
+    """Get DynamoDB table name from $AWS_REFERRAL_TABLE or the CloudFormation stack."""
+    if os.environ.get('AWS_REFERRAL_TABLE'):
+        return os.environ['AWS_REFERRAL_TABLE']
+    
+    try:
+        response = cloudformation.describe_stacks(StackName='referral-email-system')
+        outputs = response['Stacks'][0]['Outputs']
+        for output in outputs:
+            if output['OutputKey'] == 'DynamoDBTableName':
+                return output['OutputValue']
+        logger.error("Error getting table name: DynamoDBTableName not in stack outputs")
+    except Exception as e:
+        logger.error(f"Error getting table name: {e}")
+    return 'ReferralMessages'  # Fallback
+
+
+# Resolved once at startup so the first /messages request doesn't wait on
+# DescribeStacks
+TABLE_NAME = get_table_name()
+
+
+def from_json(data):
+    """Parse JSON from str or bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def to_json_bytes(obj):
+    """Serialize obj to JSON bytes in one pass."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, so jsonify() uses it too."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app = Flask(__name__)
+# Enable CORS for the React frontend on the routes it calls; browsers may
+# cache preflight responses for a day
+CORS(
+    app,
+    resources={
+        r'/messages': {'origins': FRONTEND_ORIGIN},
+        r'/service-catalog': {'origins': FRONTEND_ORIGIN}
+    },
+    max_age=86400
+)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+# Compress JSON responses (mainly /messages; /service-catalog is compressed
+# once up front and passed through as-is)
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 500
+if Compress is not None:
+    Compress(app)
+
+
+def load_service_catalog():
+    """
+    Load the service catalog from the brand guidelines, reading the file only once.
+    Raises FileNotFoundError if the guidelines file can't be found.
+    
+    Returns:
+        Dictionary of content encoding ('identity' or 'gzip') -> (body, ETag)
+    """
+    global _service_catalog
+    if _service_catalog is not None:
+        return _service_catalog
+    with _service_catalog_lock:
+        if _service_catalog is None:
+            guidelines = from_json(GUIDELINES_PATH.read_bytes())
+            body = to_json_bytes(guidelines.get('service_catalog', {}))
+            etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+            _service_catalog = {
+                'identity': (body, etag),
+                'gzip': (gzip.compress(body, compresslevel=9), f"{etag}-gzip")
+            }
+    return _service_catalog
+
+
+class NativeNumberDeserializer(TypeDeserializer):
+    """TypeDeserializer that returns numbers as int or float instead of Decimal."""
+
+    def _deserialize_n(self, value):
         try:
-            response = cloudformation.describe_stacks(StackName='referral-email-system')
-            outputs = response['Stacks'][0]['Outputs']
-            for output in outputs:
-                if output['OutputKey'] == 'DynamoDBTableName':
-                    _table_name = output['OutputValue']
-                    break
-        except Exception as e:
-            print(f"Error getting table name: {e}")
-            _table_name = 'ReferralMessages'  # Fallback
-    return _table_name
+            return int(value)
+        except ValueError:
+            return float(value)
+
+
+_deserializer = NativeNumberDeserializer()
 
 
-def decimal_default(obj):
-    """JSON serializer for Decimal objects."""
-    if isinstance(obj, Decimal):
-        return float(obj)
-    raise TypeError
+def deserialize_item(item):
+    """Convert a low-level DynamoDB item into plain Python values."""
+    return {key: _deserializer.deserialize(value) for key, value in item.items()}
+
+
+def scan_recent_messages():
+    """
+    Scan the whole table and keep the 50 most recent messages, newest first.
+    Used for stacks whose messages table predates TimestampIndex.
+    """
+    pages = dynamodb.get_paginator('scan').paginate(
+        TableName=TABLE_NAME,
+        ProjectionExpression=MESSAGE_PROJECTION,
+        ExpressionAttributeNames=MESSAGE_PROJECTION_NAMES
+    )
+    items = [deserialize_item(item) for page in pages for item in page['Items']]
+    # timestamp is the table's sort key, so every item has it
+    return heapq.nlargest(MESSAGES_LIMIT, items, key=itemgetter('timestamp'))
+
+
+def query_recent_messages():
+    """Query the 50 most recent messages from TimestampIndex, newest first."""
+    # The paginator follows LastEvaluatedKey when a page comes back short of
+    # the limit, and stops once MaxItems have been returned
+    pages = dynamodb.get_paginator('query').paginate(
+        TableName=TABLE_NAME,
+        IndexName='TimestampIndex',
+        KeyConditionExpression='statusGroup = :group',
+        ExpressionAttributeValues={':group': {'S': MESSAGE_STATUS_GROUP}},
+        ScanIndexForward=False,
+        ProjectionExpression=MESSAGE_PROJECTION,
+        ExpressionAttributeNames=MESSAGE_PROJECTION_NAMES,
+        PaginationConfig={'MaxItems': MESSAGES_LIMIT, 'PageSize': MESSAGES_LIMIT}
+    )
+    try:
+        return [deserialize_item(item) for page in pages for item in page['Items']]
+    except ClientError as e:
+        # Missing index: ValidationException from DynamoDB (ResourceNotFoundException
+        # from some emulators)
+        if e.response['Error']['Code'] not in ('ValidationException', 'ResourceNotFoundException'):
+            raise
+        logger.warning(f"TimestampIndex unavailable, scanning instead: {e}")
+        return scan_recent_messages()
 
 
 @app.route('/messages', methods=['GET'])
 def get_messages():
     """Get all messages from DynamoDB."""
     try:
-        table_name = get_table_name()
-        table = dynamodb.Table(table_name)
-        
-        # Scan table (limit to recent 50 messages)
-        response = table.scan(Limit=50)
-        items = response.get('Items', [])
+        if time.monotonic() >= _messages_cache['expires']:
+            with _messages_cache_lock:
+                # Another request may have refreshed it while we waited
+                if time.monotonic() >= _messages_cache['expires']:
+                    # Encode once; numbers are already int/float (see NativeNumberDeserializer)
+                    _messages_cache['body'] = to_json_bytes(query_recent_messages())
+                    _messages_cache['expires'] = time.monotonic() + MESSAGES_CACHE_TTL
         
-        # Sort by timestamp (most recent first)
-        items.sort(key=lambda x: x.get('timestamp', 0), reverse=True)
-        
-        # Convert Decimal to float for JSON serialization
-        items_json = json.loads(json.dumps(items, default=decimal_default))
-        
-        return jsonify(items_json)
+        response = Response(_messages_cache['body'], mimetype='application/json')
+        response.cache_control.max_age = int(MESSAGES_CACHE_TTL)
+        return response
     except Exception as e:
-        print(f"Error fetching messages: {e}")
+        logger.exception("Error fetching messages")
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint."""
-    return jsonify({'status': 'ok'})
+    return Response(HEALTH_BODY, mimetype='application/json')
 
 
 @app.route('/service-catalog', methods=['GET'])
 def get_service_catalog():
     """Get service catalog from brand guidelines."""
     try:
-        # Read the guidelines file
-        with open('aws/brand_guidelines/guidelines.json', 'r') as f:
-            guidelines = json.load(f)
-        
-        # Extract just the service catalog
-        service_catalog = guidelines.get('service_catalog', {})
-        
-        return jsonify(service_catalog)
-    except FileNotFoundError:
-        # Fallback if running from different directory
-        try:
-            with open('../aws/brand_guidelines/guidelines.json', 'r') as f:
-                guidelines = json.load(f)
-            service_catalog = guidelines.get('service_catalog', {})
-            return jsonify(service_catalog)
-        except Exception as e:
-            print(f"Error loading service catalog: {e}")
-            return jsonify({'error': 'Service catalog not found'}), 404
+        catalog = load_service_catalog()
+        encoding = 'gzip' if request.accept_encodings['gzip'] else 'identity'
+        body, etag = catalog[encoding]
+        response = Response(body, mimetype='application/json')
+        if encoding == 'gzip':
+            response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        # Answers 304 with no body when the client's If-None-Match still matches
+        return response.make_conditional(request)
+    except FileNotFoundError as e:
+        logger.error(f"Error loading service catalog: {e}")
+        return jsonify({'error': 'Service catalog not found'}), 404
     except Exception as e:
-        print(f"Error fetching service catalog: {e}")
+        logger.exception("Error fetching service catalog")
         return jsonify({'error': str(e)}), 500
 
 
 if __name__ == '__main__':
     print("Starting Flask server on http://localhost:8000")
     print("Make sure your AWS credentials are configured!")
-    app.run(host='0.0.0.0', port=8000, debug=True)
+    # Debugger and reloader only on request; they slow every request down
+    app.run(host='0.0.0.0', port=8000, debug=os.environ.get('FLASK_DEBUG') == '1')
 